@@ -1,5 +1,7 @@
 """Tools for extracting extended emission from a cube."""
 #Standard Imports
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 import os
 import sys
 
@@ -7,13 +9,15 @@ import sys
 from astropy import units as u
 from astropy import convolution
 from astropy.cosmology import WMAP9
+from astropy.io import fits
 from astropy.modeling import models, fitting
 from astropy.nddata import Cutout2D
 from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
 from photutils import DAOStarFinder
 from scipy.ndimage.measurements import center_of_mass
-from scipy.signal import medfilt
-from scipy.ndimage import convolve as sc_ndi_convolve
+from scipy import ndimage
+from scipy.signal import oaconvolve
 from scipy.stats import sigmaclip, tstd
 from skimage import measure, morphology
 from tqdm import tqdm
@@ -252,8 +256,224 @@ def reg2mask(fits_in, reg):
     return hdu_out
 
 
+def _get_wl_windows(zmask, wl_width_px):
+    """Get the white-light window used to model the PSF at each wavelength.
+
+    Each window is centered on its wavelength layer and grown symmetrically
+    until it contains at least wl_width_px unmasked layers (or all of them).
+
+    Args:
+        zmask (numpy.ndarray): Boolean mask of layers to use in white-light images.
+        wl_width_px (float): Width of the white-light window, in layers.
+
+    Returns:
+        numpy.ndarray: Index of the first layer of each window.
+        numpy.ndarray: Index of the last layer of each window, plus one.
+        numpy.ndarray: Number of unmasked layers in each window.
+
+    """
+    n_z = zmask.size
+    zrange = np.arange(n_z)
+    n_valid = np.concatenate(([0], np.cumsum(zmask)))
+    n_min = min(n_valid[-1], wl_width_px)
+
+    #Grow the windows which are still too small until all are large enough
+    radius = np.full(n_z, max(int(np.floor(wl_width_px / 2)), 0))
+    while True:
+        z_lo = np.clip(zrange - radius, 0, n_z)
+        z_hi = np.clip(zrange + radius + 1, 0, n_z)
+        n_wl = n_valid[z_hi] - n_valid[z_lo]
+        short = n_wl < n_min
+        if not np.any(short):
+            return z_lo, z_hi, n_wl
+        radius[short] += 1
+
+def _cumsum_layers(data, zmask):
+    """Get the cumulative sum of the unmasked layers of a cube along z.
+
+    Args:
+        data (numpy.ndarray): The input cube.
+        zmask (numpy.ndarray): Boolean mask of layers to include in the sum.
+
+    Returns:
+        numpy.ndarray: Cumulative sum, with a leading layer of zeros, such that
+            the sum over layers z_0 to z_1 - 1 is csum[z_1] - csum[z_0].
+
+    """
+    csum = np.zeros((data.shape[0] + 1,) + data.shape[1:])
+    csum[1:] = data
+    csum[1:][~zmask] = 0
+    np.cumsum(csum, axis=0, out=csum)
+    return csum
+
+def _clipped_layer_medians(layers):
+    """Get the 2-sigma clipped median of each layer in a stack of images."""
+    return utils.sigmaclip_median(layers.reshape(layers.shape[0], -1), True, low=2, high=2)
+
+def _psf_model_empirical(cube, zmask, wl_width_px, fit_labels, sub_labels, var=None,
+                         max_size=2**22):
+    """Model PSFs at every wavelength by scaling sliding white-light images.
+
+    The white-light image of each layer is the mean over its window (see
+    _get_wl_windows), taken from a cumulative sum along z so that the cost does
+    not depend on the window size. Layers are processed in blocks of ~max_size
+    elements, evaluating the scale factors of all sources in each block at once.
+
+    Each source is described by a label (1, 2, ...) in fit_labels and
+    sub_labels, and each spaxel belongs to at most one source, so blended
+    sources are never modeled twice in the same spaxel.
+
+    Args:
+        cube (numpy.ndarray): The input cube.
+        zmask (numpy.ndarray): Boolean mask of layers to use in white-light images.
+        wl_width_px (float): Width of the white-light window, in layers.
+        fit_labels (numpy.ndarray): 2D label image of spaxels used to scale the
+            PSF of each source, with 0 for unused spaxels.
+        sub_labels (numpy.ndarray): 2D label image of spaxels to model for each
+            source, with 0 for unused spaxels.
+        var (numpy.ndarray): Variance cube associated with input. Optional.
+        max_size (int): Approximate number of elements per block of layers.
+
+    Returns:
+        numpy.ndarray: The PSF model cube.
+        numpy.ndarray: The variance on the PSF model, or None if var is None.
+
+    """
+    z_lo, z_hi, n_wl = _get_wl_windows(zmask, wl_width_px)
+    csum = _cumsum_layers(cube, zmask)
+    psf_cube = np.zeros(cube.shape)
+
+    if var is not None:
+        var_csum = _cumsum_layers(var, zmask)
+        psf_var = np.zeros(cube.shape)
+    else:
+        psf_var = None
+
+    fit_masks = [fit_labels == label for label in range(1, sub_labels.max() + 1)]
+    sub_mask = sub_labels > 0
+    sub_index = sub_labels[sub_mask]
+
+    zblock = max(1, max_size // cube[0].size)
+    for z_0 in tqdm(range(0, cube.shape[0], zblock)):
+        blk = slice(z_0, z_0 + zblock)
+        z_lo_b, z_hi_b, n_wl_b = z_lo[blk], z_hi[blk], n_wl[blk]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+
+            #Get layers and white-light images with background levels removed
+            layers = cube[blk] - _clipped_layer_medians(cube[blk])[:, None, None]
+            wl_imgs = (csum[z_hi_b] - csum[z_lo_b]) / n_wl_b[:, None, None]
+            wl_imgs -= _clipped_layer_medians(wl_imgs)[:, None, None]
+
+            #Calculate scaling factor for each PSF model, set to zero for bad values
+            scale = np.zeros((layers.shape[0], len(fit_masks) + 1))
+            for label, fit_mask in enumerate(fit_masks, start=1):
+                if np.any(fit_mask):
+                    ratio = layers[:, fit_mask] / wl_imgs[:, fit_mask]
+                    scale[:, label] = np.median(ratio, axis=1)
+            scale[~(scale >= 0) | np.isinf(scale)] = 0
+            scale = scale[:, sub_index]
+
+            #Create empirical PSF models by scaling WL images
+            psf_cube[blk][:, sub_mask] = scale * wl_imgs[:, sub_mask]
+
+            #Propagate variance on this
+            if var is not None:
+                psf_var[blk][:, sub_mask] = (scale / n_wl_b[:, None])**2 * (
+                    var_csum[z_hi_b][:, sub_mask] - var_csum[z_lo_b][:, sub_mask]
+                    )
+
+    return psf_cube, psf_var
+
+def _fit_psf_layer(args):
+    """Fit an analytical PSF model to one layer, in a worker process."""
+    return modeling.fit_model2d(*args)
+
+def _psf_model_analytic(cube, pos, use_model, fit_mask, sub_mask, n_workers=1,
+                        max_size=2**22):
+    """Model a PSF at every wavelength by fitting a 2D Moffat or Gaussian.
+
+    Args:
+        cube (numpy.ndarray): The input cube.
+        pos (float tuple): Position (x, y) of the source in image coordinates.
+        use_model (str): The analytical model to fit, 'moffat' or 'gauss'.
+        fit_mask (numpy.ndarray): 2D boolean mask of spaxels used to fit the PSF.
+        sub_mask (numpy.ndarray): 2D boolean mask of spaxels to model.
+        n_workers (int): Number of processes over which to distribute layers.
+        max_size (int): Approximate number of elements per block of layers
+            when removing background levels.
+
+    Returns:
+        numpy.ndarray: The PSF model cube.
+
+    """
+    if 'moffat' in use_model.lower():
+        model_func = modeling.moffat2d
+    elif 'gauss' in use_model.lower():
+        model_func = modeling.gauss2d
+    else:
+        raise ValueError("use_model must be 'gauss' or 'moffat'")
+
+    ygrid, xgrid = np.indices(cube.shape[1:])
+    fity, fitx = ygrid[fit_mask], xgrid[fit_mask]
+    xmin, xmax = fitx.min() - 1, fitx.max() + 2
+    ymin, ymax = fity.min() - 1, fity.max() + 2
+    fit_box = (slice(max(ymin, 0), ymax), slice(max(xmin, 0), xmax))
+
+    #Get the fitting region of each layer, after median subtraction
+    fit_args = []
+    zblock = max(1, max_size // cube[0].size)
+    for z_0 in range(0, cube.shape[0], zblock):
+        layers = cube[z_0:z_0 + zblock]
+        layers = layers - _clipped_layer_medians(layers)[:, None, None]
+
+        for layer_i in layers:
+            if model_func is modeling.moffat2d:
+                model_bounds = [
+                    (0, layer_i[fit_mask].max() * 3),
+                    (pos[1], pos[1]),
+                    (pos[0], pos[0]),
+                    (0.1, 15.0),
+                    (0.1, 15.0)
+                ]
+            else:
+                model_bounds = [
+                    (0, layer_i[fit_mask].max() * 3),
+                    (pos[1], pos[1]),
+                    (pos[0], pos[0]),
+                    (0.5, 2.0),
+                    (0.5, 2.0),
+                    (0, 0)
+                ]
+            fit_args.append((
+                model_func,
+                model_bounds,
+                ygrid[fit_box],
+                xgrid[fit_box],
+                layer_i[fit_box]
+            ))
+
+    #Fit layers, either in this process or in a pool of workers
+    if n_workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(n_workers)
+        model_fits = pool.imap(_fit_psf_layer, fit_args)
+    else:
+        pool = None
+        model_fits = map(_fit_psf_layer, fit_args)
+
+    #Create analytical model of each layer within subtraction mask
+    psf_cube = np.zeros(cube.shape)
+    for i, model_fit in enumerate(tqdm(model_fits, total=len(fit_args))):
+        psf_cube[i][sub_mask] = model_func(model_fit.x, ygrid[sub_mask], xgrid[sub_mask])
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return psf_cube
+
 def psf_sub(inputfits, pos, r_fit=1.5, r_sub=5.0, wl_window=200, wmasks=None, recenter=True,
-            var=None, maskpsf=False, use_model=None):
+            var=None, maskpsf=False, use_model=None, n_workers=1):
     """Models and subtracts a single point-source in a 3D data cube.
 
     Args:
@@ -272,6 +492,8 @@ def psf_sub(inputfits, pos, r_fit=1.5, r_sub=5.0, wl_window=200, wmasks=None, re
             model with a 2D Moffat or 2D Gaussian estimate instead. Default
             is None (i.e. standard empirical PSF model is used). This takes significantly longer,
             but can help when subtracting blended sources.
+        n_workers (int): Number of processes over which to distribute wavelength
+            layers when fitting an analytical model (see use_model).
 
     Returns:
         numpy.ndarray: PSF-subtracted data cube
@@ -283,13 +505,12 @@ def psf_sub(inputfits, pos, r_fit=1.5, r_sub=5.0, wl_window=200, wmasks=None, re
     #Open fits image and extract info
     cube = inputfits[0].data.copy()
     header = inputfits[0].header
-    zrange = np.arange(cube.shape[0])
     wav = coordinates.get_wav_axis(header)
     cd3_3 = header["CD3_3"]
+    usevar = var is not None
 
-    if var is not None:
+    if usevar:
         var_cube = var.copy()
-        usevar = True
 
     #Get plate scales in arcseconds and Angstrom
     rr_arcsec = coordinates.get_rgrid(inputfits, pos, unit='arcsec')
@@ -297,144 +518,111 @@ def psf_sub(inputfits, pos, r_fit=1.5, r_sub=5.0, wl_window=200, wmasks=None, re
     #Remove NaN values
     cube = np.nan_to_num(cube, nan=0.0, posinf=0, neginf=0)
 
-    #Create cube for subtracted cube and for model of psf and assoc. variance
-    psf_cube = np.zeros_like(cube)
-    psf_cube_var = np.zeros_like(psf_cube)
-
-    #Create white-light image
+    #Create wavelength mask for white-light images
     zmask = np.ones_like(wav, dtype=bool)
-    for (wav0, wav1) in wmasks:
-        zmask[(wav >= wav0) & (wav <= wav1)] = 0
-    nzmax = np.count_nonzero(zmask)
-
-    #Create WL image
-    wl_img = np.sum(cube[zmask], axis=0)
-
-    ygrid, xgrid = np.indices(wl_img.shape)
+    if wmasks is not None:
+        for (wav0, wav1) in wmasks:
+            zmask[(wav >= wav0) & (wav <= wav1)] = 0
 
-    #Reposition source using data within 1'' if requested
+    #Reposition source using data within 2'' if requested
     if recenter:
-        recenter_img = wl_img.copy()
+        recenter_img = np.sum(cube[zmask], axis=0)
         recenter_img[rr_arcsec > 2.0] = 0
-        pos = center_of_mass(recenter_img)
+        pos = center_of_mass(recenter_img)[::-1]
         rr_arcsec = coordinates.get_rgrid(inputfits, pos, unit='arcsec')
 
-    #Get boolean masks for
+    #Get boolean masks for fitting and subtraction
     fit_mask = (rr_arcsec <= r_fit)
     sub_mask = (rr_arcsec <= r_sub)
 
-    fitx = xgrid[np.where(fit_mask == 1)]
-    fity = ygrid[np.where(fit_mask == 1)]
-    xmin, xmax = fitx.min() - 1, fitx.max() + 2
-    ymin, ymax = fity.min() - 1, fity.max() + 2
-
-    #Run through wavelength layers
-    for i in tqdm(range(wav.size)):
-
-        #Get current layer and do median subtraction (after sigclipping)
-        layer_i = cube[i].copy()
-        layer_i -= np.median(sigmaclip(layer_i, low=2, high=2).clipped)
-
-        #Construct empirical PSF model if using this method
-        if use_model is None:
-
-            #Get initial width of white-light bandpass in px
-            wl_width_px = wl_window / cd3_3
-
-            #Create initial white-light mask, centered on j with above width
-            wl_mask = zmask & (np.abs(zrange - i) <= wl_width_px / 2)
-
-            #Grow mask until minimum number of valid wavelength layers included
-            while np.count_nonzero(wl_mask) < min(nzmax, wl_window / cd3_3):
-                wl_width_px += 2
-                wl_mask = zmask & (np.abs(zrange - i) <= wl_width_px / 2)
-
-            #Get white-light image and do the same thing
-            n_wl = np.count_nonzero(wl_mask)
-            wl_img_i = np.sum(cube[wl_mask], axis=0) / n_wl
-
-            #Try to remove any elevated background levels
-            wl_img_i -= np.median(sigmaclip(wl_img_i, low=2, high=2).clipped)
-
-            #Calculate scaling factor for PSF model
-            scale_factor = np.median(layer_i[fit_mask] / wl_img_i[fit_mask])
-
-            #Set to zero for bad values
-            if scale_factor < 0 or np.isinf(scale_factor) or np.isnan(scale_factor):
-                scale_factor = 0
-
-            #Create empirical PSF model by scaling WL image
-            psf_model = scale_factor * wl_img_i
-
-            #Propagate variance on this
-            if usevar:
-                psf_model_var = (scale_factor / n_wl)**2 * np.sum(var_cube[wl_mask], axis=0)
-                psf_cube_var[i][sub_mask] += psf_model_var[sub_mask]
-
-        #If user wants to fit analytical model instead of empirical PSF
-        else:
-            if 'moffat' in use_model.lower():
-                model_func = modeling.moffat2d
-                model_bounds = [
-                    (0, layer_i[fit_mask].max() * 3),
-                    (pos[0], pos[0]),
-                    (pos[1], pos[1]),
-                    (0.1, 15.0),
-                    (0.1, 15.0)
-                ]
-
-            elif 'gauss' in use_model.lower():
-                model_func = modeling.gauss2d
-                model_bounds = [
-                    (0, layer_i[fit_mask].max() * 3),
-                    (pos[1], pos[1]),
-                    (pos[0], pos[0]),
-                    (0.5, 2.0),
-                    (0.5, 2.0),
-                    (0, 0)
-                ]
-            else:
-                raise ValueError("use_model must be 'gauss' or 'moffat'")
-
-            model_fit = modeling.fit_model2d(
-                model_func,
-                model_bounds,
-                ygrid[ymin:ymax, xmin:xmax],
-                xgrid[ymin:ymax, xmin:xmax],
-                layer_i[ymin:ymax, xmin:xmax]
-            )
-            #Create analytical model
-            psf_model = model_func(model_fit.x, ygrid, xgrid)
-
-        #Add 2D PSF model to psf cube, within subtraction mask
-        psf_cube[i][sub_mask] += psf_model[sub_mask]
+    #Model the PSF at every wavelength
+    if use_model is None:
+        psf_cube, psf_cube_var = _psf_model_empirical(
+            cube,
+            zmask,
+            wl_window / cd3_3,
+            fit_mask.astype(int),
+            sub_mask.astype(int),
+            var=var_cube if usevar else None
+        )
+    else:
+        psf_cube = _psf_model_analytic(
+            cube,
+            pos,
+            use_model,
+            fit_mask,
+            sub_mask,
+            n_workers=n_workers
+        )
+        psf_cube_var = None
 
     #Subtract 3D PSF model
+    psf_cube = psf_cube.astype(cube.dtype)
     cube -= psf_cube
 
     if maskpsf:
-        cube = cube.T
-        cube[fit_mask.T] = 0
-        cube = cube.T
+        cube[:, fit_mask] = 0
 
     #Return subtracted data alongside model
     if usevar:
-        var_cube += psf_cube_var
+        if psf_cube_var is not None:
+            var_cube += psf_cube_var
         return cube, psf_cube, var_cube
 
     return cube, psf_cube
 
+def _get_source_labels(header, shape, sources, r_fit, r_sub):
+    """Assign each spaxel to the nearest of several sources, within a radius.
+
+    Args:
+        header (astropy.io.fits.Header): Header of the 2D or 3D input data.
+        shape (int tuple): Shape of the 2D image.
+        sources (list): List of (x, y) source positions, in image coordinates.
+            Ties in distance are resolved in favour of earlier sources.
+        r_fit (float): Inner radius, in arcsec, used for fitting PSFs.
+        r_sub (float): Outer radius, in arcsec, used to subtract PSFs.
+
+    Returns:
+        numpy.ndarray: 2D label image of spaxels used to fit each source.
+        numpy.ndarray: 2D label image of spaxels to subtract for each source.
+
+    """
+    if header["NAXIS"] == 3:
+        header = coordinates.get_header2d(header)
+    xscale, yscale = proj_plane_pixel_scales(WCS(header))
+    xscale = (xscale * u.deg).to(u.arcsec).value
+    yscale = (yscale * u.deg).to(u.arcsec).value
+
+    ygrid, xgrid = np.indices(shape, dtype=float)
+    labels = np.zeros(shape, dtype=int)
+    rr_min = np.full(shape, np.inf)
+    for label, (src_x, src_y) in enumerate(sources, start=1):
+        rr_arcsec = np.sqrt(((xgrid - src_x) * xscale)**2 + ((ygrid - src_y) * yscale)**2)
+        closer = rr_arcsec < rr_min
+        labels[closer] = label
+        rr_min[closer] = rr_arcsec[closer]
+
+    fit_labels = np.where(rr_min <= r_fit, labels, 0)
+    sub_labels = np.where(rr_min <= r_sub, labels, 0)
+
+    return fit_labels, sub_labels
+
 def psf_sub_all(inputfits, r_fit=1.5, r_sub=5.0, reg=None, pos=None,
                 recenter=True, auto=7, wl_window=200, wmasks=None, var_cube=None,
-                maskpsf=False):
+                maskpsf=False, use_model=None, n_workers=1):
     """Models and subtracts multiple point-sources in a 3D data cube.
 
+    All sources are subtracted jointly, in a single pass through the cube. Each
+    spaxel is modeled by the nearest source within r_sub, so blended sources
+    are not subtracted twice where their footprints overlap.
+
     Args:
         inputfits (astrop FITS object): Input data cube/FITS.
         r_fit (float): Inner radius, in arcsec, used for fitting PSF.
         r_sub (float): Outer radius, in arcsec, used to subtract PSF.
         reg (str): Path to a DS9 region file containing sources to subtract.
-        pos (float tuple): Position of the source to subtract.
+        pos (float tuple): Position (x, y) of the source to subtract.
+        recenter (bool): Recenter each source using the centroid within a radius of 2''.
         auto (float): SNR above which to automatically detect/subtract sources.
             Note: One of the parameters reg, pos, or auto must be provided.
         wl_window (int): Size of white-light window (in Angstrom) to use.
@@ -443,6 +631,12 @@ def psf_sub_all(inputfits, r_fit=1.5, r_sub=5.0, reg=None, pos=None,
         wmasks (int tuple): Wavelength regions to exclude from white-light images.
         var_cube (numpy.ndarray): Variance cube associated with input. Optional.
             Method returns propagated variance if given.
+        maskpsf (bool): Set to TRUE to mask the spaxels used to fit each PSF.
+        use_model (str): Set to 'moffat' or 'gauss' to fit an analytical PSF
+            model instead (see psf_sub). Sources are then subtracted one at a
+            time, brightest first.
+        n_workers (int): Number of processes over which to distribute wavelength
+            layers when fitting an analytical model.
 
     Returns:
         numpy.ndarray: PSF-subtracted data cube
@@ -470,9 +664,8 @@ def psf_sub_all(inputfits, r_fit=1.5, r_sub=5.0, reg=None, pos=None,
         >>> sub_cube, psf_model = psf_subtract(myfits, pos=(21.1, 34.6))
 
     """
-    #Open fits image and extract info
-    cube = inputfits[0].data
-    cube = np.nan_to_num(cube, nan=0.0, posinf=0, neginf=0)
+    #Open fits image and extract info (this is the only copy of the cube)
+    cube = np.nan_to_num(inputfits[0].data, nan=0.0, posinf=0, neginf=0)
     header = inputfits[0].header
     wav = coordinates.get_wav_axis(header)
     usevar = var_cube is not None
@@ -480,13 +673,11 @@ def psf_sub_all(inputfits, r_fit=1.5, r_sub=5.0, reg=None, pos=None,
     #Get WCS information
     wcs = WCS(header)
 
-    #Create cube for subtracted cube and for model of psf
-    sub_cube = cube.copy()
-
     #Create wavelength mask for white-light image
     zmask = np.ones_like(wav, dtype=bool)
-    for (wav0, wav1) in wmasks:
-        zmask[(wav >= wav0) & (wav <= wav1)] = 0
+    if wmasks is not None:
+        for (wav0, wav1) in wmasks:
+            zmask[(wav >= wav0) & (wav <= wav1)] = 0
 
     #Create white-light image
     wl_img = np.sum(cube[zmask], axis=0)
@@ -511,7 +702,7 @@ def psf_sub_all(inputfits, r_fit=1.5, r_sub=5.0, reg=None, pos=None,
             src_x, src_y, _ = wcs.all_world2pix(src_ra, src_dec, header["CRVAL3"], 0)
             src_x = float(src_x)
             src_y = float(src_y)
-            sources.append((src_y, src_x))
+            sources.append((src_x, src_y))
 
     #Otherwise, use the automatic method
     else:
@@ -540,39 +731,152 @@ def psf_sub_all(inputfits, r_fit=1.5, r_sub=5.0, reg=None, pos=None,
         #Reverse to get descending order (brightest sources first)
         sources.reverse()
 
-    #Run through sources
-    psf_model = np.zeros_like(cube)
-    sub_cube = cube.copy()
-
-    for src_pos in sources:
-
-        res = psf_sub(inputfits,
-                      pos=src_pos,
-                      r_fit=r_fit,
-                      r_sub=r_sub,
-                      wl_window=wl_window,
-                      wmasks=wmasks,
-                      var=var_cube,
-                      maskpsf=maskpsf,
-                      recenter=recenter
-                      )
-        if len(res) == 3:
-            sub_cube, model_p, var_cube = res
-
-        elif len(res) == 2:
-            sub_cube, model_p = res
-
-        #Update FITS data and model cube
-        inputfits[0].data = sub_cube
-        psf_model += model_p
+    #Subtract analytical models one source at a time
+    if use_model is not None:
+        psf_model = np.zeros_like(cube)
+        sub_fits = fits.HDUList([fits.PrimaryHDU(cube, header)])
+
+        for src_pos in sources:
+            res = psf_sub(sub_fits,
+                          pos=src_pos,
+                          r_fit=r_fit,
+                          r_sub=r_sub,
+                          wl_window=wl_window,
+                          wmasks=wmasks,
+                          var=var_cube,
+                          maskpsf=maskpsf,
+                          recenter=recenter,
+                          use_model=use_model,
+                          n_workers=n_workers
+                          )
+            if usevar:
+                sub_fits[0].data, model_p, var_cube = res
+            else:
+                sub_fits[0].data, model_p = res
+            psf_model += model_p
+
+        if usevar:
+            return sub_fits[0].data, psf_model, var_cube
+
+        return sub_fits[0].data, psf_model
+
+    #Reposition sources using data within 2'' if requested
+    if recenter:
+        for i, src_pos in enumerate(sources):
+            _, sub_labels = _get_source_labels(header, wl_img.shape, [src_pos], 0, 2.0)
+            recenter_img = np.where(sub_labels > 0, wl_img, 0)
+            sources[i] = center_of_mass(recenter_img)[::-1]
+
+    #Model all sources jointly and subtract
+    fit_labels, sub_labels = _get_source_labels(header, wl_img.shape, sources, r_fit, r_sub)
+    psf_model, psf_var = _psf_model_empirical(
+        cube,
+        zmask,
+        wl_window / header["CD3_3"],
+        fit_labels,
+        sub_labels,
+        var=var_cube
+    )
+    psf_model = psf_model.astype(cube.dtype)
+    cube -= psf_model
+
+    if maskpsf:
+        cube[:, fit_labels > 0] = 0
 
     if usevar:
-        return sub_cube, psf_model, var_cube
+        return cube, psf_model, var_cube + psf_var
+
+    return cube, psf_model
+
+def _running_median(spectra, window, n_workers=1, max_size=2**22):
+    """Median-filter many spectra along the first axis.
+
+    Each filtered value is the median of a sliding window of the spectrum,
+    reflected at the ends. Each spectrum is filtered on its own with scipy's
+    1D median filter, which uses a fast running median, rather than through
+    the much slower general N-D rank filter. Spectra are split into chunks of
+    ~max_size elements, which can be distributed over a pool of threads.
+
+    Args:
+        spectra (numpy.ndarray): The spectra, shape (N_z, N_spec).
+        window (int): Size of the median filter window. Must be odd.
+        n_workers (int): Number of threads to use.
+        max_size (int): Approximate number of elements per chunk.
+
+    Returns:
+        numpy.ndarray: The filtered spectra, shape (N_z, N_spec).
+
+    """
+    if window % 2 == 0:
+        raise ValueError("Median filter window must be odd.")
+
+    filtered = np.zeros(spectra.shape)
+
+    chunk_size = max(1, max_size // spectra.shape[0])
+    chunks = [slice(i, i + chunk_size) for i in range(0, spectra.shape[1], chunk_size)]
+
+    def filter_chunk(chunk):
+        for i in range(chunk.start, min(chunk.stop, spectra.shape[1])):
+            filtered[:, i] = ndimage.median_filter(spectra[:, i], size=window, mode='mirror')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(filter_chunk, chunks))
+
+    return filtered
 
-    return sub_cube, psf_model
+def _polyfit_spectra(wav, spectra, zmask, poly_k):
+    """Fit a polynomial to many spectra which share the same wavelength axis.
+
+    This is equivalent to calling np.polyfit(..., cov=True) on each spectrum,
+    but since the design matrix is the same for every spectrum, all of them are
+    solved at once with a single pseudo-inverse.
+
+    Args:
+        wav (numpy.ndarray): The wavelength axis, shape (N_z,).
+        spectra (numpy.ndarray): The spectra, shape (N_z, N_spec).
+        zmask (numpy.ndarray): Boolean mask of wavelengths to use in the fit.
+        poly_k (int): The degree of the polynomial.
+
+    Returns:
+        numpy.ndarray: The polynomial models, shape (N_z, N_spec).
+        numpy.ndarray: The variance on the models, propagated from the fit
+            covariance of each spectrum, shape (N_z, N_spec).
+
+    """
+    order = poly_k + 1
+    n_fit = np.count_nonzero(zmask)
+    if n_fit <= order:
+        raise ValueError("the number of data points must exceed order "
+                         "to scale the covariance matrix")
+
+    #Scaled Vandermonde matrix of the fitted wavelengths, as in np.polyfit
+    lhs = np.vander(wav[zmask], order)
+    scale = np.sqrt(np.sum(lhs**2, axis=0))
+    lhs /= scale
+
+    #Solve for all coefficients in one matrix multiply
+    rhs = spectra[zmask]
+    coeff = np.linalg.pinv(lhs) @ rhs
+    resids = np.sum((rhs - lhs @ coeff)**2, axis=0)
+    coeff = (coeff.T / scale).T
+
+    #Covariance of each fit is the same base matrix, scaled by residuals
+    vbase = np.linalg.inv(lhs.T @ lhs) / np.outer(scale, scale)
+    fac = resids / (n_fit - order)
+
+    #Evaluate models on the full wavelength axis
+    vander = np.vander(wav, order)
+    model = vander @ coeff
+
+    #Variance terms are sum_m (sum_l wav^(k-l) * C_lm / sqrt(C_mm))^2 for the
+    #covariance C = vbase * fac of each spectrum, which factorizes as below
+    var_base = np.sum((vander @ vbase / np.sqrt(np.diag(vbase)))**2, axis=1)
+    var_model = np.outer(var_base, fac)
+
+    return model, var_model
 
 def bg_sub(inputfits, method='polyfit', poly_k=1, median_window=31, wmasks=None,
-           mask_reg=None, var=None):
+           mask_reg=None, var=None, n_workers=1):
     """Subtracts extended continuum emission / scattered light from a cube
 
     Args:
@@ -581,15 +885,20 @@ def bg_sub(inputfits, method='polyfit', poly_k=1, median_window=31, wmasks=None,
             'polyfit': Fits polynomial to the spectrum in each spaxel (default.)
             'median': Subtract the spatial median of each wavelength layer.
             'medfilt': Model spectrum in each spaxel by median filtering it.
+                Spectra are reflected at the ends. Versions up to 0.8.7
+                zero-padded them (scipy.signal.medfilt), so models of the
+                first and last median_window // 2 layers differ from those.
             'noisefit': Model noise in each z-layer and subtract mean.
         poly_k (int): The degree of polynomial to use for background modeling.
         median_window (int): The filter window size to use if median filtering.
+            Must be odd.
         wmasks (int tuple): Wavelength regions to exclude from white-light images.
         mask_reg (str): Path to a DS9 region file to use to exclude regions
             when using 'median' method of bg subtraction.
         var (numpy.ndarray): Variance cube associated with input data.
             NOTE: Variance is only formally propagated for 'polyfit'. For  other methods, the input
             variance is re-scaled empirically using reduction.variance.scale_variance.
+        n_workers (int): Number of threads to use for median filtering.
 
     Returns:
         numpy.ndarray: Background-subtracted cube
@@ -617,55 +926,30 @@ def bg_sub(inputfits, method='polyfit', poly_k=1, median_window=31, wmasks=None,
     #Subtract background by fitting a low-order polynomial
     if method == 'polyfit':
 
-        #Run through spaxels and subtract low-order polynomial
-        for y_ind in tqdm(range(cube.shape[1])):
-            for x_ind in range(cube.shape[2]):
-
-                #Extract spectrum at this location
-                spectrum = cube[:, y_ind, x_ind].copy()
-
-                coeff, covar = np.polyfit(wav[zmask], spectrum[zmask], poly_k, full=False, cov=True)
-
-                polymodel = np.poly1d(coeff)
+        #Fit low-order polynomials to all non-empty spaxels at once
+        use_xy = ~mask_2d
+        bg_model, bg_var = _polyfit_spectra(wav, cube[:, use_xy], zmask, poly_k)
 
-                #Get background model
-                bg_model = polymodel(wav)
+        #Subtract background model
+        cube[:, use_xy] -= bg_model
+        model_cube[:, use_xy] += bg_model
 
-                if mask_2d[y_ind, x_ind] != 0:
-                    continue
-
-                cube[:, y_ind, x_ind] -= bg_model
-
-                #Add to model
-                model_cube[:, y_ind, x_ind] += bg_model
-
-                if var is None:
-                    continue
-
-                for m in range(covar.shape[0]):
-                    var_m = 0
-                    for l in range(covar.shape[1]):
-                        var_m += np.power(wav, poly_k - l) * covar[l, m] / np.sqrt(covar[m, m])
-                    var_out[:, y_ind, x_ind] += var_m**2
+        if var is not None:
+            var_out[:, use_xy] += bg_var
 
     #Subtract background by estimating it with a median filter
     elif method == 'medfilt':
 
-        #Get median filtered spectrum as background model
-        bg_model = medfilt(cube, kernel_size=(median_window, 1, 1))
+        #Get median filtered spectrum of each non-empty spaxel as background model
+        use_xy = ~mask_2d
+        bg_model = _running_median(cube[:, use_xy], median_window, n_workers=n_workers)
 
-        bg_model_t = bg_model.T
-        bg_model_t[mask_2d.T] = 0
-        bg_model = bg_model_t.T
-
-        #Run through spaxels and subtract low-order polynomial
-        for y_ind in tqdm(range(cube.shape[1])):
-            for x_ind in range(cube.shape[2]):
-                cube[:, y_ind, x_ind] -= bg_model
-                model_cube[:, y_ind, x_ind] += bg_model
+        #Subtract background model
+        cube[:, use_xy] -= bg_model
+        model_cube[:, use_xy] += bg_model
 
         if var is not None:
-            var_out = scale_variance(cube, var)
+            var_out, _ = scale_variance(cube, var)
 
     #Subtract layer-by-layer by fitting noise profile
     elif method == 'noisefit':
@@ -695,7 +979,7 @@ def bg_sub(inputfits, method='polyfit', poly_k=1, median_window=31, wmasks=None,
             model_cube[i][~mask_2d] = bg_model_1(wav_i)
 
         if var is not None:
-            var_out = scale_variance(cube, var)
+            var_out, _ = scale_variance(cube, var)
 
     #Subtract using simple layer-by-layer median value
     elif method == "median":
@@ -714,13 +998,131 @@ def bg_sub(inputfits, method='polyfit', poly_k=1, median_window=31, wmasks=None,
         cube -= model_cube
 
         if var is not None:
-            var_out = scale_variance(cube, var)
+            var_out, _ = scale_variance(cube, var)
 
     if var is None:
         return cube, model_cube
     return cube, model_cube, var_out
 
-def smooth_cube_wavelength(data, scale, ktype='gaussian', var=False):
+def _get_kernel1d(scale, ktype, var=False):
+    """Get the 1D kernel array for a smoothing scale, or None for unknown kernel types.
+
+    The 2D Gaussian and box kernels of astropy are the outer products of these,
+    so the same array is used for each axis of a separable 2D smoothing.
+    """
+    if ktype == 'box':
+        kernel = convolution.Box1DKernel(scale).array
+    elif ktype == 'gaussian':
+        kernel = convolution.Gaussian1DKernel(fwhm2sigma(scale)).array
+    else:
+        return None
+
+    return np.power(kernel, 2) if var else kernel
+
+def _convolve1d(data, kernel, axis, mode='reflect', output=None, fft_size=129):
+    """Convolve data along one axis with a symmetric, odd-sized 1D kernel.
+
+    Box kernels use running-sum (uniform) filters, kernels of fft_size or more
+    use FFT convolution and others use direct convolution. All give the same
+    result as scipy.ndimage.convolve1d.
+
+    Args:
+        data (numpy.ndarray): The input data.
+        kernel (numpy.ndarray): The 1D kernel.
+        axis (int): The axis to convolve along.
+        mode (str): How data is extended beyond its edges, 'reflect' or
+            'constant' (zeros).
+        output (numpy.ndarray): Array to write the result to, which may be data
+            itself. Default is a new array with the shape and type of data.
+        fft_size (int): Minimum kernel size for FFT convolution.
+
+    Returns:
+        numpy.ndarray: The convolved data.
+
+    """
+    if output is None:
+        output = np.empty_like(data)
+
+    size = kernel.size
+    norm = kernel[size // 2]
+
+    #Box of odd width: all values equal
+    if size > 1 and np.all(kernel == norm):
+        ndimage.uniform_filter1d(data, size, axis=axis, output=output, mode=mode)
+        output *= norm * size
+        return output
+
+    #Box of even width: half-weight end values, i.e. the sum of two box means
+    if size > 3 and np.all(kernel[1:-1] == norm) and kernel[0] == kernel[-1] == norm / 2:
+        tmp = ndimage.uniform_filter1d(data, size - 1, axis=axis, output=output.dtype,
+                                       mode=mode)
+        ndimage.uniform_filter1d(data, size - 1, axis=axis, output=output, mode=mode,
+                                 origin=-1)
+        output += tmp
+        output *= norm * (size - 1) / 2
+        return output
+
+    if size < fft_size:
+        return ndimage.convolve1d(data, kernel, axis=axis, output=output, mode=mode)
+
+    #Large kernels: extend data by the kernel radius, as ndimage does, then FFT
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (size // 2, size // 2)
+    pad_mode = 'symmetric' if mode == 'reflect' else mode
+    data_pad = np.pad(np.asarray(data, dtype=float), pad, mode=pad_mode)
+
+    shape = [1] * data.ndim
+    shape[axis] = size
+    output[...] = oaconvolve(data_pad, kernel.reshape(shape), mode='valid', axes=axis)
+    return output
+
+def _convolve_slabs(data, kernel, axes, mode='reflect', dtype=None, n_workers=1,
+                    max_size=2**22):
+    """Convolve data along several axes with a 1D kernel, in slabs along the first axis.
+
+    Each slab is read with a halo of the kernel radius along the first axis (if
+    it is convolved), so that the result matches convolving the full array.
+    Slabs are sized to hold ~max_size elements, can be distributed over a pool
+    of threads, and are written into a single preallocated output array.
+
+    Args:
+        data (numpy.ndarray): The input data.
+        kernel (numpy.ndarray): The 1D kernel.
+        axes (int iterable): The axes to convolve along.
+        mode (str): How data is extended beyond its edges, 'reflect' or
+            'constant' (zeros).
+        dtype (numpy.dtype): The output type. Default is the floating-point type of data.
+        n_workers (int): Number of threads to use.
+        max_size (int): Approximate number of elements per slab.
+
+    Returns:
+        numpy.ndarray: The convolved data.
+
+    """
+    if dtype is None:
+        dtype = np.result_type(data.dtype, np.float32)
+    output = np.empty(data.shape, dtype=dtype)
+
+    n_0 = data.shape[0]
+    halo = kernel.size // 2 if 0 in axes else 0
+    plane_size = max(1, data[0].size)
+    slab_size = max(1, min(max_size // plane_size, -(-n_0 // n_workers)))
+
+    def convolve_slab(start):
+        stop = min(start + slab_size, n_0)
+        lo, hi = max(start - halo, 0), min(stop + halo, n_0)
+        slab = np.empty((hi - lo,) + data.shape[1:], dtype=output.dtype)
+        for i, axis in enumerate(axes):
+            _convolve1d(data[lo:hi] if i == 0 else slab, kernel, axis, mode=mode,
+                        output=slab)
+        output[start:stop] = slab[start - lo:stop - lo]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(convolve_slab, range(0, n_0, slab_size)))
+
+    return output
+
+def smooth_cube_wavelength(data, scale, ktype='gaussian', var=False, n_workers=1):
     """Smooth 3D data spatially by a specified 2D kernel.
 
     Args:
@@ -730,33 +1132,20 @@ def smooth_cube_wavelength(data, scale, ktype='gaussian', var=False):
             For a box kernel, this is the width of the box.
         ktype (str): The kernel type ('gaussian' or 'box')
         var (bool): Set to TRUE when smoothing variance data.
+        n_workers (int): Number of threads over which to distribute wavelength slabs.
 
     Returns:
         numpy.ndarray: The smoothed data cube.
 
     """
-    #Make copy - do not modify input cube directly
-    data_copy = data.copy()
-
-
-    if ktype == 'box':
-        kernel = convolution.Box1DKernel(scale)
-    elif ktype == 'gaussian':
-        sigma = fwhm2sigma(scale)
-        kernel = convolution.Gaussian1DKernel(sigma)
-    else:
+    kernel = _get_kernel1d(scale, ktype, var=var)
+    if kernel is None:
         err = "No kernel type '%s' for wavelength smoothing" % (ktype)
         raise ValueError(err)
 
-    kernel = np.array([[kernel.array]]).T
-
-    if var:
-        kernel = np.power(kernel, 2)
-
-    data_copy = sc_ndi_convolve(data, kernel)
-    return data_copy
+    return _convolve_slabs(data, kernel, [0], n_workers=n_workers)
 
-def smooth_cube_spatial(data, scale, ktype='gaussian', var=False):
+def smooth_cube_spatial(data, scale, ktype='gaussian', var=False, n_workers=1):
     """Smooth 3D data spatially by a specified 2D kernel.
 
     Args:
@@ -766,34 +1155,22 @@ def smooth_cube_spatial(data, scale, ktype='gaussian', var=False):
             For a box kernel, this is the width of the box.
         ktype (str): The kernel type ('gaussian' or 'box')
         var (bool): Set to TRUE when smoothing variance data.
+        n_workers (int): Number of threads over which to distribute wavelength slabs.
 
     Returns:
         numpy.ndarray: The smoothed data cube.
 
     """
-    #Make copy - do not modify input cube directly
-    data_copy = data.copy()
-
-
-    if ktype == 'box':
-        kernel = convolution.Box2DKernel(scale)
-    elif ktype == 'gaussian':
-        sigma = fwhm2sigma(scale)
-        kernel = convolution.Gaussian2DKernel(sigma)
-    else:
+    kernel = _get_kernel1d(scale, ktype, var=var)
+    if kernel is None:
         err = "No kernel type '%s' for spatial smoothing" % (ktype)
         raise ValueError(err)
 
-    kernel = np.array([kernel.array])
-
-    if var:
-        kernel = np.power(kernel, 2)
-
-    data_copy = sc_ndi_convolve(data, kernel)
-    return data_copy
+    #The 2D kernel is separable, so smooth along y then x
+    return _convolve_slabs(data, kernel, [1, 2], n_workers=n_workers)
 
 
-def smooth_nd(data, scale, axes=None, ktype='gaussian', var=False):
+def smooth_nd(data, scale, axes=None, ktype='gaussian', var=False, n_workers=1):
     """Smooth along all/any axes of a data cube with a box or gaussian kernel.
 
     Args:
@@ -804,14 +1181,13 @@ def smooth_nd(data, scale, axes=None, ktype='gaussian', var=False):
         axes (int tuple): The axes to smooth along. Default is all input axes.
         ktype (str): The kernel type ('gaussian' or 'box')
         var (bool): Set to TRUE when smoothing variance data.
+        n_workers (int): Number of threads over which to distribute slabs of the
+            first axis.
 
     Returns:
         numpy.ndarray: The smoothed data cube.
 
     """
-    #Make copy - do not modify input cube directly
-    data_copy = data.copy()
-
     if axes is None:
         axes = range(len(data.shape))
 
@@ -825,43 +1201,23 @@ def smooth_nd(data, scale, axes=None, ktype='gaussian', var=False):
     if ndims < 1 or ndims > 3:
         raise ValueError("smooth_nd only works for 1-3 dimensional data.")
 
-    #Smooth subset of axes for 1D or 3D data
-    if ndims in [1, 3]:
-
-        if ktype == 'box':
-            kernel = convolution.Box1DKernel(scale)
-        elif ktype == 'gaussian':
-            sigma = fwhm2sigma(scale)
-            kernel = convolution.Gaussian1DKernel(sigma)
-        else:
-            err = "No kernel type '%s' for %iD smoothing" % (ktype, naxes)
-            raise ValueError(err)
-
-        kernel = np.power(np.array(kernel), 2) if var else np.array(kernel)
-
-        for axis_i in axes:
-            data_copy = np.apply_along_axis(
-                lambda m: np.convolve(m, kernel, mode='same'),
-                axis=axis_i,
-                arr=data_copy.copy()
-            )
-
-        return data_copy
-
-    #Otherwise - data must be 2D
-    if ktype == 'box':
-        kernel = convolution.Box2DKernel(scale)
-    elif ktype == 'gaussian':
-        sigma = fwhm2sigma(scale)
-        kernel = convolution.Gaussian2DKernel(sigma)
-    else:
+    kernel = _get_kernel1d(scale, ktype, var=var)
+    if kernel is None:
         err = "No kernel type '%s' for %iD smoothing" % (ktype, naxes)
         raise ValueError(err)
 
-    kernel = np.power(np.array(kernel), 2) if var else np.array(kernel)
-    data_copy = convolution.convolve(data_copy, kernel)
+    #Smooth subset of axes for 1D or 3D data, with zeros beyond the edges
+    if ndims in [1, 3]:
+        return _convolve_slabs(data, kernel, axes, mode='constant', dtype=float,
+                               n_workers=n_workers)
 
-    return data_copy
+    #Otherwise - data must be 2D. Normalized kernel, with NaNs interpolated over
+    if np.any(np.isnan(data)):
+        kernel = np.outer(kernel, kernel)
+        return convolution.convolve(data, kernel / kernel.sum())
+
+    return _convolve_slabs(data, kernel / kernel.sum(), [0, 1], mode='constant',
+                           dtype=float, n_workers=n_workers)
 
 def obj2binary(obj_mask, obj_id):
     """Get a binary mask of specific objects in a labelled object mask.
@@ -887,8 +1243,208 @@ def obj2binary(obj_mask, obj_id):
         raise TypeError("obj_id must be an integer or list of integers.")
     return bin_cube
 
+def _select_regions(areas, int_totals, var_totals, header, nmin=10, snr_int=None):
+    """Select segmented regions by size and, optionally, integrated SNR.
+
+    Args:
+        areas (numpy.ndarray): The size of each region, in voxels.
+        int_totals (numpy.ndarray): The summed intensity of each region.
+        var_totals (numpy.ndarray): The summed variance of each region.
+        header (astropy.io.fits.Header): The cube header, used to scale variance
+            for covariance if it contains covariance parameters.
+        nmin (int): The minimum region size, in voxels.
+        snr_int (float): Integrated SNR threshold. If None, regions are selected
+            by size only.
+
+    Returns:
+        numpy.ndarray: Boolean array which is True for selected regions.
+
+    """
+    detected_regs = areas > nmin
+    if snr_int is None:
+        return detected_regs
+
+    var_totals = np.array(var_totals, dtype=float)
+
+    #Scale for covariance
+    if "COV_ALPH" in header:
+        alpha = header["COV_ALPH"]
+        norm = header["COV_NORM"]
+        thresh = header["COV_THRE"]
+
+        large = areas > thresh
+        beta = norm * (1 + alpha * np.log(thresh))
+
+        var_totals[large] *= (beta**2)
+        var_totals[~large] *= (norm * (1 + alpha * np.log(areas[~large])))**2
+
+    snr_totals = int_totals / np.sqrt(var_totals)
+    return detected_regs & (snr_totals >= snr_int)
+
+def _get_touching_labels(labels0, labels1):
+    """Get pairs of labels which touch across two adjacent layers of a label cube.
+
+    Voxels touch if they are neighbours with full connectivity, i.e. including
+    diagonal neighbours, as used by skimage.measure.label.
+
+    Args:
+        labels0 (numpy.ndarray): The 2D labels of the first layer.
+        labels1 (numpy.ndarray): The 2D labels of the second layer.
+
+    Returns:
+        numpy.ndarray: Unique pairs of touching labels, shape (N, 2).
+
+    """
+    n_y, n_x = labels0.shape
+    pairs = []
+    for d_y in (-1, 0, 1):
+        for d_x in (-1, 0, 1):
+            lab0 = labels0[max(-d_y, 0):n_y - max(d_y, 0), max(-d_x, 0):n_x - max(d_x, 0)]
+            lab1 = labels1[max(d_y, 0):n_y - max(-d_y, 0), max(d_x, 0):n_x - max(-d_x, 0)]
+            touch = (lab0 > 0) & (lab1 > 0)
+            pairs.append(np.stack([lab0[touch], lab1[touch]], axis=1))
+
+    return np.unique(np.concatenate(pairs), axis=0)
+
+def _merge_labels(n_labels, pairs):
+    """Merge pairs of labels with a union-find structure.
+
+    Args:
+        n_labels (int): The number of labels, which run from 1 to n_labels.
+        pairs (numpy.ndarray): Pairs of labels to merge, shape (N, 2).
+
+    Returns:
+        numpy.ndarray: The root of each label (including 0), which is the lowest
+            label it is connected to.
+
+    """
+    parents = np.arange(n_labels + 1)
+
+    def find_root(label):
+        while parents[label] != label:
+            parents[label] = parents[parents[label]]
+            label = parents[label]
+        return label
+
+    for label0, label1 in pairs:
+        root0, root1 = find_root(label0), find_root(label1)
+        if root0 != root1:
+            parents[max(root0, root1)] = min(root0, root1)
+
+    #Point every label directly at its root
+    roots = parents[parents]
+    while np.any(roots != parents):
+        parents, roots = roots, roots[roots]
+
+    return roots
+
+def _get_label_dtype(n_labels):
+    """Get the integer type for an object mask with the given number of labels.
+
+    Object masks use 32-bit labels unless there are too many objects for them,
+    so that the output type does not depend on how the cube was segmented.
+    """
+    if n_labels > np.iinfo(np.int32).max:
+        return np.int64
+    return np.int32
+
+def _segment_slabs(data, var, use_mask, header, snrmin=3, nmin=10, pad=0, fill_holes=False,
+                   snr_int=None, slab_size=100):
+    """Segment a cube in wavelength slabs, merging regions across slab boundaries.
+
+    Slabs are read from the input arrays (which may be memory-mapped),
+    thresholded and labelled one at a time. Regions which touch across slab
+    boundaries are merged with a union-find structure and their properties are
+    summed over slabs, giving the same object mask as segmenting the whole cube
+    at once, while holding only one slab of data besides the output mask,
+    which uses 32-bit labels unless more are needed.
+
+    Args:
+        data (numpy.ndarray): The input data.
+        var (numpy.ndarray): The input variance.
+        use_mask (numpy.ndarray): Boolean mask of wavelength layers to segment.
+        header (astropy.io.fits.Header): The cube header.
+        snrmin (float): The minimum SNR for detection
+        nmin (int): The minimum 3D object size, in voxels.
+        pad (int): Number of pixels on xy axes to ignore.
+        fill_holes (bool): Set to TRUE to auto-fill holes in 3D objects.
+        snr_int (float): Integrated SNR threshold.
+        slab_size (int): Number of wavelength layers per slab.
+
+    Returns:
+        numpy.ndarray: An object mask with labelled regions (see _get_label_dtype)
+
+    """
+    n_z = data.shape[0]
+    slabs = [(z_0, min(z_0 + slab_size, n_z)) for z_0 in range(0, n_z, slab_size)]
+
+    #Closing can change voxels up to two layers from the edge of a slab
+    halo = 2 if fill_holes else 0
+
+    #Label slabs with consecutive labels, and get region properties per slab
+    #32-bit labels, unless there are too many regions for them
+    obj_mask = np.zeros(data.shape, dtype=np.int32)
+    areas, int_totals, var_totals, pairs = [], [], [], []
+    n_reg = 0
+    for z_0, z_1 in slabs:
+        z_lo, z_hi = max(z_0 - halo, 0), min(z_1 + halo, n_z)
+
+        slab_data = np.array(data[z_lo:z_hi])
+        slab_var = np.asarray(var[z_lo:z_hi])
+
+        #Apply XY padding
+        slab_data.T[pad:-pad, pad:-pad] = 0
+
+        snr = slab_data / np.sqrt(slab_var)
+        snr[~use_mask[z_lo:z_hi]] = snrmin - 1
+        det = (snr >= snrmin)
+
+        #Repair objects if requested
+        if fill_holes:
+            det = morphology.binary_closing(det)
+
+        inner = slice(z_0 - z_lo, z_1 - z_lo)
+        reg, n_slab = measure.label(det[inner], return_num=True)
+        reg_flat = reg.ravel()
+        for totals, weights in [(areas, None), (int_totals, slab_data), (var_totals, slab_var)]:
+            weights = None if weights is None else weights[inner].ravel()
+            totals.append(np.bincount(reg_flat, weights=weights, minlength=n_slab + 1)[1:])
+
+        if n_reg + n_slab > np.iinfo(obj_mask.dtype).max:
+            obj_mask = obj_mask.astype(np.int64)
+
+        reg[reg > 0] += n_reg
+        obj_mask[z_0:z_1] = reg
+        n_reg += n_slab
+
+        if z_0 > 0:
+            pairs.append(_get_touching_labels(obj_mask[z_0 - 1], obj_mask[z_0]))
+
+    #Merge regions across slabs. Roots are the lowest label of each region,
+    #so they are in the same order as labels of the whole cube
+    pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=int)
+    roots = _merge_labels(n_reg, pairs)
+    root_labels = np.flatnonzero(roots[1:] == np.arange(1, n_reg + 1)) + 1
+
+    areas, int_totals, var_totals = [
+        np.bincount(roots[1:], weights=np.concatenate(totals), minlength=n_reg + 1)[root_labels]
+        for totals in [areas, int_totals, var_totals]
+    ]
+    detected_regs = _select_regions(areas.astype(int), int_totals, var_totals, header,
+                                    nmin=nmin, snr_int=snr_int)
+
+    #Look-up table from slab label to new object label, starting at 1 and consecutive
+    obj_lut = np.zeros(n_reg + 1, dtype=obj_mask.dtype)
+    obj_lut[root_labels[detected_regs]] = np.arange(1, np.count_nonzero(detected_regs) + 1)
+    obj_lut = obj_lut[roots]
+    for z_0, z_1 in slabs:
+        obj_mask[z_0:z_1] = obj_lut[obj_mask[z_0:z_1]]
+
+    #Slab labels may have needed 64 bits even if the final object labels do not
+    return obj_mask.astype(_get_label_dtype(np.count_nonzero(detected_regs)), copy=False)
+
 def segment(fits_in, var, snrmin=3, includes=None, excludes=None, nmin=10, pad=0,
-            fill_holes=False, snr_int=None):
+            fill_holes=False, snr_int=None, slab_size=None):
     """Segment cube into 3D regions above a threshold.
 
     Args:
@@ -905,13 +1461,19 @@ def segment(fits_in, var, snrmin=3, includes=None, excludes=None, nmin=10, pad=0
         fill_holes (bool): Set to TRUE to auto-fill holes in 3D objects.
         snr_int (float): Integrated SNR threshold, use instead of nmin to base
             selection on the total SNR instead of size.
+        slab_size (int): Number of wavelength layers to segment at a time. Regions
+            are merged across slabs, giving the same result as segmenting the
+            whole cube at once while holding only one slab of the (possibly
+            memory-mapped) data and variance in memory. Default is to segment
+            the whole cube at once.
 
     Returns:
-        numpy.ndarray: An object mask with labelled regions
+        numpy.ndarray: An object mask with labelled regions, as 32-bit integers
+            unless there are too many objects for them.
 
     """
     hdu = utils.extract_hdu(fits_in)
-    data, header = hdu.data.copy(), hdu.header.copy()
+    header = hdu.header.copy()
 
     #Create wavelength masked based on input
     wav = coordinates.get_wav_axis(header)
@@ -933,60 +1495,46 @@ def segment(fits_in, var, snrmin=3, includes=None, excludes=None, nmin=10, pad=0
 
     use_mask = include_mask & ~exclude_mask
 
-    #Apply XY padding
-    data = data.T
-    data[pad:-pad, pad:-pad] = 0
-    data = data.T
-
-    snr = data / np.sqrt(var)
-    snr[~use_mask] = snrmin - 1
-    det = (snr >= snrmin)
-
-    #Repair objects if requested
-    if fill_holes:
-        det = morphology.binary_closing(det)
-
-    reg = measure.label(det)
-    reg_props = measure.regionprops_table(
-        reg,
-        intensity_image=data,
-        properties=['area', 'label', 'mean_intensity']
-    )
-    large_regs = reg_props['area'] > nmin
-    if snr_int is None:
-        detected_regs = large_regs
+    #Segment in wavelength slabs if requested, to limit memory use
+    if slab_size is not None:
+        obj_mask = _segment_slabs(hdu.data, var, use_mask, header, snrmin=snrmin, nmin=nmin,
+                                  pad=pad, fill_holes=fill_holes, snr_int=snr_int,
+                                  slab_size=slab_size)
 
     else:
-        var_props = measure.regionprops_table(
-            reg,
-            intensity_image=var,
-            properties=['area', 'label', 'mean_intensity']
-        )
-        int_totals = reg_props['area'] * reg_props['mean_intensity']
-        var_totals = var_props['area'] * var_props['mean_intensity']
+        data = hdu.data.copy()
 
-        #Scale for covariance
-        if "COV_ALPH" in header:
-            alpha = header["COV_ALPH"]
-            norm = header["COV_NORM"]
-            thresh = header["COV_THRE"]
+        #Apply XY padding
+        data = data.T
+        data[pad:-pad, pad:-pad] = 0
+        data = data.T
 
-            large = reg_props['area'] > thresh
-            beta = norm * (1 + alpha * np.log(thresh))
+        snr = data / np.sqrt(var)
+        snr[~use_mask] = snrmin - 1
+        det = (snr >= snrmin)
 
-            var_totals[large] *= (beta**2)
-            var_totals[~large] *= (norm * (1 + alpha * np.log(reg_props['area'][~large])))**2
+        #Repair objects if requested
+        if fill_holes:
+            det = morphology.binary_closing(det)
 
-            snr_totals = int_totals / np.sqrt(var_totals)
-            detected_regs = (snr_totals >= snr_int) & (large_regs)
+        reg, n_reg = measure.label(det, return_num=True)
 
-    #Convert selected regions into new mask
-    obj_mask = np.zeros_like(data, dtype=int)
-    for reg_label in reg_props['label'][detected_regs]:
-        obj_mask[reg == reg_label] = 1
+        #Region sizes and totals, indexed by label - 1
+        reg_flat = reg.ravel()
+        areas = np.bincount(reg_flat, minlength=n_reg + 1)[1:]
+        int_totals, var_totals = None, None
+        if snr_int is not None:
+            int_totals = np.bincount(reg_flat, weights=data.ravel(), minlength=n_reg + 1)[1:]
+            var_totals = np.bincount(reg_flat, weights=var.ravel(), minlength=n_reg + 1)[1:]
 
-    #Re-label objects so numbers start at 1 and are consecutive
-    obj_mask = measure.label(obj_mask)
+        detected_regs = _select_regions(areas, int_totals, var_totals, header, nmin=nmin,
+                                        snr_int=snr_int)
+
+        #Look-up table from region label to new object label, starting at 1 and consecutive
+        n_obj = np.count_nonzero(detected_regs)
+        obj_lut = np.zeros(n_reg + 1, dtype=_get_label_dtype(n_obj))
+        obj_lut[1:][detected_regs] = np.arange(1, n_obj + 1)
+        obj_mask = obj_lut[reg]
 
     header["BUNIT"] = "OBJ_ID"
     obj_out = utils.match_hdu_type(fits_in, obj_mask, header)
@@ -994,8 +1542,43 @@ def segment(fits_in, var, snrmin=3, includes=None, excludes=None, nmin=10, pad=0
     return obj_out
 
 
+def _get_bbox(mask):
+    """Get the bounding box of the True values in a mask.
+
+    Args:
+        mask (numpy.ndarray): The boolean mask.
+
+    Returns:
+        tuple: Slices of the bounding box along each axis, or None if the mask is empty.
+
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(i for i in range(mask.ndim) if i != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other))
+        if indices.size == 0:
+            return None
+        bbox.append(slice(indices[0], indices[-1] + 1))
+
+    return tuple(bbox)
+
+def _pad_bbox(bbox, pad, shape):
+    """Grow a bounding box by a margin along each axis, within the given shape."""
+    return tuple(
+        slice(max(b.start - p, 0), min(b.stop + p, n))
+        for b, p, n in zip(bbox, pad, shape)
+        )
+
+def _kernel_halo(scale, ktype):
+    """Get the half-width of the smoothing kernels used for a given scale."""
+    if ktype == 'box':
+        kernel = convolution.Box1DKernel(scale)
+    else:
+        kernel = convolution.Gaussian1DKernel(fwhm2sigma(scale))
+    return kernel.array.size // 2
+
 def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z_mode='gaussian',
-              xy_range=(2, 4), z_range=(2, 4), xy_step_min=0.5, z_step_min=0.5):
+              xy_range=(2, 4), z_range=(2, 4), xy_step_min=0.5, z_step_min=0.5, n_workers=1):
     """Perform adaptive kernel smoothing on data.
 
     3D Algorithm based on 2D algorithm by Ebeling, White & Ranjaran 2006. This 3D algorithm has not
@@ -1017,6 +1600,8 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
         z_range (float tuple): Range of smoothing scales to use for z-axis
         xy_step_min (float): Minimum step size to use for increasing spatial kernel size
         z_step_min (float): Minimum step size to use for increasing wavelength kernel size
+        n_workers (int): Number of threads over which to distribute the smoothing of
+            wavelength slabs.
 
     Returns:
          numpy.ndarray: adaptively smoothed intensity cube
@@ -1078,8 +1663,8 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
     mcube_det[mask_xy.T] = 1
     mcube_det = mcube_det.T
 
-    #Get number of pixels already mapped before starting
-    n_det_0 = np.sum(mcube_det)
+    #Count of voxels detected since starting
+    n_det = 0
 
     #Initialize spatial kernel variables
     xy_scale = r_min
@@ -1088,17 +1673,46 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
     #Initialize backup variables
     xy_scale_old = xy_scale
 
+    #Spatially smoothed cubes of the last xy_scale, and the region they cover
+    xy_cache = None
+
     ## MAIN LOOP
     utils.output("# %8s %8s %8s %8s %8s %8s %8s %8s %8s %8s\n" % ('z_scale', 'z_step', 'xy_scale', 'xy_step', 'n_pix', '% Done', 'min_snr', 'med_snr', 'max_snr', 'mid/med'))
 
     while xy_scale < r_max: #Run through wavelength bins
 
-        #Spatially smooth weighted intensity data and corresponding variance
-        icube_xy = smooth_cube_spatial(icube, xy_scale, ktype=xy_mode, var=False)
-        vcube_xy = smooth_cube_spatial(vcube, xy_scale, ktype=xy_mode, var=False)
+        #Spatially smooth weighted intensity data and corresponding variance, only
+        #around undetected voxels. Reuse the last result if nothing changed since.
+        if xy_cache is None or not np.isclose(xy_cache[0], xy_scale, rtol=1e-12, atol=0):
+
+            box_det = _get_bbox(mcube_det == 0)
+            if box_det is None:
+                break
 
-        #Smooth variance with kernel squared for error propagation
-        vcube_xy2 = smooth_cube_spatial(vcube, xy_scale, ktype=xy_mode, var=True)
+            #Halo of the spatial kernel, and of the largest wavelength kernel
+            xy_halo = _kernel_halo(xy_scale, xy_mode)
+            z_halo = _kernel_halo(z_max, z_mode)
+            box_in = _pad_bbox(box_det, (z_halo, xy_halo, xy_halo), icube.shape)
+            inner = (slice(None),) + tuple(
+                slice(b_d.start - b_i.start, b_d.stop - b_i.start)
+                for b_d, b_i in zip(box_det[1:], box_in[1:])
+                )
+
+            icube_xy = smooth_cube_spatial(icube[box_in], xy_scale, ktype=xy_mode,
+                                           n_workers=n_workers)[inner]
+            vcube_xy = smooth_cube_spatial(vcube[box_in], xy_scale, ktype=xy_mode,
+                                           n_workers=n_workers)[inner]
+
+            #Smooth variance with kernel squared for error propagation
+            vcube_xy2 = smooth_cube_spatial(vcube[box_in], xy_scale, ktype=xy_mode,
+                                            var=True, n_workers=n_workers)[inner]
+
+            #Region of the full cube covered by the spatially smoothed cubes
+            box_xy = (box_in[0],) + box_det[1:]
+            xy_cache = (xy_scale, box_xy, icube_xy, vcube_xy, vcube_xy2)
+
+        else:
+            _, box_xy, icube_xy, vcube_xy, vcube_xy2 = xy_cache
 
         #Initialize wavelelength kernel variables and backups
         z_scale, z_step = z_min, z_step_min
@@ -1117,12 +1731,28 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
             break_flag = False #Flag for breaking out of inner loop
             f_snr = -1 #Ratio of median detected SNR to midSNR
 
+            #Only smooth the remaining undetected voxels in wavelength
+            box_z = _get_bbox(mcube_det[box_xy] == 0)
+            if box_z is None:
+                utils.output("\n")
+                break
+            box_z_in = _pad_bbox(box_z, (_kernel_halo(z_scale, z_mode), 0, 0), icube_xy.shape)
+            inner = (slice(box_z[0].start - box_z_in[0].start,
+                           box_z[0].stop - box_z_in[0].start),)
+            box_cur = tuple(
+                slice(b_xy.start + b_z.start, b_xy.start + b_z.stop)
+                for b_xy, b_z in zip(box_xy, box_z)
+                )
+
             #Wavelength-smooth data, as above
-            icube_xyz = smooth_cube_wavelength(icube_xy, z_scale, ktype=z_mode)
-            vcube_xyz = smooth_cube_wavelength(vcube_xy, z_scale, ktype=z_mode)
+            icube_xyz = smooth_cube_wavelength(icube_xy[box_z_in], z_scale, ktype=z_mode,
+                                               n_workers=n_workers)[inner]
+            vcube_xyz = smooth_cube_wavelength(vcube_xy[box_z_in], z_scale, ktype=z_mode,
+                                               n_workers=n_workers)[inner]
 
             #Smooth variance with kernel squared for error propagation
-            vcube_xyz2 = smooth_cube_wavelength(vcube_xy2, z_scale, ktype=z_mode, var=True)
+            vcube_xyz2 = smooth_cube_wavelength(vcube_xy2[box_z_in], z_scale, ktype=z_mode,
+                                                var=True, n_workers=n_workers)[inner]
 
             #Replace non-positive values
             vcube_xyz2[vcube_xyz2 <= 0] = np.inf
@@ -1137,7 +1767,7 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
 
             #Calculate SNR and detections
             snr_xyz = (icube_xyz / np.sqrt(vcube_xyz2))
-            detections = (snr_xyz >= snr_min) & (mcube_det == 0)
+            detections = (snr_xyz >= snr_min) & (mcube_det[box_cur] == 0)
 
             #Get SNR values and total # of new detections
             snrs_det = snr_xyz[detections]
@@ -1296,17 +1926,21 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
                 icube_xyz_rec = icube_xyz / vcube_xyz
 
                 #Update relevant cubes
-                icube_det[detections] = icube_xyz_rec[detections]
-                vcube_det[detections] = 1 / vcube_xyz[detections]
-                mcube_det[detections] = 1
-                snr_det[detections] = snr_xyz[detections]
+                icube_det[box_cur][detections] = icube_xyz_rec[detections]
+                vcube_det[box_cur][detections] = 1 / vcube_xyz[detections]
+                mcube_det[box_cur][detections] = 1
+                snr_det[box_cur][detections] = snr_xyz[detections]
 
-                kr_vals[detections] = xy_scale
-                kw_vals[detections] = z_scale
+                kr_vals[box_cur][detections] = xy_scale
+                kw_vals[box_cur][detections] = z_scale
 
                 #Null the detected voxels to prevent further contributions
-                icube[detections] = 0
-                vcube[detections] = 0
+                icube[box_cur][detections] = 0
+                vcube[box_cur][detections] = 0
+                n_det += n_vox
+
+                #Spatially smoothed cubes are out of date for the next xy_scale
+                xy_cache = None
 
                 #Update outer-loop smoothing at current scale after subtraction
                 #icube_xy = extraction.smooth_cube_spatial(icube, xy_scale_old, ktype=xy_mode)
@@ -1314,7 +1948,7 @@ def asmooth3d(int_fits, var_fits, snr_min=5, snr_max=None, xy_mode='gaussian', z
                 #vcube_xy2 = extraction.smooth_cube_spatial(vcube, xy_scale_old, ktype=xy_mode, var=True)
 
             ## Output some diagnostics
-            perc = 100 * (np.sum(mcube_det) - n_det_0) / icube.size
+            perc = 100 * n_det / icube.size
             if n_vox > 0:
                 max_snr_det, min_snr_det = np.max(snrs_det), np.min(snrs_det)
                 if n_vox > 5:
@@ -1,7 +1,10 @@
 """Tools for model fitting, evaluation and comparison"""
 
+#Standard Imports
+import multiprocessing
+
 #Third-party Imports
-from scipy.optimize import differential_evolution
+from scipy.optimize import differential_evolution, least_squares, OptimizeResult
 #from scipy.special import voigt_profile
 import numpy as np
 
@@ -217,7 +220,12 @@ def moffat2d(params, xx, yy):
 ### MODEL FITTING
 ###
 def fit_model1d(model_func, model_bounds, x, y, *args, **kwargs):
-    """Wrapper for fitting a 1D model using SciPy's differential evolution.
+    """Fit a 1D model using bounded least-squares or differential evolution.
+
+    By default, the model is fit with SciPy's trust-region reflective
+    least-squares method, using an analytic Jacobian where one is available
+    (see JACOBIANS) and starting from a moment-based initial guess. Parameters
+    with equal lower and upper bounds are held fixed.
 
     Args:
         model_func (callable): The model function, of form f(parameters, x)
@@ -226,11 +234,30 @@ def fit_model1d(model_func, model_bounds, x, y, *args, **kwargs):
         x (numpy.array): Input x data (e.g. wavelength)
         y (numpy.array): Input y data to fit to (e.g. flux)
         y_var (numpy.array): (optional) The variance on the y-data, used to weight data.
+        method (str): (optional) The fitting method to use.
+            'lsq': Bounded least-squares from a moment-based guess (default).
+            'de': Global optimization using differential evolution.
+        fallback (bool): (optional) Set to TRUE to retry with differential
+            evolution if the least-squares fit fails.
+
     Returns:
-        scipy.optimize.OptimizeResult: The result of the fit.
+        scipy.optimize.OptimizeResult: The result of the fit. The attribute
+            'fun' is the residual sum of squares of the best-fit model.
 
     """
-    y_var = kwargs.get("y_var", 1)
+    y_var = kwargs.get("y_var")
+    if y_var is None:
+        y_var = 1
+    method = kwargs.get("method", "lsq")
+    fallback = kwargs.get("fallback", False)
+
+    if method == 'lsq':
+        fit = _fit_least_squares(model_func, model_bounds, (x,), y, y_var, args)
+        if fit.success or not fallback:
+            return fit
+    elif method != 'de':
+        raise ValueError("method must be 'lsq' or 'de'")
+
     fit = differential_evolution(
         rss_func1d,
         model_bounds,
@@ -256,9 +283,10 @@ def rss_func1d(model_params, model_func, x, y, y_var, *args):
     """
     return np.sum(np.power((y - model_func(model_params, x, *args)) / np.sqrt(y_var), 2))
 
-def fit_model2d(model_func, model_bounds, xx, yy, zz):
+def fit_model2d(model_func, model_bounds, xx, yy, zz, method='lsq', fallback=False):
     """Fit a Gaussian or Moffat PSF
 
+    See fit_model1d for a description of the fitting methods.
 
     Args:
         model_func (callable): The model function, of form f(parameters, x)
@@ -267,11 +295,21 @@ def fit_model2d(model_func, model_bounds, xx, yy, zz):
         xx (numpy.ndarray): Input x position meshgrid
         yy (numpy.ndarray): Input y position meshgrid
         zz (numpy.ndarray): Input data to fit to (e.g. flux)
+        method (str): The fitting method to use, 'lsq' (default) or 'de'.
+        fallback (bool): Set to TRUE to retry with differential evolution if
+            the least-squares fit fails.
 
     Returns:
         scipy.optimize.OptimizeResult: The result of the fit.
 
     """
+    if method == 'lsq':
+        fit = _fit_least_squares(model_func, model_bounds, (xx, yy), zz, 1, ())
+        if fit.success or not fallback:
+            return fit
+    elif method != 'de':
+        raise ValueError("method must be 'lsq' or 'de'")
+
     fit = differential_evolution(
         rss_func2d,
         model_bounds,
@@ -279,6 +317,220 @@ def fit_model2d(model_func, model_bounds, xx, yy, zz):
     )
     return fit
 
+def _fit_least_squares(model_func, model_bounds, inputs, data, data_var, args):
+    """Fit a model with bounded (trust-region reflective) least-squares.
+
+    Args:
+        model_func (callable): The model function, of form f(params, *inputs, *args)
+        model_bounds (list): List of (lower, upper) bounds on the model parameters.
+            Parameters with equal bounds are held fixed.
+        inputs (tuple): The model inputs, i.e. (x,) or (xx, yy).
+        data (numpy.ndarray): The data to fit to.
+        data_var (numpy.ndarray): Variance on the data, or 1 to ignore.
+        args (tuple): Additional arguments to the model function.
+
+    Returns:
+        scipy.optimize.OptimizeResult: The result of the fit.
+
+    """
+    bounds = np.array(model_bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    free = lower < upper
+
+    guess_func = _INITIAL_GUESSES.get(model_func, _guess_bounds)
+    params = np.clip(guess_func(bounds, *inputs, data, *args), lower, upper)
+
+    data = np.ravel(data)
+    weights = np.ravel(np.broadcast_to(1 / np.sqrt(data_var), np.shape(data)))
+
+    if not np.any(free):
+        model = np.ravel(model_func(params, *inputs, *args))
+        return OptimizeResult(x=params, fun=np.sum(((model - data) * weights)**2),
+                              success=True, status=0, nfev=1,
+                              message="All parameters are fixed.")
+
+    def get_params(params_free):
+        params_all = params.copy()
+        params_all[free] = params_free
+        return params_all
+
+    def residuals(params_free):
+        model = model_func(get_params(params_free), *inputs, *args)
+        return (np.ravel(model) - data) * weights
+
+    jac_func = JACOBIANS.get(model_func)
+    if jac_func is None:
+        jacobian = '2-point'
+    else:
+        def jacobian(params_free):
+            jac = jac_func(get_params(params_free), *inputs, *args)
+            return jac.reshape(-1, params.size)[:, free] * weights[:, None]
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        fit = least_squares(
+            residuals,
+            params[free],
+            jac=jacobian,
+            bounds=(lower[free], upper[free]),
+            method='trf'
+        )
+
+    return OptimizeResult(x=get_params(fit.x), fun=2 * fit.cost, success=fit.success,
+                          status=fit.status, nfev=fit.nfev, message=fit.message)
+
+def fit_model1d_batch(model_func, model_bounds, x, y, *args, y_var=None, max_iter=100,
+                      tol=1e-8, n_workers=1, fallback=False):
+    """Fit a 1D model to many spectra (or profiles) at once.
+
+    All spectra are fit simultaneously with vectorized, bounded Levenberg-Marquardt
+    (damped Gauss-Newton) iterations, starting from the same initial guesses as
+    fit_model1d (matched-filter guesses for gauss1d and doublet, moment-based
+    for moffat1d and the center of the bounds otherwise). Each spectrum has its
+    own damping factor and stops iterating once an accepted step has converged.
+    Any spectra which have not converged after max_iter iterations, or whose
+    damping grows without improving the fit, are then fit individually with
+    fit_model1d, over a pool of worker processes.
+
+    The model function must broadcast over a batch of parameters, i.e. accept
+    params with shape (N_params, N_spec, 1) as all of the built-in 1D models
+    (except covar_curve) do.
+
+    Args:
+        model_func (callable): The model function, of form f(parameters, x, *args)
+        model_bounds (list): List of tuples representing (lower, upper) bounds
+            on the model parameters, shared by all spectra. Parameters with
+            equal bounds are held fixed.
+        x (numpy.array): Input x data (e.g. wavelength), shape (N_x,)
+        y (numpy.ndarray): Input y data to fit to, shape (N_spec, N_x)
+        y_var (numpy.ndarray): The variance on the y-data, used to weight data.
+        max_iter (int): Maximum number of batched iterations.
+        tol (float): Relative tolerance on the change of the residual sum of
+            squares and of the parameters used to test for convergence.
+        n_workers (int): Number of processes used to fit non-converged spectra.
+        fallback (bool): Set to TRUE to retry non-converged spectra whose
+            individual least-squares fit fails with differential evolution.
+
+    Returns:
+        scipy.optimize.OptimizeResult: The result of the fits, where x has shape
+            (N_spec, N_params) and fun (the weighted residual sum of squares) and
+            success have shape (N_spec,).
+
+    """
+    bounds = np.array(model_bounds, dtype=float)
+    lower, upper = bounds[:, 0], bounds[:, 1]
+    free = lower < upper
+    n_spec, n_par = y.shape[0], bounds.shape[0]
+
+    y = np.asarray(y, dtype=float)
+    if y_var is None:
+        weights = np.ones_like(y)
+    else:
+        with np.errstate(divide='ignore'):
+            weights = np.broadcast_to(1 / np.sqrt(y_var), y.shape)
+
+    guess_func = _INITIAL_GUESSES.get(model_func, _guess_bounds)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        params = np.broadcast_to(guess_func(bounds, x, y, *args), (n_spec, n_par))
+    params = np.clip(np.nan_to_num(params), lower, upper)
+
+    jac_func = JACOBIANS.get(model_func)
+
+    def residuals(params_b, y_b, weights_b):
+        return (model_func(params_b.T[..., None], x, *args) - y_b) * weights_b
+
+    def jacobian(params_b, weights_b):
+        if jac_func is not None:
+            jac = jac_func(params_b.T[..., None], x, *args)[..., free]
+        else:
+            #Forward differences, for all spectra at once
+            model = model_func(params_b.T[..., None], x, *args)
+            jac = []
+            for k in np.flatnonzero(free):
+                step = 1.5e-8 * np.maximum(np.abs(params_b[:, k]), 1)
+                params_k = params_b.copy()
+                params_k[:, k] += step
+                jac.append((model_func(params_k.T[..., None], x, *args) - model) / step[:, None])
+            jac = np.stack(jac, axis=-1)
+        return jac * weights_b[..., None]
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        cost = np.sum(residuals(params, y, weights)**2, axis=1)
+        damping = np.full(n_spec, 1e-3)
+        success = np.zeros(n_spec, dtype=bool)
+        active = np.flatnonzero(np.isfinite(cost))
+
+        diag = np.arange(np.count_nonzero(free))
+        for _ in range(max_iter):
+            if active.size == 0:
+                break
+
+            params_a, y_a, weights_a = params[active], y[active], weights[active]
+            res = residuals(params_a, y_a, weights_a)
+            jac = jacobian(params_a, weights_a)
+
+            #Solve damped normal equations for each spectrum
+            hess = np.einsum('nip,niq->npq', jac, jac)
+            grad = np.einsum('nip,ni->np', jac, res)
+            hess_diag = hess[:, diag, diag]
+            hess[:, diag, diag] += damping[active, None] * np.maximum(
+                hess_diag, 1e-12 * hess_diag.max(axis=1, keepdims=True) + 1e-300
+                )
+            try:
+                step = np.linalg.solve(hess, -grad[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = -np.einsum('npq,nq->np', np.linalg.pinv(hess), grad)
+
+            #Take projected steps and keep those which improve the fit
+            params_new = params_a.copy()
+            params_new[:, free] = np.clip(params_a[:, free] + step, lower[free], upper[free])
+            cost_new = np.sum(residuals(params_new, y_a, weights_a)**2, axis=1)
+            better = cost_new < cost[active]
+
+            change = np.abs(params_new - params_a)[:, free]
+            small_step = better & np.all(change <= tol * (np.abs(params_a[:, free]) + tol), axis=1)
+            small_gain = better & (cost[active] - cost_new <= tol * cost[active])
+
+            params[active[better]] = params_new[better]
+            cost[active[better]] = cost_new[better]
+            damping[active] = np.where(better, damping[active] / 10, damping[active] * 10)
+
+            #Stop iterating spectra which have converged, or which are stuck
+            converged = small_step | small_gain
+            stuck = ~converged & (damping[active] > 1e12)
+            success[active[converged]] = True
+            active = active[~(converged | stuck)]
+
+    #Fit any remaining spectra individually
+    remaining = np.flatnonzero(~success)
+    if remaining.size > 0:
+        tasks = [(
+            model_func,
+            model_bounds,
+            x,
+            y[i],
+            args,
+            None if y_var is None else np.broadcast_to(y_var, y.shape)[i],
+            fallback
+            ) for i in remaining]
+
+        if n_workers > 1:
+            with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+                fits = pool.map(_fit_model1d_worker, tasks)
+        else:
+            fits = map(_fit_model1d_worker, tasks)
+
+        for i, fit in zip(remaining, fits):
+            params[i] = fit.x
+            cost[i] = fit.fun
+            success[i] = fit.success
+
+    return OptimizeResult(x=params, fun=cost, success=success)
+
+def _fit_model1d_worker(task):
+    """Fit a single spectrum for fit_model1d_batch, in a worker process."""
+    model_func, model_bounds, x, y, args, y_var, fallback = task
+    return fit_model1d(model_func, model_bounds, x, y, *args, y_var=y_var, fallback=fallback)
+
 def rss_func2d(model_params, model_func, xx, yy, zz):
     """Calculate the residual sum of squares for a 2D model + 2D data.
 
@@ -294,18 +546,20 @@ def rss_func2d(model_params, model_func, xx, yy, zz):
     """
     return np.sum(np.power((zz - model_func(model_params, xx, yy)), 2))
 
-def rss(data, model):
+def rss(data, model, axis=None):
     """Get the residual sum of squares for a model and data.
 
     Args:
         data (NumPy.ndarray): Observed data.
         model (NumPy.ndarray): Modeled data.
+        axis (int): Axis along which to sum, for a batch of models. Default
+            is to sum over all data.
 
     Returns:
         rss (float): Sum of square residuals for the input data and model.
 
     """
-    return np.sum(np.power(data-model, 2))
+    return np.sum(np.power(data-model, 2), axis=axis)
 
 ###
 ### MODEL COMPARISON
@@ -326,20 +580,22 @@ def bic(model, data, k):
     rss_in = rss(data, model)
     return n * np.log(rss_in / n) + k * np.log(n)
 
-def aic(model, data, k):
+def aic(model, data, k, axis=None):
     """Calculate the Akaike Information Criterion for a model.
 
     Args:
         model (NumPy.ndarray): The model data being evaluated
         data (NumPy.ndarray): The data being modeled
         k (int): The number of parameters in the model
+        axis (int): Axis along which to evaluate, for a batch of models. Default
+            is to evaluate over all data.
 
     Returns:
         aic (float): The Akaike Information Criterion
 
     """
-    n = model.size
-    rss_in = rss(data, model)
+    n = model.size if axis is None else model.shape[axis]
+    rss_in = rss(data, model, axis=axis)
     aic0 = 2 * k + n * np.log(rss_in)
 
     #Correction term for small samples
@@ -352,7 +608,8 @@ def bic_weights(bic_list):
     """Get weights representing relative likelihood of models based on BICs.
 
     Args:
-        bic_list (array-like): Array of BIC values for models.
+        bic_list (array-like): Array of BIC values for models. For a batch of
+            comparisons, the models are along the first axis.
 
     Returns:
         weights (Numpy.array): Array of relative likelihoods for models.
@@ -360,9 +617,9 @@ def bic_weights(bic_list):
     """
     if isinstance(bic_list, list):
         bic_list = np.array(bic_list)
-    delta_i = bic_list - np.min(bic_list) #Minimum AIC value of set
+    delta_i = bic_list - np.min(bic_list, axis=0) #Minimum AIC value of set
     rel_l = np.exp(-0.5 * delta_i) #Proportional likelihood term
-    weights = rel_l / np.sum(rel_l)
+    weights = rel_l / np.sum(rel_l, axis=0)
     return weights
 
 
@@ -418,3 +675,233 @@ def covar_curve(params, ksizes):
     res = norm * (1 + alpha * np.log(ksizes))
     res[ksizes > thresh] = norm * (1 + alpha * np.log(thresh))
     return res
+
+
+###
+### ANALYTIC JACOBIANS in form J(params, x), with parameters along the last axis
+###
+def doublet_jac(params, x, peaks):
+    """Jacobian of the doublet model with respect to its parameters."""
+    b_amp, b_cen, b_std, ratio = params
+    cen_scale = peaks[1] / peaks[0]
+    r_cen = b_cen * cen_scale
+    b_gauss = np.exp(-0.5 * (x - b_cen)**2 / b_std**2)
+    r_gauss = np.exp(-0.5 * (x - r_cen)**2 / b_std**2) / ratio
+    return np.stack([
+        b_gauss + r_gauss,
+        b_amp * (b_gauss * (x - b_cen) + r_gauss * (x - r_cen) * cen_scale) / b_std**2,
+        b_amp * (b_gauss * (x - b_cen)**2 + r_gauss * (x - r_cen)**2) / b_std**3,
+        -b_amp * r_gauss / ratio
+        ], axis=-1)
+
+def gauss1d_jac(params, x):
+    """Jacobian of the 1D Gaussian model with respect to its parameters."""
+    amp, mean, std = params
+    gauss = np.exp(-((x - mean)**2) / (2 * std**2))
+    return np.stack([
+        gauss,
+        amp * gauss * (x - mean) / std**2,
+        amp * gauss * (x - mean)**2 / std**3
+        ], axis=-1)
+
+def moffat1d_jac(params, x):
+    """Jacobian of the 1D Moffat model with respect to its parameters."""
+    amp, mean, alpha, gamma = params
+    base = 1 + ((x - mean) / gamma)**2
+    profile = np.power(base, -alpha)
+    slope = 2 * amp * alpha * profile / base
+    return np.stack([
+        profile,
+        slope * (x - mean) / gamma**2,
+        -amp * profile * np.log(base),
+        slope * (x - mean)**2 / gamma**3
+        ], axis=-1)
+
+def gauss2d_jac(params, xx, yy):
+    """Jacobian of the general 2D Gaussian model with respect to its parameters."""
+    I0, x0, y0, sig_x, sig_y, theta = params
+
+    t_rad = theta * np.pi / 180
+    cos2_t = np.cos(t_rad)**2
+    sin2_t = np.sin(t_rad)**2
+    sin_2t = np.sin(2 * t_rad)
+    two_sig2_x = 2 * sig_x**2
+    two_sig2_y = 2 * sig_y**2
+
+    a = cos2_t / two_sig2_x + sin2_t / two_sig2_y
+    b = sin_2t * (1 / two_sig2_x - 1 / two_sig2_y)
+    c = sin2_t / two_sig2_x + cos2_t / two_sig2_y
+
+    d_x, d_y = xx - x0, yy - y0
+    gauss = np.exp(-a * d_x**2 - b * d_x * d_y - c * d_y**2)
+    model = I0 * gauss
+
+    #Derivatives of the quadratic form with respect to sig_x, sig_y and theta
+    dq_sx = -(cos2_t * d_x**2 + sin_2t * d_x * d_y + sin2_t * d_y**2) / sig_x**3
+    dq_sy = -(sin2_t * d_x**2 - sin_2t * d_x * d_y + cos2_t * d_y**2) / sig_y**3
+    db_dt = 2 * np.cos(2 * t_rad) * (1 / two_sig2_x - 1 / two_sig2_y)
+    dq_t = (-b * d_x**2 + db_dt * d_x * d_y + b * d_y**2) * np.pi / 180
+
+    return np.stack([
+        gauss,
+        model * (2 * a * d_x + b * d_y),
+        model * (b * d_x + 2 * c * d_y),
+        -model * dq_sx,
+        -model * dq_sy,
+        -model * dq_t
+        ], axis=-1)
+
+def moffat2d_jac(params, xx, yy):
+    """Jacobian of the 2D Moffat model with respect to its parameters."""
+    I0, x0, y0, alpha, gamma = params
+    d_x, d_y = xx - x0, yy - y0
+    base = 1 + (d_x**2 + d_y**2) / gamma**2
+    profile = np.power(base, -alpha)
+    slope = 2 * I0 * alpha * profile / base
+    return np.stack([
+        profile,
+        slope * d_x / gamma**2,
+        slope * d_y / gamma**2,
+        -I0 * profile * np.log(base),
+        slope * (d_x**2 + d_y**2) / gamma**3
+        ], axis=-1)
+
+def covar_curve_jac(params, ksizes):
+    """Jacobian of the covariance curve model with respect to its parameters."""
+    alpha, norm, thresh = params
+    above = ksizes > thresh
+    log_k = np.log(np.where(above, thresh, ksizes))
+    return np.stack([
+        norm * log_k,
+        1 + alpha * log_k,
+        np.where(above, norm * alpha / thresh, 0)
+        ], axis=-1)
+
+JACOBIANS = {
+    doublet: doublet_jac,
+    gauss1d: gauss1d_jac,
+    moffat1d: moffat1d_jac,
+    gauss2d: gauss2d_jac,
+    moffat2d: moffat2d_jac,
+    covar_curve: covar_curve_jac
+}
+
+###
+### INITIAL GUESSES in form f(bounds, *inputs, data, *args)
+###
+def _guess_bounds(bounds, *_):
+    """Use the center of the bounds as an initial guess."""
+    return bounds.mean(axis=1)
+
+def _get_moments(x, y):
+    """Get the mean and variance of x along the last axis, weighted by the positive part of y."""
+    weights = np.clip(y, 0, None)
+    total = np.sum(weights, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(weights * x, axis=-1) / total
+        var = np.sum(weights * (x - mean[..., None])**2, axis=-1) / total
+    empty = ~(total > 0)
+    mean = np.where(empty, np.mean(x), mean)
+    var = np.where(empty, np.var(x), var)
+    return mean, var
+
+def _match_templates(model_func, params_grid, x, y, *args):
+    """Find the best-matching scaled template for a profile (or a batch of them).
+
+    Each template is the model evaluated with a set of parameters from the grid
+    and unit amplitude (the first parameter, in which the model must be
+    linear). The amplitude of each template is solved for by linear least
+    squares, and the template reducing the residuals the most is picked.
+
+    Args:
+        model_func (callable): The model function, of form f(parameters, x, *args)
+        params_grid (numpy.ndarray): Parameters of the templates, shape (N_t, N_params).
+        x (numpy.array): Input x data, shape (N_x,)
+        y (numpy.ndarray): Profile(s) to match, shape (..., N_x)
+
+    Returns:
+        numpy.ndarray: Best parameters for each profile, shape (..., N_params).
+
+    """
+    params_grid[:, 0] = 1
+    templates = model_func(params_grid.T[..., None], x, *args)
+    norms = np.sum(templates**2, axis=-1)
+    proj = np.dot(np.nan_to_num(y), templates.T)
+    score = np.where(proj > 0, proj**2 / norms, 0)
+    best = np.argmax(score, axis=-1)
+
+    params = params_grid[best]
+    params[..., 0] = np.take_along_axis(proj, best[..., None], axis=-1)[..., 0] / norms[best]
+    return params
+
+def _get_line_grid(bounds, x, cen_index=1, std_index=2, n_std=6):
+    """Get a grid of line parameters, with centers on x and log-spaced widths."""
+    centers = x[(x >= bounds[cen_index, 0]) & (x <= bounds[cen_index, 1])]
+    if centers.size == 0:
+        centers = bounds[cen_index].mean(keepdims=True)
+
+    std_min = max(bounds[std_index, 0], np.min(np.abs(np.diff(x))) / 2)
+    std_max = max(bounds[std_index, 1], std_min)
+    stds = np.geomspace(std_min, std_max, n_std)
+
+    grid = np.tile(bounds.mean(axis=1), (centers.size * stds.size, 1))
+    grid[:, cen_index] = np.repeat(centers, stds.size)
+    grid[:, std_index] = np.tile(stds, centers.size)
+    return grid
+
+def _guess_gauss1d(bounds, x, y):
+    """Matched-filter initial guess for a 1D Gaussian (or a batch of them)."""
+    return _match_templates(gauss1d, _get_line_grid(bounds, x), x, y)
+
+def _guess_doublet(bounds, x, y, peaks):
+    """Matched-filter initial guess for a doublet (or a batch of them)."""
+    return _match_templates(doublet, _get_line_grid(bounds, x), x, y, peaks)
+
+def _guess_moffat1d(bounds, x, y):
+    """Moment-based initial guess for a 1D Moffat profile (or a batch of them)."""
+    mean, var = _get_moments(x, y)
+    alpha = np.clip(2.5, *bounds[2])
+    gamma = sigma2fwhm(np.sqrt(var)) / (2 * np.sqrt(2**(1 / alpha) - 1))
+    return np.stack([np.max(y, axis=-1), mean, np.full_like(mean, alpha), gamma], axis=-1)
+
+def _guess_gauss2d(bounds, xx, yy, zz):
+    """Moment-based initial guess for a 2D Gaussian."""
+    x_mean, x_var = _get_moments(np.ravel(xx), np.ravel(zz))
+    y_mean, y_var = _get_moments(np.ravel(yy), np.ravel(zz))
+    return np.array([np.max(zz), x_mean, y_mean, np.sqrt(x_var), np.sqrt(y_var),
+                     bounds[5].mean()])
+
+def _guess_moffat2d(bounds, xx, yy, zz):
+    """Moment-based initial guess for a 2D Moffat profile."""
+    x_mean, x_var = _get_moments(np.ravel(xx), np.ravel(zz))
+    y_mean, y_var = _get_moments(np.ravel(yy), np.ravel(zz))
+    alpha = np.clip(2.5, *bounds[3])
+    sigma = np.sqrt((x_var + y_var) / 2)
+    gamma = sigma2fwhm(sigma) / (2 * np.sqrt(2**(1 / alpha) - 1))
+    return np.array([np.max(zz), x_mean, y_mean, alpha, gamma])
+
+def _guess_covar_curve(bounds, ksizes, ratios):
+    """Initial guess for the covariance curve, by linear fits over thresholds."""
+    best_guess, best_rss = _guess_bounds(bounds), np.inf
+    thresholds = np.unique(np.clip(ksizes, *bounds[2]))
+    for thresh in thresholds:
+
+        #For a fixed threshold, the model is linear in norm and norm * alpha
+        design = np.stack([np.ones_like(ksizes), np.log(np.minimum(ksizes, thresh))], axis=-1)
+        coeffs, _, _, _ = np.linalg.lstsq(design, ratios, rcond=None)
+        rss_t = np.sum((design.dot(coeffs) - ratios)**2)
+
+        if rss_t < best_rss and coeffs[0] != 0:
+            best_rss = rss_t
+            best_guess = np.array([coeffs[1] / coeffs[0], coeffs[0], thresh])
+
+    return best_guess
+
+_INITIAL_GUESSES = {
+    doublet: _guess_doublet,
+    gauss1d: _guess_gauss1d,
+    moffat1d: _guess_moffat1d,
+    gauss2d: _guess_gauss2d,
+    moffat2d: _guess_moffat2d,
+    covar_curve: _guess_covar_curve
+}
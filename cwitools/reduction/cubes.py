@@ -1,17 +1,23 @@
 """Reduction tools directly related to cube cropping, coadding, etc."""
 
 #Standard Imports
+import glob
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
 import warnings
+import zipfile
 
 #Third-party Imports
 from astropy.io import fits
 from astropy.stats import sigma_clip
 from astropy.wcs import WCS
 from astropy.wcs.utils import proj_plane_pixel_scales
-from scipy.stats import sigmaclip, mode
+from scipy.stats import mode
+from scipy import sparse
 from skimage import morphology
-from shapely.geometry import box as shapely_box
-from shapely.geometry import Polygon as shapely_polygon
 from tqdm import tqdm
 
 import matplotlib.gridspec as gridspec
@@ -26,6 +32,8 @@ def slice_corr(fits_in, mask_reg=None):
 
     Args:
         fits_in (HDU or HDUList): The input data cube
+        mask_reg (str): Path to a DS9 region file of sources to exclude when
+            measuring the median of each slice.
 
     Returns:
         HDU or HDUList (same type as input): The corrected data
@@ -50,121 +58,202 @@ def slice_corr(fits_in, mask_reg=None):
     else:
         msk2d = np.zeros_like(data[0], dtype=bool)
 
-    #Run through slices
-    for slice_i in tqdm(range(nslices)):
-
-        if slice_axis == 1:
-            slice_2d = data[:, slice_i, :]
-            msk1d = msk2d[slice_i, :]
-        elif slice_axis == 2:
-            slice_2d = data[:, :, slice_i]
-            msk1d = msk2d[:, slice_i]
-        else:
-            raise RuntimeError("Shortest axis should be slice axis.")
-
-        #Shrink mask if needed to obtain measurement
-        while np.count_nonzero(msk1d == 0) < 5:
-            msk1d = morphology.binary_erosion(msk1d)
-
+    #Get views of data as [slice, wavelength, in-slice pixel] and mask as [slice, in-slice pixel]
+    if slice_axis == 1:
+        slices = np.transpose(data, (1, 0, 2))
+        msk_slices = msk2d.copy()
+    elif slice_axis == 2:
+        slices = np.transpose(data, (2, 0, 1))
+        msk_slices = msk2d.T.copy()
+    else:
+        raise RuntimeError("Shortest axis should be slice axis.")
 
-        #Run through wavelength layers
-        for layer_j in range(slice_2d.shape[0]):
+    #Shrink mask if needed to obtain measurement
+    for slice_i in range(nslices):
+        while np.count_nonzero(msk_slices[slice_i] == 0) < 5:
+            msk_slices[slice_i] = morphology.binary_erosion(msk_slices[slice_i])
 
-            xprof = slice_2d[layer_j].copy()[msk1d == 0]
+    #Get the 2-sigma clipped median of every wavelength layer of every slice at once
+    medians = utils.sigmaclip_median(slices, (msk_slices == 0)[:, None, :], low=2, high=2)
 
-            _, lower, upper = sigmaclip(xprof, low=2, high=2)
-            usex = (xprof >= lower) & (xprof <= upper)
+    #Subtract (the slices array is a view of data)
+    slices -= medians[:, :, None]
 
-            slice_2d[layer_j] -= np.median(xprof[usex])
+    return utils.match_hdu_type(fits_in, data, hdu.header)
 
-    return fits_in
 
+def _block_reduce(data, bin_xy, bin_z, mode='sum', max_size=2**24):
+    """Reduce a cube over (bin_z, bin_xy, bin_xy) blocks, dropping remainders.
 
-def rebin(inputfits, bin_xy=1, bin_z=1, vardata=False):
-    """Re-bin a data cube along the spatial (x,y) and wavelength (z) axes.
+    The cube is processed in slabs of whole output layers, so at most
+    ~max_size input elements are copied at a time, even if the input is a
+    memory-mapped array.
 
     Args:
-        inputfits (astropy FITS object): Input FITS to be rebinned.
-        bin_xy (int): Integer binning factor for x,y axes. (Def: 1)
-        bin_z (int): Integer binning factor for z axis. (Def: 1)
-        vardata (bool): Set to TRUE if rebinning variance data. (Def: True)
-        fileExt (str): File extension for output (Def: .binned.fits)
+        data (numpy.ndarray): Input 3D data (z, y, x).
+        bin_xy (int): Binning factor for the x, y axes.
+        bin_z (int): Binning factor for the z axis.
+        mode (str): 'sum' to add the values in each block, or 'or' to combine
+            them with a logical (bool) or bitwise (int) OR. Floating-point masks
+            are OR-ed as integers if all of their values are whole numbers,
+            and otherwise set to 1 wherever any value in the block is non-zero.
+            The result keeps the input type.
+        max_size (int): Approximate number of input elements per slab.
 
     Returns:
-        astropy.io.fits.HDUList: The re-binned cube with updated WCS/Header.
+        numpy.ndarray: The block-reduced data.
 
     """
-
-
-    #Extract useful structures
-    data = inputfits[0].data.copy()
-    head = inputfits[0].header.copy()
-
-    #Get dimensions & Wav array
     n_z, n_y, n_x = data.shape
+    shape_new = (n_z // bin_z, n_y // bin_xy, n_x // bin_xy)
 
-    #Get new sizes
-    n_z_new = int(n_z // bin_z)
-    n_y_new = int(n_y // bin_xy)
-    n_x_new = int(n_x // bin_xy)
+    if mode == 'sum':
+        out = np.zeros(shape_new)
+    elif mode == 'or':
+        out = np.zeros(shape_new, dtype=data.dtype)
+    else:
+        raise ValueError("mode must be 'sum' or 'or'")
 
-    #Perform wavelenght-binning first, if bin provided
-    if bin_z > 1:
+    zchunk = max(1, max_size // (bin_z * n_y * n_x))
+    z_slabs = [
+        (z_0, min(z_0 + zchunk, shape_new[0])) for z_0 in range(0, shape_new[0], zchunk)
+    ]
 
-        #Create new data cube shape
-        data_zbinned = np.zeros((n_z_new, n_y, n_x))
+    #Decide once for the whole cube how to OR a floating-point mask
+    float_bitwise = False
+    if mode == 'or' and not (data.dtype == bool or np.issubdtype(data.dtype, np.integer)):
+        float_bitwise = all(
+            np.all(np.mod(data[z_0 * bin_z:z_1 * bin_z], 1) == 0) for z_0, z_1 in z_slabs
+        )
 
-        #Run through all input wavelength layers and add to new cube
-        for z_i in range(n_z_new * bin_z):
-            data_zbinned[int(z_i // bin_z)] += data[z_i]
+    for z_0, z_1 in z_slabs:
 
-        #Normalize so that units remain as "erg/s/cm2/A"
-        if vardata:
-            data_zbinned /= bin_z**2
+        slab = np.reshape(
+            data[z_0 * bin_z:z_1 * bin_z, :shape_new[1] * bin_xy, :shape_new[2] * bin_xy],
+            (z_1 - z_0, bin_z, shape_new[1], bin_xy, shape_new[2], bin_xy)
+            )
+
+        if mode == 'sum':
+            out[z_0:z_1] = np.sum(slab, axis=(1, 3, 5), dtype=float)
+        elif data.dtype == bool:
+            out[z_0:z_1] = np.any(slab, axis=(1, 3, 5))
+        elif np.issubdtype(data.dtype, np.integer):
+            out[z_0:z_1] = np.bitwise_or.reduce(slab, axis=(1, 3, 5))
+        elif float_bitwise:
+            out[z_0:z_1] = np.bitwise_or.reduce(slab.astype(np.int64), axis=(1, 3, 5))
         else:
-            data_zbinned /= bin_z
+            out[z_0:z_1] = np.any(slab, axis=(1, 3, 5))
 
-        #Update central reference and pixel scales
-        head["CD3_3"] *= bin_z
-        head["CRPIX3"] /= bin_z
+    return out
 
-    else:
+def _rebin_header(header, bin_xy, bin_z):
+    """Get the header of a cube re-binned by rebin().
 
-        data_zbinned = data
+    Args:
+        header (astropy.io.fits.Header): Header of the input cube.
+        bin_xy (int): Integer binning factor for x,y axes.
+        bin_z (int): Integer binning factor for z axis.
 
-    #Perform spatial binning next
-    if bin_xy > 1:
+    Returns:
+        astropy.io.fits.Header: A copy of the header with updated WCS.
 
-        #Get new shape
-        data_xybinned = np.zeros((n_z_new, n_y_new, n_x_new))
+    """
+    head = header.copy()
 
-        #Run through spatial pixels and add
-        for y_i in range(n_y_new * bin_xy):
-            for x_i in range(n_x_new * bin_xy):
-                xindex = int(x_i // bin_xy)
-                yindex = int(y_i // bin_xy)
-                data_xybinned[:, yindex, xindex] += data_zbinned[:, y_i, x_i]
+    if bin_z > 1:
 
-        #
-        # No normalization needed for binning spatial pixels.
-        # Units remain as 'per pixel' but pixel size changes.
-        #
+        #Update central reference and pixel scales
+        head["CD3_3"] *= bin_z
+        head["CRPIX3"] = (head["CRPIX3"] - 0.5) / bin_z + 0.5
+
+    if bin_xy > 1:
 
         #Update reference pixel
-        head["CRPIX1"] /= float(bin_xy)
-        head["CRPIX2"] /= float(bin_xy)
+        head["CRPIX1"] = (head["CRPIX1"] - 0.5) / bin_xy + 0.5
+        head["CRPIX2"] = (head["CRPIX2"] - 0.5) / bin_xy + 0.5
 
         #Update pixel scales
         for key in ["CD1_1", "CD1_2", "CD2_1", "CD2_2"]:
             head[key] *= bin_xy
 
-    else: data_xybinned = data_zbinned
+    return head
+
+def rebin(inputfits, bin_xy=1, bin_z=1, vardata=False):
+    """Re-bin a data cube along the spatial (x,y) and wavelength (z) axes.
+
+    Trailing pixels or layers which do not fill a complete bin are dropped.
+    Binning is done in slabs of output layers, so memory-mapped input is never
+    copied in full.
+
+    Args:
+        inputfits (astropy FITS object): Input FITS to be rebinned.
+        bin_xy (int): Integer binning factor for x,y axes. (Def: 1)
+        bin_z (int): Integer binning factor for z axis. (Def: 1)
+        vardata (bool): Set to TRUE if rebinning variance data. (Def: True)
+
+    Returns:
+        astropy.io.fits.HDUList: The re-binned cube with updated WCS/Header.
 
-    binned_fits = fits.HDUList([fits.PrimaryHDU(data_xybinned)])
+    """
+
+    #Extract useful structures
+    hdu = utils.extract_hdu(inputfits)
+    head = _rebin_header(hdu.header, bin_xy, bin_z)
+
+    #
+    # No normalization needed for binning spatial pixels.
+    # Units remain as 'per pixel' but pixel size changes.
+    # Normalize z-binning so that units remain as "erg/s/cm2/A"
+    #
+    data_binned = _block_reduce(hdu.data, bin_xy, bin_z)
+    if vardata:
+        data_binned /= bin_z**2
+    else:
+        data_binned /= bin_z
+
+    binned_fits = fits.HDUList([fits.PrimaryHDU(data_binned)])
     binned_fits[0].header = head
 
     return binned_fits
 
+def rebin_all(inputfits, bin_xy=1, bin_z=1, vardata=False, var=None, mask=None):
+    """Re-bin a data cube together with its variance and mask cubes.
+
+    The data and variance are binned as in rebin(). Binned mask values are the
+    OR of all input mask values in each bin.
+
+    Args:
+        inputfits (astropy FITS object): Input FITS to be rebinned.
+        bin_xy (int): Integer binning factor for x,y axes. (Def: 1)
+        bin_z (int): Integer binning factor for z axis. (Def: 1)
+        vardata (bool): Set to TRUE if rebinning variance data. (Def: False)
+        var (astropy FITS object): Variance cube to rebin alongside the data.
+        mask (astropy FITS object): Mask cube to rebin alongside the data.
+
+    Returns:
+        astropy.io.fits.HDUList: The re-binned data cube.
+        astropy.io.fits.HDUList: The re-binned variance, or None if not given.
+        astropy.io.fits.HDUList: The re-binned mask, or None if not given.
+
+    """
+    binned_fits = rebin(inputfits, bin_xy=bin_xy, bin_z=bin_z, vardata=vardata)
+    head = binned_fits[0].header
+    binned_var, binned_mask = None, None
+
+    if var is not None:
+        var_hdu = utils.extract_hdu(var)
+        var_binned = _block_reduce(var_hdu.data, bin_xy, bin_z) / bin_z**2
+        binned_var = fits.HDUList([fits.PrimaryHDU(var_binned)])
+        binned_var[0].header = head.copy()
+
+    if mask is not None:
+        mask_hdu = utils.extract_hdu(mask)
+        mask_binned = _block_reduce(mask_hdu.data, bin_xy, bin_z, mode='or')
+        binned_mask = fits.HDUList([fits.PrimaryHDU(mask_binned)])
+        binned_mask[0].header = head.copy()
+
+    return binned_fits, binned_var, binned_mask
+
 def get_crop_params(fits_in, plot=False):
     """Get optimized crop parameters for crop().
 
@@ -373,8 +462,545 @@ def crop(fits_in, wcrop=None, ycrop=None, xcrop=None):
 
     return trimmed_hdu
 
+def _clip_polygons(verts, nverts, axis, limit, sign):
+    """Clip a batch of convex polygons against an axis-aligned half-plane.
+
+    This is a vectorized form of one Sutherland-Hodgman clipping step. Each
+    polygon is stored as a fixed-size vertex buffer with a vertex count.
+
+    Args:
+        verts (numpy.ndarray): Polygon vertices, shape (N, M, 2).
+        nverts (numpy.ndarray): Number of valid vertices in each polygon, (N,).
+        axis (int): The coordinate to clip on (0 for x, 1 for y).
+        limit (float or numpy.ndarray): Position of the clipping line, either
+            shared by all polygons or given per polygon as shape (N,).
+        sign (int): +1 to keep coordinates >= limit, -1 to keep <= limit.
+
+    Returns:
+        numpy.ndarray: Clipped polygon vertices, shape (N, M', 2).
+        numpy.ndarray: Number of valid vertices in each clipped polygon.
+
+    """
+    n_max = verts.shape[1]
+    index = np.arange(n_max)[None, :]
+    valid = index < nverts[:, None]
+
+    #Vertex at the other end of each edge, wrapping around at nverts
+    nxt_index = (index + 1) % np.maximum(nverts[:, None], 1)
+    nxt = np.take_along_axis(verts, nxt_index[:, :, None], axis=1)
+
+    #Signed distance of each vertex inside the half-plane
+    limit = np.reshape(limit, (-1, 1))
+    d_cur = sign * (verts[:, :, axis] - limit)
+    d_nxt = sign * (nxt[:, :, axis] - limit)
+    in_cur = d_cur >= 0
+    in_nxt = d_nxt >= 0
+
+    #Intersection of each edge with the clipping line
+    crosses = (in_cur != in_nxt) & valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(crosses, d_cur / (d_cur - d_nxt), 0)
+    cross = verts + frac[:, :, None] * (nxt - verts)
+
+    #Each edge emits [intersection, next vertex], subject to the keep flags
+    out = np.stack([cross, nxt], axis=2).reshape(len(verts), 2 * n_max, 2)
+    keep = np.stack([crosses, in_nxt & valid], axis=2).reshape(len(verts), 2 * n_max)
+
+    #Compact kept vertices to the front of each buffer, preserving order
+    order = np.argsort(~keep, axis=1, kind='stable')
+    out = np.take_along_axis(out, order[:, :, None], axis=1)
+    nverts_out = np.count_nonzero(keep, axis=1)
+
+    return out[:, :max(np.max(nverts_out, initial=0), 1)], nverts_out
+
+def _polygon_areas(verts, nverts):
+    """Get the areas of a batch of polygons using the shoelace formula.
+
+    Args:
+        verts (numpy.ndarray): Polygon vertices, shape (N, M, 2).
+        nverts (numpy.ndarray): Number of valid vertices in each polygon, (N,).
+
+    Returns:
+        numpy.ndarray: The (unsigned) area of each polygon.
+
+    """
+    index = np.arange(verts.shape[1])[None, :]
+    valid = index < nverts[:, None]
+    nxt_index = (index + 1) % np.maximum(nverts[:, None], 1)
+    nxt = np.take_along_axis(verts, nxt_index[:, :, None], axis=1)
+    cross = verts[:, :, 0] * nxt[:, :, 1] - nxt[:, :, 0] * verts[:, :, 1]
+    return 0.5 * np.abs(np.sum(cross * valid, axis=1))
+
+def get_drizzle_weights(header_in, header_out, drizzle=0, chunk_size=20000):
+    """Get the fractional overlap of input pixels with the pixels of a new grid.
+
+    The corners of every input pixel are transformed to the output frame in a
+    single batched WCS call, and the resulting quadrilaterals are clipped
+    against each output pixel they touch to measure the overlapping area.
+
+    Args:
+        header_in (astropy.io.fits.Header): 2D header of the input frame.
+        header_out (astropy.io.fits.Header): 2D header of the output frame.
+        drizzle (float): The drizzle factor to use, as a fraction of pixels size.
+        chunk_size (int): Number of input pixels to clip at a time. This only
+            limits the memory used by intermediate arrays.
+
+    Returns:
+        scipy.sparse.csr_matrix: A matrix of shape (N_out, N_in), where N_in and
+            N_out are the number of pixels in the flattened input/output images.
+            Each element is the fraction of the input pixel's projected area
+            which overlaps the output pixel.
+
+    """
+    wcs_in = WCS(header_in)
+    wcs_out = WCS(header_out)
+    ny_in, nx_in = header_in["NAXIS2"], header_in["NAXIS1"]
+    ny_out, nx_out = header_out["NAXIS2"], header_out["NAXIS1"]
+
+    drz_f = (1 - drizzle) / 2.0 # Fractional margin to add for drizzle factor
+
+    # Define BL, TL, TR, BR corners of every input pixel as coordinates
+    y_in, x_in = np.mgrid[:ny_in, :nx_in]
+    x_in, y_in = x_in.ravel(), y_in.ravel()
+    x_lo, x_hi = x_in - 0.5 + drz_f, x_in + 0.5 - drz_f
+    y_lo, y_hi = y_in - 0.5 + drz_f, y_in + 0.5 - drz_f
+    pix_verts = np.stack([
+        np.stack([x_lo, y_lo], axis=1),
+        np.stack([x_lo, y_hi], axis=1),
+        np.stack([x_hi, y_hi], axis=1),
+        np.stack([x_hi, y_lo], axis=1)
+        ], axis=1)
+
+    # Input pixel --> RA/DEC --> coadd pixel, for all vertices at once
+    pix_verts_radec = wcs_in.all_pix2world(pix_verts.reshape(-1, 2), 0)
+    pix_verts_out = wcs_out.all_world2pix(pix_verts_radec, 0).reshape(-1, 4, 2)
+    pix_areas = _polygon_areas(pix_verts_out, np.full(len(pix_verts_out), 4))
+
+    # Range of output pixels (centered on integers) touched by each projection
+    bounds_lo = np.floor(np.min(pix_verts_out, axis=1) + 0.5).astype(int)
+    bounds_hi = np.floor(np.max(pix_verts_out, axis=1) + 0.5).astype(int)
+    span = np.max(bounds_hi - bounds_lo, axis=0) + 1
+    offsets = np.stack(np.meshgrid(np.arange(span[0]), np.arange(span[1])), axis=-1)
+    offsets = offsets.reshape(-1, 2)
+
+    rows, cols, vals = [], [], []
+    for start in range(0, len(pix_verts_out), chunk_size):
+
+        chunk = slice(start, start + chunk_size)
+
+        # Candidate (input, output) pixel pairs within each projection's bounds
+        cand = bounds_lo[chunk, None, :] + offsets[None, :, :]
+        in_bounds = np.all(cand <= bounds_hi[chunk, None, :], axis=2)
+        in_bounds &= (cand[:, :, 0] >= 0) & (cand[:, :, 0] < nx_out)
+        in_bounds &= (cand[:, :, 1] >= 0) & (cand[:, :, 1] < ny_out)
+        in_index, cand_index = np.nonzero(in_bounds)
+        in_index += start
+        x_c = cand[in_index - start, cand_index, 0]
+        y_c = cand[in_index - start, cand_index, 1]
+
+        # Clip each projected pixel against the box of each candidate pixel
+        verts = pix_verts_out[in_index]
+        nverts = np.full(len(verts), 4)
+        for axis, center in [(0, x_c), (1, y_c)]:
+            verts, nverts = _clip_polygons(verts, nverts, axis, center - 0.5, 1)
+            verts, nverts = _clip_polygons(verts, nverts, axis, center + 0.5, -1)
+
+        # Convert to fraction of total input pixel area
+        overlap = _polygon_areas(verts, nverts) / pix_areas[in_index]
+
+        use = overlap > 0
+        rows.append(y_c[use] * nx_out + x_c[use])
+        cols.append(in_index[use])
+        vals.append(overlap[use])
+
+    weights = sparse.coo_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(ny_out * nx_out, ny_in * nx_in)
+        )
+
+    return weights.tocsr()
+
+def _get_weights_cache_key(header_in, header_out, drizzle):
+    """Get a hash identifying the drizzle weights for a pair of 2D headers."""
+    hasher = hashlib.sha1()
+    for header in [header_in, header_out]:
+        hasher.update(WCS(header).to_header_string(relax=True).encode())
+        hasher.update(("%i %i" % (header["NAXIS1"], header["NAXIS2"])).encode())
+    hasher.update(repr(float(drizzle)).encode())
+    return hasher.hexdigest()
+
+def _prune_weights_cache(cache_dir, cache_size):
+    """Delete least-recently used weight files until cache fits in cache_size (MB)."""
+    cache_files = sorted(
+        glob.glob(os.path.join(cache_dir, "*.weights.npz")),
+        key=os.path.getmtime,
+        reverse=True
+        )
+    total_size = 0
+    for cache_file in cache_files:
+        try:
+            total_size += os.path.getsize(cache_file)
+            if total_size > cache_size * 1e6:
+                os.remove(cache_file)
+        except FileNotFoundError:
+            continue #Already removed by another process
+
+def get_drizzle_weights_cached(header_in, header_out, drizzle=0, cache_dir=None,
+                               cache_size=500):
+    """Get drizzle weights, re-using a copy saved on disk if available.
+
+    Weights are saved in cache_dir under a hash of the input and output 2D WCS
+    and the drizzle factor, so they are only recomputed if the geometry of the
+    coadd changes. Each use of a cached file marks it as recently used, and the
+    least recently used files are deleted when the cache exceeds cache_size.
+    Files are written atomically, and unreadable files are treated as missing.
+
+    Args:
+        header_in (astropy.io.fits.Header): 2D header of the input frame.
+        header_out (astropy.io.fits.Header): 2D header of the output frame.
+        drizzle (float): The drizzle factor to use, as a fraction of pixels size.
+        cache_dir (str): Directory in which to save the weights. If None, the
+            weights are computed without caching.
+        cache_size (float): Maximum total size of the cache, in MB.
+
+    Returns:
+        scipy.sparse.csr_matrix: The weights, as returned by get_drizzle_weights.
+
+    """
+    if cache_dir is None:
+        return get_drizzle_weights(header_in, header_out, drizzle=drizzle)
+
+    cache_key = _get_weights_cache_key(header_in, header_out, drizzle)
+    cache_file = os.path.join(cache_dir, cache_key + ".weights.npz")
+
+    if os.path.isfile(cache_file):
+        try:
+            weights = sparse.load_npz(cache_file).tocsr()
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            warnings.warn("Could not read cached weights %s. Recomputing." % cache_file)
+        else:
+            try:
+                os.utime(cache_file) #Mark as recently used
+            except FileNotFoundError:
+                pass #Pruned by another process after reading
+            return weights
+
+    weights = get_drizzle_weights(header_in, header_out, drizzle=drizzle)
+
+    #Write to a temporary file first so readers never see a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(tmp_fd, "wb") as tmp_obj:
+            sparse.save_npz(tmp_obj, weights)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    _prune_weights_cache(cache_dir, cache_size)
+
+    return weights
+
+def _get_layer_reader(hdu, reopen=False):
+    """Get an object which can be sliced along z to read layers of an HDU.
+
+    For HDUs backed by a FITS file, this reads only the requested layers from
+    disk. For HDUs created in memory, it is simply the data array. Set reopen
+    to True to read through a new file handle, which is needed in worker
+    processes that would otherwise share the parent's file position. The new
+    HDUList is returned so the caller can close it, or None if none was opened.
+    """
+    fileinfo = hdu.fileinfo()
+    if fileinfo is None:
+        return hdu.data, None
+    if reopen:
+        hdulist = fits.open(fileinfo["file"].name)
+        for hdu_j in hdulist:
+            if hdu_j.fileinfo()["hdrLoc"] == fileinfo["hdrLoc"]:
+                return hdu_j.section, hdulist
+        hdulist.close()
+    return hdu.section, None
+
+def _read_aligned_layers(reader, int_shift, subpx_shift, z_0, z_1, mask_reader=None, power=1,
+                         dtype=np.float64):
+    """Read a block of layers from a cube, shifted onto the coadd wavelength axis.
+
+    Layer z of the output takes (subpx_shift * L[z - int_shift]) +
+    ((1 - subpx_shift) * L[z - int_shift - 1]) from the input layers L, which
+    is equivalent to padding the cube, rolling it by int_shift and convolving
+    it with the kernel [subpx_shift, 1 - subpx_shift].
+
+    Args:
+        reader (array-like): Sliceable input cube (see _get_layer_reader).
+        int_shift (int): Integer part of the wavelength shift, in layers.
+        subpx_shift (float): Sub-pixel part of the wavelength shift.
+        z_0 (int): First layer of the output block, on the coadd axis.
+        z_1 (int): Last layer (exclusive) of the output block.
+        mask_reader (array-like): Sliceable pipeline mask cube. Masked input
+            voxels are replaced with NaN before shifting.
+        power (int): Power to raise the kernel to. Use 2 for variance.
+        dtype (numpy.dtype): Data type of the output.
+
+    Returns:
+        numpy.ndarray: The aligned layers, shape (z_1 - z_0, N_y, N_x).
+
+    """
+    n_z = reader.shape[0]
+    out = np.zeros((z_1 - z_0,) + tuple(reader.shape[1:]), dtype=dtype)
+
+    # Input layers that contribute to this block
+    in_0 = min(max(z_0 - int_shift - 1, 0), n_z)
+    in_1 = min(max(z_1 - int_shift, 0), n_z)
+    if in_1 <= in_0:
+        return out
+
+    # Layers are only copied if they need to be masked
+    layers = np.asarray(reader[in_0:in_1])
+    if mask_reader is not None:
+        msk_data = mask_reader[in_0:in_1]
+        layers = np.where((msk_data == 1) & (msk_data >= 8), np.nan, layers)
+
+    # Write each term of the kernel directly into the strided output block
+    kernel = (subpx_shift**power, (1 - subpx_shift)**power)
+    for weight, lag in zip(kernel, (0, 1)):
+        i_0 = max(z_0 - int_shift - lag, in_0)
+        i_1 = min(z_1 - int_shift - lag, in_1)
+        if i_1 <= i_0:
+            continue
+        o_0 = i_0 + int_shift + lag - z_0
+        out_view = out[o_0:o_0 + i_1 - i_0]
+        if lag == 0:
+            np.multiply(layers[i_0 - in_0:i_1 - in_0], weight, out=out_view, casting='unsafe')
+        else:
+            out_view += weight * layers[i_0 - in_0:i_1 - in_0]
+
+    return out
+
+def _get_scratch_array(shape):
+    """Create a zero-filled array backed by a temporary file on disk."""
+    return np.memmap(tempfile.TemporaryFile(), dtype=float, mode='w+', shape=shape)
+
+def _get_stream_zblock(mem_limit, n_in, n_out):
+    """Get the number of layers per block which keeps coadd working memory within mem_limit (MB)."""
+    #Approximate number of float64 arrays of each size alive while projecting a block
+    bytes_per_layer = 8 * (6 * n_in + 8 * n_out)
+    zblock = int(mem_limit * 1e6 // bytes_per_layer)
+    if zblock < 1:
+        warnings.warn("mem_limit is too small to process one wavelength layer at a time.")
+        zblock = 1
+    return zblock
+
+def _coadd_frame_block(weights, int_blk, var_blk, wavmask_blk, px_area_ratio, px_thresh,
+                       t_exp):
+    """Project a block of wavelength layers from one input frame onto the coadd.
+
+    Args:
+        weights (scipy.sparse.csr_matrix): Overlap weights (N_out, N_in), from
+            get_drizzle_weights.
+        int_blk (numpy.ndarray): Intensity layers, shape (N_z, N_in).
+        var_blk (numpy.ndarray): Variance layers, shape (N_z, N_in), or None.
+        wavmask_blk (numpy.ndarray): Boolean wavelength coverage mask, (N_z,).
+        px_area_ratio (float): Ratio of coadd pixel area to input pixel area.
+        px_thresh (float): Minimum fractional pixel overlap.
+        t_exp (float): Exposure time of the input frame.
+
+    Returns:
+        numpy.ndarray: Exposure-weighted data to add to the coadd, (N_z, N_out).
+        numpy.ndarray: Exposure time to add to the coadd, (N_z, N_out).
+        numpy.ndarray: Weighted variance to add to the coadd, or None.
+
+    """
+    # Good voxels are those with valid data within the input wavelength range
+    good = wavmask_blk[:, None] & ~np.isnan(int_blk)
+    int_blk = np.where(good, int_blk, 0)
+
+    # Each projection is a single sparse matrix product over the block
+    build_frame = (weights @ int_blk.T).T
+    fract_frame = (weights @ good.T.astype(float)).T
+
+    if var_blk is not None:
+        var_blk = np.where(good, var_blk, 0)
+        var_build_frame = (weights.multiply(weights) @ var_blk.T).T
+
+    # Max value in fract_frame should be px_area_ratio; it's the biggest
+    # fraction of an input pixel that can add to one coadd pixel
+    # We want to use this map now to create a flat_frame - where the
+    # values represent a covering fraction for each pixel
+    # i.e. 0.1 = 10% of pixel area covered by input frames
+    flat_frame = fract_frame / px_area_ratio
+
+    #Replace zero-values with inf values to avoid division by zero
+    flat_frame[flat_frame == 0] = np.inf
+
+    # Perform flat field correction for pixels that are not fully covered
+    build_frame /= flat_frame
+
+    # Zero any pixels below user-set pixel threshold. Set flat value to inf
+    build_frame[flat_frame < px_thresh] = 0
+
+    # Propagate variance on previous two steps
+    if var_blk is not None:
+        var_build_frame /= (flat_frame)**2
+        var_build_frame[flat_frame < px_thresh] = np.inf
+
+    #Replace values < px_thresh with inf also
+    flat_frame[flat_frame < px_thresh] = np.inf
+
+    exp_add = t_exp * (flat_frame < np.inf)
+    data_add = t_exp * build_frame
+    var_add = None if var_blk is None else (t_exp**2) * var_build_frame
+
+    return data_add, exp_add, var_add
+
+def _coadd_frame(int_hdu, var_hdu, mask_hdu, coadd_hdr2d, wavmask, int_shift, subpx_shift,
+                 t_exp, in_counts, px_area_ratio, px_thresh, drizzle, zblock, stream, cache_dir,
+                 cache_size, dtype=np.float64, canvases=None, reopen=False):
+    """Project one input frame onto the coadd grid.
+
+    This is the per-exposure unit of work in coadd(). If canvases are given,
+    the frame is added to them directly. Otherwise, the contribution of the
+    frame is returned as partial canvases covering only its footprint.
+
+    Args:
+        int_hdu (HDU): The intensity cube.
+        var_hdu (HDU): The variance cube, or None.
+        mask_hdu (HDU): The pipeline mask cube, or None. Only used if streaming.
+        coadd_hdr2d (astropy.io.fits.Header): 2D header of the coadd frame.
+        wavmask (numpy.ndarray): Boolean wavelength coverage on the coadd axis.
+        int_shift (int): Integer wavelength shift onto the coadd axis.
+        subpx_shift (float): Sub-pixel wavelength shift onto the coadd axis.
+        t_exp (float): Exposure time of the frame.
+        in_counts (bool): Whether the input must be divided by t_exp.
+            Only used if streaming.
+        px_area_ratio (float): Ratio of coadd pixel area to input pixel area.
+        px_thresh (float): Minimum fractional pixel overlap.
+        drizzle (float): The drizzle factor.
+        zblock (int): Number of wavelength layers to project at a time.
+        stream (bool): If True, read the input from disk block by block and
+            align it to the coadd wavelength axis on the fly.
+        cache_dir (str): Drizzle weights cache directory (or None).
+        cache_size (float): Maximum size of the weights cache, in MB.
+        dtype (numpy.dtype): Data type of streamed input blocks.
+        canvases (tuple): Coadd data, exposure and variance (or None) cubes
+            to add this frame to.
+        reopen (bool): Read streamed inputs through new file handles.
+
+    Returns:
+        tuple: The bounds (y_0, y_1, x_0, x_1) of the frame's footprint on the
+            coadd grid.
+        tuple: Data, exposure and variance (or None) partial canvases for the
+            footprint, or None if canvases were given.
+
+    """
+    usevar = var_hdu is not None
+    n_z = len(wavmask)
+    nx_out = coadd_hdr2d["NAXIS1"]
+
+    # Fractional overlap of each input pixel with each coadd pixel
+    weights = get_drizzle_weights_cached(
+        coordinates.get_header2d(int_hdu.header),
+        coadd_hdr2d,
+        drizzle=drizzle,
+        cache_dir=cache_dir,
+        cache_size=cache_size
+        )
+
+    # Restrict the projection to the bounding box of the frame's footprint
+    y_fp, x_fp = np.divmod(np.nonzero(np.diff(weights.indptr))[0], nx_out)
+    if len(y_fp) == 0:
+        y_fp, x_fp = np.zeros(1, dtype=int), np.zeros(1, dtype=int)
+    y_0, y_1, x_0, x_1 = y_fp.min(), y_fp.max() + 1, x_fp.min(), x_fp.max() + 1
+    fp_shape = (y_1 - y_0, x_1 - x_0)
+    fp_rows = np.add.outer(np.arange(y_0, y_1) * nx_out, np.arange(x_0, x_1)).ravel()
+    weights = weights[fp_rows]
+
+    if canvases is None:
+        partials = (
+            np.zeros((n_z,) + fp_shape),
+            np.zeros((n_z,) + fp_shape),
+            np.zeros((n_z,) + fp_shape) if usevar else None
+            )
+        coadd_data, coadd_exp, coadd_var = partials
+        y_off, x_off = 0, 0
+    else:
+        partials = None
+        coadd_data, coadd_exp, coadd_var = canvases
+        y_off, x_off = y_0, x_0
+
+    int_reader, msk_reader, var_reader = None, None, None
+    opened = [] #File handles opened to read this frame
+    if stream:
+        int_reader, int_file = _get_layer_reader(int_hdu, reopen=reopen)
+        opened.append(int_file)
+        if mask_hdu is not None:
+            msk_reader, msk_file = _get_layer_reader(mask_hdu, reopen=reopen)
+            opened.append(msk_file)
+        if usevar:
+            var_reader, var_file = _get_layer_reader(var_hdu, reopen=reopen)
+            opened.append(var_file)
+
+    try:
+        # Project the frame onto the coadd grid one block of wavelengths at a time
+        for z_0 in range(0, n_z, zblock):
+
+            z_1 = min(z_0 + zblock, n_z)
+
+            if stream:
+                int_blk = _read_aligned_layers(
+                    int_reader, int_shift, subpx_shift, z_0, z_1,
+                    mask_reader=msk_reader, dtype=dtype
+                    )
+                int_blk = int_blk.reshape(z_1 - z_0, -1)
+                if usevar:
+                    var_blk = _read_aligned_layers(
+                        var_reader, int_shift, subpx_shift, z_0, z_1, power=2, dtype=dtype
+                        )
+                    var_blk = var_blk.reshape(z_1 - z_0, -1)
+                if in_counts:
+                    int_blk /= t_exp
+                    if usevar:
+                        var_blk /= t_exp**2 #Propagate error
+            else:
+                int_blk = int_hdu.data[z_0:z_1].reshape(z_1 - z_0, -1)
+                if usevar:
+                    var_blk = var_hdu.data[z_0:z_1].reshape(z_1 - z_0, -1)
+
+            data_add, exp_add, var_add = _coadd_frame_block(
+                weights,
+                int_blk,
+                var_blk if usevar else None,
+                wavmask[z_0:z_1],
+                px_area_ratio,
+                px_thresh,
+                t_exp
+                )
+
+            # Add weight * data and exposure time to coadd
+            canvas_blk = (slice(z_0, z_1), slice(y_off, y_off + fp_shape[0]),
+                          slice(x_off, x_off + fp_shape[1]))
+            coadd_data[canvas_blk] += data_add.reshape((z_1 - z_0,) + fp_shape)
+            coadd_exp[canvas_blk] += exp_add.reshape((z_1 - z_0,) + fp_shape)
+
+            # Propagate error on the above step
+            if usevar:
+                coadd_var[canvas_blk] += var_add.reshape((z_1 - z_0,) + fp_shape)
+    finally:
+        for hdulist in opened:
+            if hdulist is not None:
+                hdulist.close()
+
+    return (y_0, y_1, x_0, x_1), partials
+
+# Frame inputs shared with forked worker processes by coadd()
+_COADD_FRAMES = []
+
+def _coadd_frame_worker(index):
+    """Project one of the frames in _COADD_FRAMES in a worker process."""
+    return _coadd_frame(**_COADD_FRAMES[index], reopen=True)
+
 def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, px_thresh=0.5,
-          exp_thresh=0.1, verbose=False, plot=0, drizzle=0):
+          exp_thresh=0.1, verbose=False, plot=0, drizzle=0, zblock=64, cache_dir=None,
+          cache_size=500, mem_limit=None, n_workers=1, float32=False):
     """Coadd a list of fits images into a master frame.
 
     Args:
@@ -406,7 +1032,31 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
         verbose (bool): Show progress bars and file names.
         drizzle (float): The drizzle factor to use, as a fraction of pixels size.
             E.g. 0.2 will shrink input pixels by 20%.
-
+        zblock (int): Number of wavelength layers to project onto the coadd
+            grid at a time. Larger blocks are faster but use more memory.
+            Ignored if mem_limit is set.
+        cache_dir (str): Directory in which to cache the pixel overlap weights
+            between runs. The weights only depend on the WCS of the input and
+            output frames and the drizzle factor, so re-running with different
+            masks, variance or thresholds can re-use them. Default: None (no
+            caching).
+        cache_size (float): Maximum size of the weights cache, in MB. The least
+            recently used weights are deleted first. Default: 500.
+        mem_limit (float): Memory budget in MB. If set, the coadd is streamed:
+            inputs are read from disk one wavelength block at a time, the block
+            size is chosen to fit within this budget, and the coadd canvases
+            are kept in temporary files on disk (see Python's tempfile module
+            for how to choose their location). Inputs given as file paths are
+            never fully loaded into memory. Default: None (in-memory coadd).
+        n_workers (int): Number of processes to use. Each exposure is projected
+            by one worker into a partial canvas covering its footprint, and
+            the partial canvases are summed into the coadd as they complete.
+            Workers are forked, so this requires a platform with 'fork'
+            support. If mem_limit is also set, it is shared between workers,
+            but each worker also holds one footprint-sized partial canvas.
+            Default: 1.
+        float32 (bool): Store the wavelength-aligned input cubes in single
+            precision, halving their memory use. Default: False.
 
     Returns:
         astropy.io.fits.HDUList: The stacked FITS with new header.
@@ -483,9 +1133,10 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
     # At this point, we have lists of 3D HDUs for int [msk, var]
     # Next step - prepare some data structures and variables
 
-    drz_f = (1 - drizzle) / 2.0 # Fractional margin to add for drizzle factor
     usemask = mask_hdus is not None #Boolean flags for masking and error prop
     usevar = var_hdus is not None
+    stream = mem_limit is not None
+    dtype = np.float32 if float32 else np.float64
 
     footprints = [] #On-sky footprints of each HDU
     wav0s = [] #Lower wavelength limits
@@ -515,8 +1166,8 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
             warnings.warn("No header key for PA (ROTPA or ROTPOSN) found.")
             pos_ang_i = 0
 
-        # Replace masked voxels with NaN values
-        if usemask:
+        # Replace masked voxels with NaN values (done per block if streaming)
+        if usemask and not stream:
             msk_data = mask_hdus[i].data
             bin_mask = (msk_data == 1) & (msk_data >= 8)
             int_hdu.data[bin_mask] = np.nan
@@ -547,69 +1198,45 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
     cd33_0 = wscales[0]
     wav_new = np.arange(min(wav0s) - cd33_0, max(wav1s) + cd33_0, cd33_0)
 
-    # Adjust each cube to be on new wavelength axis
+    # Split the wavelength offset between each cube and wav_new into an
+    # integer and sub-pixel shift
+    int_shifts = []
+    subpx_shifts = []
+    for wav0 in wav0s:
+        wav_shift_i = (wav0 - wav_new[0]) / cd33_0
+        int_shifts.append(int(wav_shift_i))
+        subpx_shifts.append(wav_shift_i - int(wav_shift_i))
+
+    # Adjust each cube to be on new wavelength axis (done per block if streaming)
+    t_align = time.time()
     for i, int_hdu in enumerate(int_hdus):
 
-        # Pad the end of the cube with zeros to reach same length as wav_new
-        n_pad_w = len(wav_new) - int_hdu.header["NAXIS3"]
-
-        # Get the wavelength offset between this cube and wav_new
-        wav_shift_i = (wav0s[i] - wav_new[0]) / cd33_0
-
-        # Split the wavelength difference into an integer and sub-pixel shift
-        int_shift = int(wav_shift_i)
-        subpx_shift = wav_shift_i - int_shift
+        if stream:
+            break
 
-        # Create convolution matrix for subpixel shift
-        shift_kernel = np.array([subpx_shift, 1 - subpx_shift])
+        # Shift data onto the new axis, squaring the kernel for variance
+        for hdu_i, power in [(int_hdu, 1), (var_hdus[i] if usevar else None, 2)]:
 
-        #
-        # Apply changes
-        #
+            if hdu_i is None:
+                continue
 
-        # 1 - Pad data along z-axis to same length as wav_new
-        int_hdu.data = np.pad(
-            int_hdu.data,
-            ((0, n_pad_w), (0, 0), (0, 0)),
-            mode='constant'
-            )
-
-        # 2 - Perform integer shift with np.roll
-        int_hdu.data = np.roll(int_hdu.data, int_shift, axis=0)
-
-        # 3 - Shift data along axis by convolving with K
-        int_hdu.data = np.apply_along_axis(
-            lambda m, sk=shift_kernel: np.convolve(m, sk, mode='same'),
-            axis=0,
-            arr=int_hdu.data
-            )
-
-        # 4 - Update header's WCS info for axis 3
-        int_hdu.header["NAXIS3"] = len(wav_new)
-        int_hdu.header["CRVAL3"] = wav_new[0]
-        int_hdu.header["CRPIX3"] = 1
-
-        # Apply steps 1-4 to variance (square the kernel for convolution)
-        if usevar:
-            var_hdus[i].data = np.pad(
-                var_hdus[i].data,
-                ((0, n_pad_w), (0, 0), (0, 0)),
-                mode='constant'
-                )
-            # 2 - Perform integer shift with np.roll
-            var_hdus[i].data = np.roll(var_hdus[i].data, int_shift, axis=0)
-
-            # 3 - Shift data along axis by convolving with K
-            var_hdus[i].data = np.apply_along_axis(
-                lambda m, sk=shift_kernel: np.convolve(m, sk**2, mode='same'),
-                axis=0,
-                arr=var_hdus[i].data
+            hdu_i.data = _read_aligned_layers(
+                hdu_i.data,
+                int_shifts[i],
+                subpx_shifts[i],
+                0,
+                len(wav_new),
+                power=power,
+                dtype=dtype
                 )
 
-            # 4 - Update header's WCS info for axis 3
-            var_hdus[i].header["NAXIS3"] = len(wav_new)
-            var_hdus[i].header["CRVAL3"] = wav_new[0]
-            var_hdus[i].header["CRPIX3"] = 1
+            # Update header's WCS info for axis 3
+            hdu_i.header["NAXIS3"] = len(wav_new)
+            hdu_i.header["CRVAL3"] = wav_new[0]
+            hdu_i.header["CRPIX3"] = 1
+
+    if not stream:
+        utils.output("\tWavelength alignment: %.2f seconds\n" % (time.time() - t_align))
 
     #
     # Stage 2 - SPATIAL ALIGNMENT
@@ -627,8 +1254,8 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
     else:
         wcs0.wcs.cd[:, 1] /= dy_0 / dx_0
 
-    #Rotate WCS to the input pa
-    wcs0 = reduction.wcs.rotate(wcs0, pas[i] - pos_ang)
+    #Rotate WCS to the input pa, measured from the last input cube
+    wcs0 = reduction.wcs.rotate(wcs0, pas[-1] - pos_ang)
 
     #Set new WCS - we will use it later to create the canvas
     wcs0.wcs.set()
@@ -701,11 +1328,22 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
     coadd_px_area = coordinates.get_pxarea_arcsec(coadd_hdr2d)
 
     # Create data structures to store coadded cube and corresponding exposure time mask
-    coadd_data = np.zeros((coadd_size_w, coadd_size_y, coadd_size_x))
-    coadd_exp = np.zeros_like(coadd_data)
-
-    if usevar:
-        coadd_var = np.zeros_like(coadd_data)
+    coadd_shape = (coadd_size_w, coadd_size_y, coadd_size_x)
+    if stream:
+        zblock = _get_stream_zblock(
+            mem_limit,
+            max(x.header["NAXIS1"] * x.header["NAXIS2"] for x in int_hdus),
+            coadd_size_x * coadd_size_y
+            )
+        coadd_data = _get_scratch_array(coadd_shape)
+        coadd_exp = _get_scratch_array(coadd_shape)
+        if usevar:
+            coadd_var = _get_scratch_array(coadd_shape)
+    else:
+        coadd_data = np.zeros(coadd_shape)
+        coadd_exp = np.zeros_like(coadd_data)
+        if usevar:
+            coadd_var = np.zeros_like(coadd_data)
 
     if plot:
 
@@ -732,15 +1370,15 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
         sky_ax = fig2.add_subplot(grid[1:, :1])
         coadd_ax = fig2.add_subplot(grid[1:, 1:])
 
-    if verbose:
-        pbar = tqdm(total=np.sum([x.data[0].size for x in int_hdus]))
+    if stream:
+        zblock = max(1, zblock // n_workers)
 
-    # Run through each input frame
+    # Gather the inputs needed to project each frame
+    frames = []
+    frame_ids = []
     for i, int_hdu in enumerate(int_hdus):
 
         header_i = int_hdu.header
-        header2d_i = coordinates.get_header2d(header_i)
-        wcs2d_i = WCS(header2d_i)
         px_area_i = coordinates.get_pxarea_arcsec(header_i)
 
         if "TELAPSE" in header_i:
@@ -751,222 +1389,174 @@ def coadd(cube_list, cube_type=None, masks_in=None, var_in=None, pos_ang=None, p
             warnings.warn("No exposure time (TELAPSE/EXPTIME) keyword found in header. Skipping.")
             continue
 
-        # Create intermediate frame to build up coadd contributions pixel-by-pixel
-        build_frame = np.zeros_like(coadd_data)
-
-        #Build frame for variance
-        if usevar:
-            var_build_frame = np.zeros_like(coadd_data)
-
-        # Fract frame stores a coverage fraction for each coadd pixel
-        fract_frame = np.zeros_like(coadd_data)
-
         # Get wavelength coverage of this FITS as binary mask
         wavmask_i = np.ones(len(wav_new), dtype=bool)
         wavmask_i[wav_new < wav0s[i]] = 0
         wavmask_i[wav_new > wav1s[i]] = 0
 
         # Convert to a flux-like unit if the input data is in counts
-        if "electrons" in int_hdu.header["BUNIT"]:
+        in_counts = "electrons" in int_hdu.header["BUNIT"]
+        if in_counts and not stream:
             int_hdu.data /= t_exp_i
             if usevar:
                 var_hdus[i].data /= t_exp_i**2 #Propagate error
 
-        if plot:
-            input_ax.clear()
-            sky_ax.clear()
-            coadd_ax.clear()
-            input_ax.set_title("Input Frame Coordinates")
-            sky_ax.set_title("Sky Coordinates")
-            coadd_ax.set_title("Coadd Coordinates")
-            coadd_ax.set_xlabel("X")
-            coadd_ax.set_ylabel("Y")
-            sky_ax.set_xlabel("RA (hh.hh)")
-            sky_ax.set_ylabel("DEC (dd.dd)")
-            y_u, x_u = int_hdu.data.shape[1:]
-            input_ax.plot([0, x_u], [0, 0], 'k-')
-            input_ax.plot([x_u, x_u], [0, y_u], 'k-')
-            input_ax.plot([x_u, 0], [y_u, y_u], 'k-')
-            input_ax.plot([0, 0], [y_u, 0], 'k-')
-            input_ax.set_xlim([-5, x_u+5])
-            input_ax.set_ylim([-5, y_u+5])
-            #input_ax.plot(qXin,qYin,'ro')
-            input_ax.set_xlabel("X")
-            input_ax.set_ylabel("Y")
-            y_u, x_u = coadd_data.shape[1:]
-            coadd_ax.plot([0, x_u], [0, 0], 'r-')
-            coadd_ax.plot([x_u, x_u], [0, y_u], 'r-')
-            coadd_ax.plot([x_u, 0], [y_u, y_u], 'r-')
-            coadd_ax.plot([0, 0], [y_u, 0], 'r-')
-            coadd_ax.set_xlim([-0.5, x_u+1])
-            coadd_ax.set_ylim([-0.5, y_u+1])
-            for f_p in footprints[i:i+1]:
-                sky_ax.plot(-f_p[0:2, 0], f_p[0:2, 1], 'k-')
-                sky_ax.plot(-f_p[1:3, 0], f_p[1:3, 1], 'k-')
-                sky_ax.plot(-f_p[2:4, 0], f_p[2:4, 1], 'k-')
-                sky_ax.plot([-f_p[3, 0], -f_p[0, 0]], [f_p[3, 1], f_p[0, 1]], 'k-')
-            for f_p in [coadd_fp]:
-                sky_ax.plot(-f_p[0:2, 0], f_p[0:2, 1], 'r-')
-                sky_ax.plot(-f_p[1:3, 0], f_p[1:3, 1], 'r-')
-                sky_ax.plot(-f_p[2:4, 0], f_p[2:4, 1], 'r-')
-                sky_ax.plot([-f_p[3, 0], -f_p[0, 0]], [f_p[3, 1], f_p[0, 1]], 'r-')
-
-        # Loop through spatial pixels in this input frame
-        for y_j in range(int_hdu.data.shape[1]):
-            for x_k in range(int_hdu.data.shape[2]):
-
-                #Get binary mask of good wavelength indices at this x,y position
-                msk_jk = wavmask_i & ~np.isnan(int_hdu.data[:, y_j, x_k])
-
-                # Define BL, TL, TR, BR corners of pixel as coordinates
-                pix_verts = np.array([
-                    [x_k - 0.5 + drz_f, y_j - 0.5 + drz_f],
-                    [x_k - 0.5 + drz_f, y_j + 0.5 - drz_f],
-                    [x_k + 0.5 - drz_f, y_j + 0.5 - drz_f],
-                    [x_k + 0.5 - drz_f, y_j - 0.5 + drz_f]
-                    ])
-
-                # Convert these vertices to RA/DEC positions
-                pix_verts_radec = wcs2d_i.all_pix2world(pix_verts, 0)
-
-                # Convert the RA/DEC vertex values into coadd frame coordinates
-                pix_verts_coadd = coadd_wcs.all_world2pix(pix_verts_radec, 0)
-
-                #Create polygon object for projection onto coadd grid
-                pix_projection = shapely_polygon(pix_verts_coadd)
-
-                if plot:
-                    input_ax.plot(pix_verts[:, 0], pix_verts[:, 1], 'kx')
-                    sky_ax.plot(-pix_verts_radec[:, 0], pix_verts_radec[:, 1], 'kx')
-                    coadd_ax.plot(pix_verts_coadd[:, 0], pix_verts_coadd[:, 1], 'kx')
-
-                #Get bounds of pixel projection in coadd frame
-                proj_bounds = list(pix_projection.exterior.bounds)
-
-                # xb0 is x-bound-lower, yb1 is y-bound-upper, etc.
-                xb0, yb0, xb1, yb1 = (int(round(pib)) for pib in proj_bounds)
-
-                # Upper bounds need to be increased to include full pixel
-                xb1 += 1
-                yb1 += 1
-
-                # Loop through relevant pixels in output/coadd frame ('coadd' denoted '_c')
-                for x_c in range(xb0, xb1):
-                    for y_c in range(yb0, yb1):
-
-                        # Create shapely_polygon object for this coadd pixel
-                        coadd_pixel = shapely_box(x_c - 0.5, y_c - 0.5, x_c + 0.5, y_c + 0.5)
-
-                        # Get overlap between input pixel and this coadd pixel
-                        overlap = pix_projection.intersection(coadd_pixel).area
-
-                        # Convert to fraction of total input pixel area
-                        overlap /= pix_projection.area
-
-                        # Extract spectrum
-                        spc_in = int_hdu.data[msk_jk, y_j, x_k]
-
-                        # Extract variance
-                        if usevar:
-                            var_jk = var_hdus[i].data[msk_jk, y_j, x_k].copy()
-                            var_jk *= (overlap**2)
-
-                        #Update all relevant frames
-                        try:
-                            fract_frame[msk_jk, y_c, x_c] += overlap
-                            build_frame[msk_jk, y_c, x_c] += overlap * spc_in
-                            if usevar:
-                                var_build_frame[msk_jk, y_c, x_c] += var_jk
-
-                        except IndexError:
-                            continue
-                            #TODO - Fix the issue of edge pixels being trimmed
-                            #Need to expand coadd canvas to include all pixels.
-                if verbose:
-                    pbar.update(1)
-
-        if plot:
-            fig2.canvas.draw()
-            plt.waitforbuttonpress()
-
-        #Calculate ratio of coadd pixel area to input pixel area
-        px_area_ratio = coadd_px_area / px_area_i
-
-        # Max value in fract_frame should be px_area_ratio; it's the biggest
-        # fraction of an input pixel that can add to one coadd pixel
-        # We want to use this map now to create a flat_frame - where the
-        # values represent a covering fraction for each pixel
-        # i.e. 0.1 = 10% of pixel area covered by input frames
-        flat_frame = fract_frame / px_area_ratio
-
-        #Replace zero-values with inf values to avoid division by zero
-        flat_frame[flat_frame == 0] = np.inf
-
-        # Perform flat field correction for pixels that are not fully covered
-        build_frame /= flat_frame
-
-        # Zero any pixels below user-set pixel threshold. Set flat value to inf
-        build_frame[flat_frame < px_thresh] = 0
-
-        # Propagate variance on previous two steps
-        if usevar:
-            var_build_frame /= (flat_frame)**2
-            var_build_frame[flat_frame < px_thresh] = np.inf
-
-        #Replace values < px_thresh with inf also
-        flat_frame[flat_frame < px_thresh] = np.inf
-
-        #Add to exposure mask
-        coadd_exp += t_exp_i * (flat_frame < np.inf)
-
-        # Add weight * data to coadd
-        coadd_data += t_exp_i * build_frame
-
-        # Propagate error on the above step
-        if usevar:
-            coadd_var += (t_exp_i**2) * var_build_frame
-
-    if verbose:
-        pbar.close()
+        frame_ids.append(i)
+        frames.append(dict(
+            int_hdu=int_hdu,
+            var_hdu=var_hdus[i] if usevar else None,
+            mask_hdu=mask_hdus[i] if usemask and stream else None,
+            coadd_hdr2d=coadd_hdr2d,
+            wavmask=wavmask_i,
+            int_shift=int_shifts[i],
+            subpx_shift=subpx_shifts[i],
+            t_exp=t_exp_i,
+            in_counts=in_counts,
+            px_area_ratio=coadd_px_area / px_area_i,
+            px_thresh=px_thresh,
+            drizzle=drizzle,
+            zblock=zblock,
+            stream=stream,
+            cache_dir=cache_dir,
+            cache_size=cache_size,
+            dtype=dtype
+            ))
+
+    canvases = (coadd_data, coadd_exp, coadd_var if usevar else None)
+
+    # Project each frame, either in this process or in a pool of workers
+    t_project = time.time()
+    global _COADD_FRAMES
+    pool = None
+    try:
+        if n_workers > 1:
+            _COADD_FRAMES = frames
+            pool = multiprocessing.get_context("fork").Pool(n_workers)
+            results = pool.imap(_coadd_frame_worker, range(len(frames)))
+        else:
+            results = (_coadd_frame(**frame, canvases=canvases) for frame in frames)
+
+        for i, (bounds, partials) in tqdm(zip(frame_ids, results), total=len(frames),
+                                          disable=not verbose):
+
+            y_0, y_1, x_0, x_1 = bounds
+
+            # Sum partial canvases from worker processes into the coadd
+            if partials is not None:
+                for canvas, partial in zip(canvases, partials):
+                    if partial is not None:
+                        canvas[:, y_0:y_1, x_0:x_1] += partial
+
+            if plot:
+                int_hdu = int_hdus[i]
+                input_ax.clear()
+                sky_ax.clear()
+                coadd_ax.clear()
+                input_ax.set_title("Input Frame Coordinates")
+                sky_ax.set_title("Sky Coordinates")
+                coadd_ax.set_title("Coadd Coordinates")
+                coadd_ax.set_xlabel("X")
+                coadd_ax.set_ylabel("Y")
+                sky_ax.set_xlabel("RA (hh.hh)")
+                sky_ax.set_ylabel("DEC (dd.dd)")
+                y_u, x_u = int_hdu.header["NAXIS2"], int_hdu.header["NAXIS1"]
+                input_ax.plot([0, x_u], [0, 0], 'k-')
+                input_ax.plot([x_u, x_u], [0, y_u], 'k-')
+                input_ax.plot([x_u, 0], [y_u, y_u], 'k-')
+                input_ax.plot([0, 0], [y_u, 0], 'k-')
+                input_ax.set_xlim([-5, x_u+5])
+                input_ax.set_ylim([-5, y_u+5])
+                input_ax.set_xlabel("X")
+                input_ax.set_ylabel("Y")
+                y_u, x_u = coadd_data.shape[1:]
+                coadd_ax.plot([0, x_u], [0, 0], 'r-')
+                coadd_ax.plot([x_u, x_u], [0, y_u], 'r-')
+                coadd_ax.plot([x_u, 0], [y_u, y_u], 'r-')
+                coadd_ax.plot([0, 0], [y_u, 0], 'r-')
+                coadd_ax.set_xlim([-0.5, x_u+1])
+                coadd_ax.set_ylim([-0.5, y_u+1])
+                for f_p in footprints[i:i+1]:
+                    sky_ax.plot(-f_p[0:2, 0], f_p[0:2, 1], 'k-')
+                    sky_ax.plot(-f_p[1:3, 0], f_p[1:3, 1], 'k-')
+                    sky_ax.plot(-f_p[2:4, 0], f_p[2:4, 1], 'k-')
+                    sky_ax.plot([-f_p[3, 0], -f_p[0, 0]], [f_p[3, 1], f_p[0, 1]], 'k-')
+                for f_p in [coadd_fp]:
+                    sky_ax.plot(-f_p[0:2, 0], f_p[0:2, 1], 'r-')
+                    sky_ax.plot(-f_p[1:3, 0], f_p[1:3, 1], 'r-')
+                    sky_ax.plot(-f_p[2:4, 0], f_p[2:4, 1], 'r-')
+                    sky_ax.plot([-f_p[3, 0], -f_p[0, 0]], [f_p[3, 1], f_p[0, 1]], 'r-')
+
+                # Show the footprint of this frame on the coadd grid
+                coadd_ax.plot(
+                    [x_0 - 0.5, x_1 - 0.5, x_1 - 0.5, x_0 - 0.5, x_0 - 0.5],
+                    [y_0 - 0.5, y_0 - 0.5, y_1 - 0.5, y_1 - 0.5, y_0 - 0.5],
+                    'k-'
+                    )
+                fig2.canvas.draw()
+                plt.waitforbuttonpress()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    finally:
+        # Stop any workers left by an error, and release the shared frames
+        if pool is not None:
+            pool.terminate()
+        _COADD_FRAMES = []
+
+    utils.output("\tSpatial projection: %.2f seconds\n" % (time.time() - t_project))
 
     if plot:
         plt.close()
 
     utils.output("\tTrimming coadded canvas.\n")
 
-    # Create 1D exposure time profiles
-    exp_zprof = np.mean(coadd_exp, axis=(1, 2))
-    exp_xprof = np.mean(coadd_exp, axis=(0, 1))
-    exp_yprof = np.mean(coadd_exp, axis=(0, 2))
+    # Create 1D exposure time profiles, one block of layers at a time
+    exp_zprof = np.zeros(coadd_size_w)
+    exp_xprof = np.zeros(coadd_size_x)
+    exp_yprof = np.zeros(coadd_size_y)
+    for z_0 in range(0, coadd_size_w, zblock):
+        exp_blk = coadd_exp[z_0:z_0 + zblock]
+        exp_zprof[z_0:z_0 + zblock] = np.mean(exp_blk, axis=(1, 2))
+        exp_xprof += np.sum(exp_blk, axis=(0, 1))
+        exp_yprof += np.sum(exp_blk, axis=(0, 2))
 
     # Normalize the profiles
     exp_zprof /= np.max(exp_zprof)
     exp_xprof /= np.max(exp_xprof)
     exp_yprof /= np.max(exp_yprof)
 
-    # Convert 0s to +1NF in exposure time cube
-    coadd_exp[coadd_exp == 0] = np.inf
-
-    # Divide by total exposure time, or square for variance
-    coadd_data /= coadd_exp
-    if usevar:
-        coadd_var /= coadd_exp**2
-
     #Exposure time threshold, relative to maximum exposure time, below which to crop.
     use_z = exp_zprof > exp_thresh
     use_x = exp_xprof > exp_thresh
     use_y = exp_yprof > exp_thresh
 
-    #Trim the data
-    coadd_data = coadd_data[use_z]
-    coadd_data = coadd_data[:, use_y]
-    coadd_data = coadd_data[:, :, use_x]
+    #Create trimmed output cubes
+    z_use = np.nonzero(use_z)[0]
+    trim_shape = (len(z_use), np.count_nonzero(use_y), np.count_nonzero(use_x))
+    alloc = _get_scratch_array if stream else np.zeros
+    coadd_out = alloc(trim_shape)
+    if usevar:
+        coadd_var_out = alloc(trim_shape)
+
+    #Trim the data and divide by total exposure time, or square for variance
+    for j_0 in range(0, len(z_use), zblock):
+
+        z_blk = z_use[j_0:j_0 + zblock]
+        out_blk = slice(j_0, j_0 + len(z_blk))
+
+        # Convert 0s to +1NF in exposure time cube
+        exp_blk = coadd_exp[z_blk][:, use_y][:, :, use_x]
+        exp_blk[exp_blk == 0] = np.inf
+
+        coadd_out[out_blk] = coadd_data[z_blk][:, use_y][:, :, use_x] / exp_blk
+        if usevar:
+            coadd_var_out[out_blk] = coadd_var[z_blk][:, use_y][:, :, use_x] / exp_blk**2
 
-    #Trim variance
+    coadd_data = coadd_out
     if usevar:
-        coadd_var = coadd_var[use_z]
-        coadd_var = coadd_var[:, use_y]
-        coadd_var = coadd_var[:, :, use_x]
+        coadd_var = coadd_var_out
 
     #Update the WCS to account for trimmed pixels
     coadd_hdr["CRPIX3"] -= np.argmax(use_z)
@@ -4,7 +4,8 @@
 
 #Third-party Imports
 from PyAstronomy import pyasl
-from scipy.interpolate import interp1d
+from scipy.interpolate import BSpline
+from scipy.sparse.linalg import splu
 import astropy.coordinates
 import astropy.stats
 import astropy.units as u
@@ -13,12 +14,65 @@ import numpy as np
 #Local Imports
 from cwitools import coordinates, utils
 
-def air2vac(fits_in, mask=False):
+def _resample_z(cube, wav_in, wav_out, mask=False, float32=False, max_size=2**22):
+    """Resample every spectrum of a cube from one wavelength grid to another.
+
+    Data are interpolated with a cubic spline (not-a-knot, extrapolated), as
+    interp1d(kind='cubic') does. Masks take the larger of the previous and next
+    input values, or 128 outside the input grid. The spline solve and
+    evaluation matrices are built once and applied to all spaxels.
+
+    Args:
+        cube (numpy.ndarray): The 3D input cube, without NaN values.
+        wav_in (numpy.ndarray): The increasing wavelength axis of the input cube.
+        wav_out (numpy.ndarray): The wavelength axis to resample to.
+        mask (bool): Set if the cube is a mask cube.
+        float32 (bool): Return the cube in single precision.
+        max_size (int): Maximum number of input elements to resample at once.
+
+    Returns:
+        numpy.ndarray: The resampled cube.
+
+    """
+    shape = cube.shape
+    cube = cube.reshape(shape[0], -1)
+    dtype = np.float32 if float32 else cube.dtype
+
+    if mask:
+        n_in = len(wav_in)
+        i_pre = np.searchsorted(np.nextafter(wav_in, -np.inf), wav_out, side='left')
+        i_pre = i_pre.clip(1, n_in) - 1
+        i_nex = np.searchsorted(np.nextafter(wav_in, np.inf), wav_out, side='right')
+        i_nex = i_nex.clip(0, n_in - 1)
+        outside = (wav_out < wav_in[0]) | (wav_out > wav_in[-1])
+
+        cube_new = np.maximum(cube[i_pre], cube[i_nex]).astype(dtype)
+        cube_new[outside] = 128
+
+        return cube_new.reshape((len(wav_out),) + shape[1:])
+
+    # Not-a-knot cubic B-spline through the input samples
+    knots = np.concatenate([[wav_in[0]] * 4, wav_in[2:-2], [wav_in[-1]] * 4])
+    colloc = BSpline.design_matrix(wav_in, knots, 3).tocsc()
+    colloc_lu = splu(colloc)
+    design = BSpline.design_matrix(wav_out, knots, 3, extrapolate=True).tocsr()
+
+    cube_new = np.zeros((len(wav_out), cube.shape[1]), dtype=dtype)
+    step = max(1, max_size // shape[0])
+    for start in range(0, cube.shape[1], step):
+        chunk = slice(start, start + step)
+        coeffs = colloc_lu.solve(np.ascontiguousarray(cube[:, chunk], dtype=float))
+        cube_new[:, chunk] = design @ coeffs
+
+    return cube_new.reshape((len(wav_out),) + shape[1:])
+
+def air2vac(fits_in, mask=False, float32=False):
     """Covert wavelengths in a cube from standard air to vacuum.
 
     Args:
         fits_in (astropy HDU / HDUList): Input HDU/HDUList with 3D data.
         mask (bool): Set if the cube is a mask cube.
+        float32 (bool): Return the resampled cube in single precision.
 
     Returns:
         HDU / HDUList*: Trimmed FITS object with updated header.
@@ -39,43 +93,7 @@ def air2vac(fits_in, mask=False):
     wave_vac = pyasl.airtovac2(wave_air)
 
     # resample to uniform grid
-    cube_new = np.zeros_like(cube)
-    for i in range(cube.shape[2]):
-        for j in range(cube.shape[1]):
-
-            spec0 = cube[:, j, i]
-            if not mask:
-                f_cubic = interp1d(
-                    wave_vac,
-                    spec0,
-                    kind='cubic',
-                    fill_value='extrapolate'
-                    )
-                spec_new = f_cubic(wave_air)
-            else:
-                f_pre = interp1d(
-                    wave_vac,
-                    spec0,
-                    kind='previous',
-                    bounds_error=False,
-                    fill_value=128
-                    )
-                spec_pre = f_pre(wave_air)
-
-                f_nex = interp1d(
-                    wave_vac,
-                    spec0,
-                    kind='next',
-                    bounds_error=False,
-                    fill_value=128
-                    )
-                spec_nex = f_nex(wave_air)
-
-                spec_new = np.zeros_like(spec0)
-                for k in range(spec0.shape[0]):
-                    spec_new[k] = max(spec_pre[k], spec_nex[k])
-
-            cube_new[:, j, i] = spec_new
+    cube_new = _resample_z(cube, wave_vac, wave_air, mask=mask, float32=float32)
 
     hdr['CTYPE3'] = 'WAVE'
     hdu_new = utils.match_hdu_type(fits_in, cube_new, hdr)
@@ -84,7 +102,7 @@ def air2vac(fits_in, mask=False):
 
 
 def heliocentric(fits_in, mask=False, return_vcorr=False, resample=True, vcorr=None,
-                 barycentric=False):
+                 barycentric=False, float32=False):
     """Apply heliocentric correction to the cubes. 
     *Note that this only works for KCWI data because the location of the Keck 
     Observatory is hard-coded in the function.*
@@ -98,6 +116,7 @@ def heliocentric(fits_in, mask=False, return_vcorr=False, resample=True, vcorr=N
         resample (bool): Resample the cube to the original wavelength grid?
         vcorr (float): Use a different correction velocity.
         barycentric (bool): Use barycentric correction instead of heliocentric.
+        float32 (bool): Return the resampled cube in single precision.
 
     Returns:
         HDU / HDUList*: Trimmed FITS object with updated header.
@@ -161,26 +180,7 @@ def heliocentric(fits_in, mask=False, return_vcorr=False, resample=True, vcorr=N
     wav_hel = wav_old * (1 + v_tot / 2.99792458e5)
 
     # resample to uniform grid
-    cube_new = np.zeros_like(cube)
-    for i in range(cube.shape[2]):
-        for j in range(cube.shape[1]):
-
-            spc0 = cube[:, j, i]
-            if not mask:
-                f_cubic = interp1d(wav_hel, spc0, kind='cubic', fill_value='extrapolate')
-                spec_new = f_cubic(wav_old)
-
-            else:
-                f_pre = interp1d(wav_hel, spc0, kind='previous', bounds_error=False, fill_value=128)
-                spec_pre = f_pre(wav_old)
-                f_nex = interp1d(wav_hel, spc0, kind='next', bounds_error=False, fill_value=128)
-                spec_nex = f_nex(wav_old)
-
-                spec_new = np.zeros_like(spc0)
-                for k in range(spc0.shape[0]):
-                    spec_new[k] = max(spec_pre[k], spec_nex[k])
-
-            cube_new[:, j, i] = spec_new
+    cube_new = _resample_z(cube, wav_hel, wav_old, mask=mask, float32=float32)
 
     hdr['VCORR'] = vcorr
     hdu_new = utils.match_hdu_type(fits_in, cube_new, hdr)
@@ -1,6 +1,7 @@
 """Reduction tools related to variance estimation."""
 
 #Standard Imports
+from concurrent.futures import ThreadPoolExecutor
 
 #Third-party Imports
 from astropy.modeling import models, fitting
@@ -16,7 +17,56 @@ import numpy as np
 #Local Imports
 from cwitools import coordinates, modeling, utils
 
-def estimate_variance(inputfits, window=50, nmin=30, snrmin=2.5, wmasks=None):
+def _running_var(data, zmask, z_lo, z_hi):
+    """Get the variance of each spaxel over windows of unmasked wavelength layers.
+
+    Uses cumulative sums of the data and squared data along z, after shifting
+    each spectrum by its mean to limit round-off errors.
+
+    Args:
+        data (numpy.ndarray): The 3D data cube.
+        zmask (numpy.ndarray): Boolean array, True for the layers to use.
+        z_lo (numpy.ndarray): Start of the window of each output layer.
+        z_hi (numpy.ndarray): End (exclusive) of the window of each output layer.
+
+    Returns:
+        numpy.ndarray: The variance cube. Windows containing NaN values, or no
+            unmasked layers, are NaN.
+
+    """
+    vals = np.array(data[zmask], dtype=float)
+    nans = np.isnan(vals)
+    n_nan = np.count_nonzero(nans, axis=0)
+    vals[nans] = 0
+    shift = vals.sum(axis=0) / np.maximum(zmask.sum() - n_nan, 1)
+    vals -= shift
+
+    # Cumulative sums over unmasked layers, indexed by the full z axis
+    z_use = np.concatenate([[0], np.cumsum(zmask)])
+    i_lo, i_hi = z_use[z_lo], z_use[z_hi]
+    n_vox = (i_hi - i_lo)[:, None, None]
+
+    sum1 = np.zeros((vals.shape[0] + 1,) + vals.shape[1:])
+    np.cumsum(vals, axis=0, out=sum1[1:])
+    sum1 = sum1[i_hi] - sum1[i_lo]
+
+    vals *= vals
+    vals[nans] = 0
+    sum2 = np.zeros((vals.shape[0] + 1,) + vals.shape[1:])
+    np.cumsum(vals, axis=0, out=sum2[1:])
+    sum2 = sum2[i_hi] - sum2[i_lo]
+
+    nans = np.concatenate([np.zeros((1,) + nans.shape[1:], dtype=int), np.cumsum(nans, axis=0)])
+    nans = (nans[i_hi] - nans[i_lo]) > 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sum1 / n_vox
+        var = np.clip(sum2 / n_vox - mean**2, 0, None)
+    var[nans | (n_vox == 0)] = np.nan
+
+    return var
+
+def estimate_variance(inputfits, window=50, nmin=30, snrmin=2.5, wmasks=None, max_size=None):
     """Estimates the 3D variance cube of an input cube.
 
     Args:
@@ -28,6 +78,9 @@ def estimate_variance(inputfits, window=50, nmin=30, snrmin=2.5, wmasks=None):
         window (int): Wavelength window (Angstrom) to use for local 2D variance estimation.
         wmasks (list): List of wavelength tuples to exclude when estimating variance.
         sclip (float): Sigmaclip threshold to apply when comparing layer-by-layer noise.
+        max_size (int): Maximum number of voxels to estimate at once. The cube is
+            split into chunks of rows to save memory, e.g. for memory-mapped data.
+            Default is to use the whole cube at once.
 
     Returns:
         NumPy ndarray: Estimated variance cube
@@ -46,28 +99,74 @@ def estimate_variance(inputfits, window=50, nmin=30, snrmin=2.5, wmasks=None):
             zmask[(wav_axis > pair[0]) & (wav_axis < pair[1])] = 0
     nzmax = np.count_nonzero(zmask)
 
-    #Loop over wavelength first to minimize repetition of wl-mask calculation
-    for z_j in z_indices:
-
-        #Get initial width of white-light bandpass in px
-        width_px = window / hdu.header["CD3_3"]
-
-        #Create initial white-light mask, centered on j with above width
-        vmask = zmask & (np.abs(z_indices - z_j) <= width_px / 2)
-
-        #Grow until minimum number of valid wavelength layers included
-        while np.count_nonzero(vmask) < min(nzmax, window / hdu.header["CD3_3"]):
-            width_px += 2
-            vmask = zmask & (np.abs(z_indices - z_j) <= width_px / 2)
+    #Get the wavelength window of each layer first, as it does not depend on data
+    #Initial width of white-light bandpass in px, centered on each layer
+    width_0 = window / hdu.header["CD3_3"]
+    width_px = np.full(z_indices.shape, width_0)
+    z_cum = np.concatenate([[0], np.cumsum(zmask)])
+
+    #Grow until minimum number of valid wavelength layers included
+    while True:
+        half_px = np.floor(width_px / 2).astype(int)
+        z_lo = np.clip(z_indices - half_px, 0, None)
+        z_hi = np.clip(z_indices + half_px + 1, None, z_indices.size)
+        grow = (z_cum[z_hi] - z_cum[z_lo]) < min(nzmax, width_0)
+        if not np.any(grow):
+            break
+        width_px[grow] += 2
+
+    #Running variance over each window, in chunks of rows if needed
+    if max_size is None:
+        step = hdu.data.shape[1]
+    else:
+        step = max(1, max_size // (hdu.data.shape[0] * hdu.data.shape[2]))
 
-        varcube[z_j] = np.var(hdu.data[vmask], axis=0)
+    for y_0 in range(0, hdu.data.shape[1], step):
+        y_slice = slice(y_0, y_0 + step)
+        varcube[:, y_slice] = _running_var(hdu.data[:, y_slice], zmask, z_lo, z_hi)
 
     #Adjust first estimate by rescaling, if set to do so
     varcube_scaled, _ = scale_variance(hdu.data, varcube, n_min=nmin, snr_min=snrmin)
 
     return varcube_scaled
 
-def scale_variance(data, var, snr_min=3, n_min=50, plot=True, snr_range=(-5, 5), snr_bins=100):
+def _fit_gauss_hist(centers, counts, fit_method='levmar'):
+    """Fit a Gaussian model to a histogram.
+
+    Args:
+        centers (numpy.ndarray): The bin centers.
+        counts (numpy.ndarray): The counts in each bin.
+        fit_method (str): 'levmar' for an iterative fit of the counts with
+            astropy, or 'closed' for the closed-form weighted fit of a parabola
+            to the log-counts (Guo 2011). The latter falls back to the former if
+            the log-counts do not curve down.
+
+    Returns:
+        astropy.modeling.models.Gaussian1D: The best-fit model.
+
+    """
+    if fit_method == 'closed':
+        use = counts > 0
+        x_use, y_use = centers[use], counts[use].astype(float)
+        design = np.array([np.ones_like(x_use), x_use, x_use**2]).T * y_use[:, None]
+        coeff = np.linalg.lstsq(design, y_use * np.log(y_use), rcond=None)[0]
+
+        if coeff[2] < 0:
+            return models.Gaussian1D(
+                amplitude=np.exp(coeff[0] - coeff[1]**2 / (4 * coeff[2])),
+                mean=-coeff[1] / (2 * coeff[2]),
+                stddev=np.sqrt(-1 / (2 * coeff[2]))
+                )
+
+    elif fit_method != 'levmar':
+        raise ValueError("fit_method can only be 'closed' or 'levmar'")
+
+    noisefitter = fitting.LevMarLSQFitter()
+    noisemodel0 = models.Gaussian1D(amplitude=counts.max(), mean=0, stddev=1)
+    return noisefitter(noisemodel0, centers, counts)
+
+def scale_variance(data, var, snr_min=3, n_min=50, plot=True, snr_range=(-5, 5), snr_bins=100,
+                   fit_method='levmar'):
     """Automatically scale an initial 3D variance estimate using background pixels.
 
     Args:
@@ -84,6 +183,11 @@ def scale_variance(data, var, snr_min=3, n_min=50, plot=True, snr_range=(-5, 5),
         snr_bins (int): The number of SNR bins across snr_range to use for generating histograms.
             Scaling factors are determined by best-fit Gaussian models to SNR histograms, assuming
             background (i.e. shot-noise) limited observations. Default: 100
+        fit_method (str): How to fit the Gaussian models to the SNR histograms:
+            'levmar' (Default) - Iterative Levenberg-Marquardt fit to the counts.
+            'closed' - Closed-form fit of a parabola to the log-counts. Faster,
+                but weights the histogram bins differently, so the scaling
+                factor can differ from 'levmar' by a few tenths of a percent.
 
 
     Returns:
@@ -97,27 +201,30 @@ def scale_variance(data, var, snr_min=3, n_min=50, plot=True, snr_range=(-5, 5),
     scale_factor = 1
     std_fit = 99
     n_iter = 0
+    snr = data / np.sqrt(var)
+    vox_msk_old = None
 
     utils.output("\t%10s %15s %15s %15s\n" % ("iter", "scale_f", "std-dev", "1/std-dev"))
     while abs(std_fit - 1) >= 0.001:
 
         n_iter += 1
-        snr = data / np.sqrt(var)
+
         #Adjust SNR dist. using latest scale factor
         snr_scaled = snr * scale_factor
 
-        #Segment into regions
+        #Segment into regions, unless the thresholded mask did not change
         vox_msk = np.abs(snr_scaled) > snr_min
-        vox_lab = measure.label(vox_msk)
+        if vox_msk_old is None or not np.array_equal(vox_msk, vox_msk_old):
+            vox_lab = measure.label(vox_msk)
 
-        #Measure sizes of regions above (in absolute terms) snr min
-        reg_props = measure.regionprops_table(vox_lab, properties=['area', 'label'])
-        large_regions = reg_props['area'] > n_min
+            #Measure sizes of regions above (in absolute terms) snr min
+            reg_areas = np.bincount(vox_lab.ravel())
+            large_regions = reg_areas > n_min
+            large_regions[0] = False
 
-        # Create object mask to exclude these regions
-        obj_mask = np.zeros_like(data, dtype=bool)
-        for label in reg_props['label'][large_regions]:
-            obj_mask[vox_lab == label] = 1
+            # Create object mask to exclude these regions
+            obj_mask = large_regions[vox_lab]
+            vox_msk_old = vox_msk
 
         #Get SNR distribution of non-masked regions
         counts, edges = np.histogram(
@@ -127,13 +234,12 @@ def scale_variance(data, var, snr_min=3, n_min=50, plot=True, snr_range=(-5, 5),
             )
 
         #Fit Gaussian model
-        centers = np.array([(edges[i] + edges[i+1]) / 2 for i in range(edges.size - 1)])
-        noisefitter = fitting.LevMarLSQFitter()
+        centers = (edges[:-1] + edges[1:]) / 2
         noisemodel0 = models.Gaussian1D(amplitude=counts.max(), mean=0, stddev=1)
-        noisemodel1 = noisefitter(noisemodel0, centers, counts)
+        noisemodel1 = _fit_gauss_hist(centers, counts, fit_method=fit_method)
         std_fit1 = noisemodel1.stddev.value
         fit_cens = np.abs(centers) > 0.5 * std_fit1
-        noisemodel2 = noisefitter(noisemodel0, centers[fit_cens], counts[fit_cens])
+        noisemodel2 = _fit_gauss_hist(centers[fit_cens], counts[fit_cens], fit_method=fit_method)
         std_fit = noisemodel2.stddev.value
 
         if plot:
@@ -203,8 +309,77 @@ def scale_variance(data, var, snr_min=3, n_min=50, plot=True, snr_range=(-5, 5),
 
     return var * var_rescale_factor, var_rescale_factor
 
+def _get_sat(cube):
+    """Get the summed-area table of each layer of a cube.
+
+    Args:
+        cube (numpy.ndarray): The 3D input cube.
+
+    Returns:
+        numpy.ndarray: Table of shape (z, y + 1, x + 1) where [k, i, j] is the
+            sum of cube[k, :i, :j].
+
+    """
+    sat = np.zeros((cube.shape[0], cube.shape[1] + 1, cube.shape[2] + 1))
+    np.cumsum(np.cumsum(cube, axis=1, dtype=float), axis=2, out=sat[:, 1:, 1:])
+    return sat
+
+def _bin_sat(sat, binsize):
+    """Sum each layer in binsize x binsize blocks, starting from the first row and column.
+
+    Args:
+        sat (numpy.ndarray): Summed-area tables from _get_sat().
+        binsize (int): Size of the spatial bins. Incomplete bins at the upper
+            edges are dropped.
+
+    Returns:
+        numpy.ndarray: The binned cube.
+
+    """
+    n_y = (sat.shape[1] - 1) // binsize * binsize
+    n_x = (sat.shape[2] - 1) // binsize * binsize
+    corners = sat[:, :n_y + 1:binsize, :n_x + 1:binsize]
+    return corners[:, 1:, 1:] - corners[:, :-1, 1:] - corners[:, 1:, :-1] + corners[:, :-1, :-1]
+
+def _get_noise_ratios(args):
+    """Measure the noise ratio of a binned cube for several sets of z-layers.
+
+    Args:
+        args (tuple): Summed-area tables of the data, variance and non-zero
+            mask, a list of z-index arrays, and the bin size.
+
+    Returns:
+        numpy.ndarray: Ratio of the actual to the propagated noise for each set
+            of z-layers. NaN if fewer than 10 usable binned voxels remain.
+
+    """
+    sat_data, sat_var, sat_mask, z_sets, binsize = args
+    cube_b = _bin_sat(sat_data, binsize)
+    var_b = _bin_sat(sat_var, binsize)
+    use_b = _bin_sat(sat_mask, binsize) < 0.5
+
+    ratios = np.full(len(z_sets), np.nan)
+    for i, z_set in enumerate(z_sets):
+
+        #Get binary mask of useable vox
+        use_vox = use_b[z_set]
+
+        #Skip if fewer than 10 useable voxels remain in binned cube
+        if np.count_nonzero(use_vox) < 10:
+            continue
+
+        # Measure the error in the binned cube
+        actual_err = np.std(cube_b[z_set][use_vox])
+        propagated_err = np.sqrt(np.median(var_b[z_set][use_vox]))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratios[i] = actual_err / propagated_err
+
+    return ratios
+
 def fit_covar_xy(fits_in, var, mask=None, wrange=None, xybins=None, n_w=10, wavgood=True,
-                 return_all=False, model_bounds=None, mask_sky=True, mask_neb=None, plot=False):
+                 return_all=False, model_bounds=None, mask_sky=True, mask_neb=None, plot=False,
+                 n_workers=1):
     """Fits a two-component model to the noise as a function of bin size.
 
     The model used can be found in modeling.covar_curve
@@ -232,6 +407,8 @@ def fit_covar_xy(fits_in, var, mask=None, wrange=None, xybins=None, n_w=10, wavg
         mask_neb (float): Provide redshift to mask common nebular lines
         return_all (bool): If set, also return the independently measured data
             points.
+        n_workers (int): Number of threads used to measure the bin sizes in
+            parallel.
 
     Returns:
         HDU / HDUList*: Curve parameters recorded in the FITS header.
@@ -291,62 +468,12 @@ def fit_covar_xy(fits_in, var, mask=None, wrange=None, xybins=None, n_w=10, wavg
     var = var[~zmask]
     mask = mask[~zmask]
 
-    # Bin the data, variance and mask cubes in spatial axes by binsize
-    def resize(cube_in, var_in, mask_in, binsize):
-
-        cube = cube_in.copy()
-        mask = mask_in.copy()
-        var = var_in.copy()
-
-        if binsize == 1:
-            return cube, var, mask
-
-        binsize = int(binsize)
-
-        # Adjust size of cube to be even multiple of binsize
-        shape = cube.shape
-        if shape[1] % binsize != 0:
-            cube = cube[:, 0 : shape[1] - shape[1] % binsize, :]
-            mask = mask[:, 0 : shape[1] - shape[1] % binsize, :]
-            var = var[:, 0 : shape[1] - shape[1] % binsize, :]
-        if shape[2] % binsize != 0:
-            cube = cube[:, :, 0 : shape[2] - shape[2] % binsize]
-            mask = mask[:, :, 0 : shape[2] - shape[2] % binsize]
-            var = var[:, :, 0 : shape[2] - shape[2] % binsize]
-
-        # Update shape
-        shape = cube.shape
-
-        # Create new shape for the purpose of rebinning
-        shape_new = (
-            shape[0],
-            int(shape[1] / binsize),
-            binsize,
-            int(shape[2]/binsize),
-            binsize
-            )
-        cube_reshape = cube.reshape(shape_new)
-        var_reshape = var.reshape(shape_new)
-        mask_reshape = mask.reshape(shape_new)
-
-        # If a bin contains mask == 1, set whole binned mask voxel to 1
-        for k in range(shape_new[0]):
-            for i in range(shape_new[1]):
-                for j in range(shape_new[3]):
-                    msk_bin = mask_reshape[k, i, :, j, :]
-                    if 1 in msk_bin:
-                        mask_reshape[k, i, :, j, :] = 1
-
-        #Recover final, binned versions
-        cube_binned = cube_reshape.sum(-1).sum(2)
-        var_binned = var_reshape.sum(-1).sum(2)
-        mask_binned = mask_reshape.max(-1).max(2)
-
-        return cube_binned, var_binned, mask_binned
+    # Summed-area tables of each layer, giving O(1) sums for any spatial bin
+    sat_data = _get_sat(data)
+    sat_var = _get_sat(var)
+    sat_mask = _get_sat(mask != 0)
 
     # Calculate noise ratio as a function of spatial bin size
-    bin_sizes = []
-    noise_ratios = []
     if xybins is None:
         bin_grid = np.arange(1, np.min(data.shape[1:3])/5).astype(int)
 
@@ -359,32 +486,22 @@ def fit_covar_xy(fits_in, var, mask=None, wrange=None, xybins=None, n_w=10, wavg
 
     # 'z_shift' shifts these indices along by 1 each time, selecting a different
     # sub-cube made up of independent z-layers
-    for z_shift in tqdm(range(n_w)):
-        for bin_i in np.flip(bin_grid):
-
-            #Extract sub cube and sub mask
-            subcube = data[z_indices + z_shift, :, :].copy()
-            submask = mask[z_indices + z_shift, :, :].copy()
-            subvar = var[z_indices + z_shift, :, :].copy()
-
-            #Bin
-            cube_b, var_b, mask_b = resize(subcube, subvar, submask, bin_i)
-
-            #Get binary mask of useable vox (mask is dtype int)
-            use_vox = (mask_b == 0)
+    z_sets = [z_indices + z_shift for z_shift in range(n_w)]
 
-            #Skip if fewer than 10 useable voxels remain in binned cube
-            if np.count_nonzero(use_vox) < 10:
-                continue
+    bin_grid = np.flip(bin_grid)
+    jobs = [(sat_data, sat_var, sat_mask, z_sets, bin_i) for bin_i in bin_grid]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        ratio_grid = list(tqdm(executor.map(_get_noise_ratios, jobs), total=len(jobs)))
+    ratio_grid = np.array(ratio_grid).T
 
-            # Measure the error in the binned cube
-            actual_err = np.std(cube_b[use_vox])
-            propagated_err = np.sqrt(np.median(var_b[use_vox]))
-
-            # Append bin size and noise ratio to lists
-            if np.isfinite(actual_err / propagated_err):
+    # Append bin size and noise ratio to lists, skipping failed measurements
+    bin_sizes = []
+    noise_ratios = []
+    for ratios_z in ratio_grid:
+        for bin_i, ratio in zip(bin_grid, ratios_z):
+            if np.isfinite(ratio):
                 bin_sizes.append(bin_i)
-                noise_ratios.append(actual_err / propagated_err)
+                noise_ratios.append(ratio)
 
     bin_sizes = np.array(bin_sizes)
     noise_ratios = np.array(noise_ratios)
@@ -410,7 +527,8 @@ def fit_covar_xy(fits_in, var, mask=None, wrange=None, xybins=None, n_w=10, wavg
         modeling.covar_curve,
         model_bounds,
         kernel_areas,
-        noise_ratios
+        noise_ratios,
+        fallback=True
         )
     params = model_fit.x
 
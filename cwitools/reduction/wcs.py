@@ -1,13 +1,17 @@
 """Reduction tools directly related to world cooridnate system corrections."""
 
 #Standard Imports
+from concurrent.futures import ThreadPoolExecutor
+import time
 
 #Third-party Imports
 from astropy import units as u
+from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.wcs.utils import proj_plane_pixel_scales
 from scipy.interpolate import interp1d
 from scipy import ndimage
+from scipy.fft import irfft2, next_fast_len, rfft2
 from scipy.signal import correlate
 import matplotlib.pyplot as plt
 import numpy as np
@@ -131,10 +135,188 @@ def xcor_crpix3(fits_list, x_margin=2, y_margin=2):
     #Return corrections to CRPIX3 values
     return crpix3s_corr
 
+def _xcor_map_loop(img0, img1_expand, box, size, dx_grid, dy_grid, bg_subtraction=False,
+                   bg_level=None):
+    """Compute the xcor map of xcor_2d() by direct summation over all shifts."""
+    xcor = np.zeros(dx_grid.shape)
+
+    for i in range(xcor.shape[0]):
+        for j in range(xcor.shape[1]):
+
+            cut0 = img0[box[1]:box[3], box[0]:box[2]]
+            cut1 = img1_expand[
+                box[1] - dy_grid[i, j] + size[0]:box[3] - dy_grid[i, j] + size[0],
+                box[0] - dx_grid[i, j] + size[1]:box[2] - dx_grid[i, j] + size[1]
+                ]
+
+            if bg_subtraction:
+                if bg_level is None:
+                    back_val0 = np.median(cut0[cut0 != 0])
+                    back_val1 = np.median(cut1[cut1 != 0])
+                else:
+                    back_val0 = float(bg_level[0])
+                    back_val1 = float(bg_level[1])
+
+                cut0 = cut0 - back_val0
+                cut1 = cut1 - back_val1
+            else:
+                if not bg_level is None:
+                    cut0[cut0 < bg_level[0]] = 0
+                    cut1[cut1 < bg_level[1]] = 0
+
+            cut0[cut0 < 0] = 0
+            cut1[cut1 < 0] = 0
+            mult = cut0 * cut1
+
+            if np.sum(mult != 0) > 0:
+                xcor[i, j] = np.sum(mult) / np.sum(mult != 0)
+
+    return xcor
+
+def _xcor_background(img, index, bg_subtraction=False, bg_level=None):
+    """Get the background value that xcor_2d() subtracts from one image, or 0."""
+    if not bg_subtraction:
+        return 0.
+    if bg_level is None:
+        return np.median(img[img != 0])
+    return float(bg_level[index])
+
+def _xcor_clip(img, index, bg_subtraction=False, bg_level=None):
+    """Apply the background subtraction/thresholding of xcor_2d() to one image."""
+    img = img - _xcor_background(img, index, bg_subtraction=bg_subtraction,
+                                 bg_level=bg_level)
+
+    if not bg_subtraction and bg_level is not None:
+        img[img < bg_level[index]] = 0
+
+    return np.clip(img, 0, None)
+
+def _xcor_fft_shape(shape):
+    """Get the padded FFT shape needed for an alias-free correlation of two images."""
+    return [next_fast_len(2 * n - 1, real=True) for n in shape]
+
+def _xcor_ref_fft(img0, box, bg_subtraction=False, bg_level=None):
+    """Get the FFTs of the clipped reference image and its non-zero mask.
+
+    Args:
+        img0 (numpy.ndarray): The reference image.
+        box (int tuple): The [X0, Y0, X1, Y1] region of img0 to correlate.
+        bg_subtraction (bool): See xcor_2d().
+        bg_level (float tuple): See xcor_2d().
+
+    Returns:
+        numpy.ndarray: FFT of the clipped reference image.
+        numpy.ndarray: FFT of the non-zero mask of the clipped reference image.
+
+    """
+    y_0, y_1 = max(box[1], 0), min(box[3], img0.shape[0])
+    x_0, x_1 = max(box[0], 0), min(box[2], img0.shape[1])
+    fft_shape = _xcor_fft_shape(img0.shape)
+
+    img0_pos = np.zeros_like(img0)
+    img0_pos[y_0:y_1, x_0:x_1] = _xcor_clip(img0[y_0:y_1, x_0:x_1], 0,
+                                            bg_subtraction=bg_subtraction,
+                                            bg_level=bg_level)
+
+    fft_sum = rfft2(img0_pos, fft_shape)
+    fft_num = rfft2((img0_pos > 0).astype(float), fft_shape)
+
+    return fft_sum, fft_num
+
+def _xcor_map_fft(img0, img1, box, x_arr, y_arr, bg_subtraction=False, bg_level=None,
+                  ref_fft=None):
+    """Compute the xcor map of xcor_2d() with FFT correlations.
+
+    The mean product over the overlap is the correlation of the two images
+    divided by the correlation of their non-zero masks. As in the loop engine,
+    pixels beyond the edges of img1 are zeros which go through the same
+    background subtraction, so a negative background makes them positive.
+
+    Args:
+        ref_fft (tuple): Output of _xcor_ref_fft() for img0, if already known.
+            The other arguments are as in xcor_2d().
+
+    Returns:
+        numpy.ndarray: The xcor map with shape (len(x_arr), len(y_arr)).
+
+    """
+    if ref_fft is None:
+        ref_fft = _xcor_ref_fft(img0, box, bg_subtraction=bg_subtraction, bg_level=bg_level)
+
+    fft_shape = _xcor_fft_shape(img1.shape)
+    img1_pos = _xcor_clip(img1, 1, bg_subtraction=bg_subtraction, bg_level=bg_level)
+
+    xcor_sum = irfft2(ref_fft[0] * np.conj(rfft2(img1_pos, fft_shape)), fft_shape)
+    xcor_num = irfft2(
+        ref_fft[1] * np.conj(rfft2((img1_pos > 0).astype(float), fft_shape)),
+        fft_shape
+        )
+
+    # Add the products with the padding around img1, if it is non-zero
+    pad_val = -_xcor_background(img1, 1, bg_subtraction=bg_subtraction, bg_level=bg_level)
+    if pad_val > 0:
+        fft_in1 = np.conj(rfft2(np.ones(img1.shape), fft_shape))
+        xcor_sum += pad_val * (ref_fft[0][0, 0].real - irfft2(ref_fft[0] * fft_in1, fft_shape))
+        xcor_num += ref_fft[1][0, 0].real - irfft2(ref_fft[1] * fft_in1, fft_shape)
+
+    xcor_num = np.round(xcor_num)
+
+    # Shift (dx, dy) sits at (dy, dx) of the circular correlation
+    y_use = np.abs(y_arr) < img1.shape[0]
+    x_use = np.abs(x_arr) < img1.shape[1]
+    y_ind = y_arr[y_use] % fft_shape[0]
+    x_ind = x_arr[x_use] % fft_shape[1]
+
+    xcor = np.zeros((len(x_arr), len(y_arr)))
+    xcor_sum = xcor_sum[np.ix_(y_ind, x_ind)].T
+    xcor_num = xcor_num[np.ix_(y_ind, x_ind)].T
+    xcor[np.ix_(x_use, y_use)] = np.divide(
+        xcor_sum, xcor_num,
+        out=np.zeros_like(xcor_sum),
+        where=xcor_num > 0
+        )
+
+    return xcor
+
+def _refine_peak(xcor, i, j, size=1):
+    """Get the sub-pixel offset of a peak in a 2D map from a local paraboloid fit.
+
+    Args:
+        xcor (numpy.ndarray): The 2D map.
+        i (int): Index of the peak along axis 0.
+        j (int): Index of the peak along axis 1.
+        size (int): Half-width of the fitted neighbourhood, in pixels.
+
+    Returns:
+        float: Offset of the peak along axis 0, within +/- size.
+        float: Offset of the peak along axis 1, within +/- size.
+
+    """
+    if (i < size or j < size or i >= xcor.shape[0] - size or j >= xcor.shape[1] - size):
+        return 0., 0.
+
+    d_arr = np.arange(-size, size + 1)
+    d_i, d_j = np.meshgrid(d_arr, d_arr, indexing='ij')
+    d_i, d_j = d_i.ravel(), d_j.ravel()
+    design = np.array([np.ones_like(d_i), d_i, d_j, d_i**2, d_i * d_j, d_j**2]).T
+    patch = xcor[i - size:i + size + 1, j - size:j + size + 1]
+    coeff = np.linalg.lstsq(design, patch.ravel(), rcond=None)[0]
+
+    # Vertex of the paraboloid; only accept a maximum
+    hess = np.array([[2 * coeff[3], coeff[4]], [coeff[4], 2 * coeff[5]]])
+    if hess[0, 0] >= 0 or np.linalg.det(hess) <= 0:
+        return 0., 0.
+
+    offset = np.linalg.solve(hess, -coeff[1:3])
+    if np.any(np.abs(offset) > size):
+        return 0., 0.
+
+    return float(offset[0]), float(offset[1])
+
 def xcor_2d(hdu0_in, hdu1_in, crval=None, crpix=None, maxstep=None, box=None,
             upscale=1, conv_filter=2., bg_subtraction=False,
             bg_level=None, reset_center=False, method='interp-bicubic',
-            output_flag=False, plot=0):
+            engine='fft', subpixel=False, ref_cache=None, output_flag=False, plot=0):
     """Perform 2D cross correlation to image HDUs and returns the relative shifts.
 
     This function is the base of xcor_crpix12() for frame alignment.
@@ -163,6 +345,18 @@ def xcor_2d(hdu0_in, hdu1_in, crval=None, crpix=None, maxstep=None, box=None,
                 "interp-bilinear"
                 "interp-bicubic" (Default)
                 "exact"
+        engine (str): How to compute the xcor map.
+            Supported values:
+                "fft" (Default) - FFT correlation of the whole image pair. The
+                    background, if subtracted, is measured once per image
+                    rather than once per trial shift.
+                "loop" - Direct sum over every trial shift.
+        subpixel (bool): Refine the selected peak by fitting a paraboloid to
+            its neighbourhood, of half-width "conv_filter", in the xcor map.
+            This gives sub-pixel shifts without the need for a large "upscale".
+        ref_cache (dict): Store for the scaled reference image and its FFTs.
+            Pass the same dict to repeated calls with the same hdu0_in, box,
+            method and background settings to only compute these once.
         output_flag (bool): If set return [xshift, yshift, flag] even if the
             program failed to locate a local maximum (flag = 0). Otherwise,
             return [xshift, yshift] only if a  local maximum if found.
@@ -234,7 +428,12 @@ def xcor_2d(hdu0_in, hdu1_in, crval=None, crpix=None, maxstep=None, box=None,
     wcs0 = WCS(hdu0.header)
     wcs1 = WCS(hdu1.header)
 
-    hdu0 = coordinates.scale_hdu(hdu0, upscale, reproject_mode=method)
+    # The scaled reference and its FFTs only depend on the reference itself
+    if ref_cache is None:
+        ref_cache = {}
+    if ('hdu', upscale) not in ref_cache:
+        ref_cache[('hdu', upscale)] = coordinates.scale_hdu(hdu0, upscale, reproject_mode=method)
+    hdu0 = ref_cache[('hdu', upscale)]
     hdu1 = coordinates.scale_hdu(hdu1, upscale, reproject_mode=method)
 
     # project 1 to 0
@@ -255,40 +454,22 @@ def xcor_2d(hdu0_in, hdu1_in, crval=None, crpix=None, maxstep=None, box=None,
     y_arr = np.linspace(-xcor_size[1], xcor_size[1], 2 * xcor_size[1] + 1, dtype=int)
     dy_grid, dx_grid = np.meshgrid(y_arr, x_arr)
 
-    xcor = np.zeros(dx_grid.shape)
     box_sc = [b * upscale for b in box]
     box_sc = np.array(box_sc).astype(int)
 
-    for i in range(xcor.shape[0]):
-        for j in range(xcor.shape[1]):
-
-            cut0 = img0[box_sc[1]:box_sc[3], box_sc[0]:box_sc[2]]
-            cut1 = img1_expand[
-                box_sc[1] - dy_grid[i, j] + sz0_sc[0]:box_sc[3] - dy_grid[i, j] + sz0_sc[0],
-                box_sc[0] - dx_grid[i, j] + sz0_sc[1]:box_sc[2] - dx_grid[i, j] + sz0_sc[1]
-                ]
-
-            if bg_subtraction:
-                if bg_level is None:
-                    back_val0 = np.median(cut0[cut0 != 0])
-                    back_val1 = np.median(cut1[cut1 != 0])
-                else:
-                    back_val0 = float(bg_level[0])
-                    back_val1 = float(bg_level[1])
-
-                cut0 = cut0 - back_val0
-                cut1 = cut1 - back_val1
-            else:
-                if not bg_level is None:
-                    cut0[cut0 < bg_level[0]] = 0
-                    cut1[cut1 < bg_level[1]] = 0
-
-            cut0[cut0 < 0] = 0
-            cut1[cut1 < 0] = 0
-            mult = cut0 * cut1
-
-            if np.sum(mult != 0) > 0:
-                xcor[i, j] = np.sum(mult) / np.sum(mult != 0)
+    if engine == 'fft':
+        fft_key = ('fft', upscale, tuple(box_sc))
+        if fft_key not in ref_cache:
+            ref_cache[fft_key] = _xcor_ref_fft(img0, box_sc, bg_subtraction=bg_subtraction,
+                                               bg_level=bg_level)
+        xcor = _xcor_map_fft(img0, img1, box_sc, x_arr, y_arr,
+                             bg_subtraction=bg_subtraction, bg_level=bg_level,
+                             ref_fft=ref_cache[fft_key])
+    elif engine == 'loop':
+        xcor = _xcor_map_loop(img0, img1_expand, box_sc, sz0_sc, dx_grid, dy_grid,
+                              bg_subtraction=bg_subtraction, bg_level=bg_level)
+    else:
+        raise ValueError("engine can only be 'fft' or 'loop'")
 
     # local maxima
     max_conv = ndimage.filters.maximum_filter(xcor, 2 * conv_filter + 1)
@@ -391,8 +572,13 @@ def xcor_2d(hdu0_in, hdu1_in, crval=None, crpix=None, maxstep=None, box=None,
         raise ValueError('Unable to find local maximum in the XCOR map.')
 
     index = (x_arr[xindex]**2 + y_arr[yindex]**2).argmin()
-    xshift = x_arr[xindex[index]] / upscale
-    yshift = y_arr[yindex[index]] / upscale
+    if subpixel:
+        x_sub, y_sub = _refine_peak(xcor, xindex[index], yindex[index],
+                                    size=max(int(conv_filter), 1))
+    else:
+        x_sub, y_sub = 0., 0.
+    xshift = (x_arr[xindex[index]] + x_sub) / upscale
+    yshift = (y_arr[yindex[index]] + y_sub) / upscale
 
     hdu1 = coordinates.scale_hdu(hdu1, 1 / upscale, header_only=True)
     hdu0 = coordinates.scale_hdu(hdu0, 1 / upscale, header_only=True)
@@ -446,7 +632,7 @@ def xcor_2d(hdu0_in, hdu1_in, crval=None, crpix=None, maxstep=None, box=None,
 def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None, box_size=None,
                  crpix=None, pixscale=None, orientation=None, dimension=None, upscale=10.,
                  conv_filter=2., bg_subtraction=False, bg_level=None, reset_center=False,
-                 method='interp-bicubic', plot=1):
+                 method='interp-bicubic', engine='fft', subpixel=False, plot=1):
     """Use cross-correlation to measure the values of CRPIX1/2 and CRVAL1/2.
 
     This function is a wrapper of xcor_2d() to optimize the reduction process.
@@ -484,6 +670,10 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
             the same as HDU0.
         method (str): Sampling method for sub-pixel interpolations. Supported values:
             "interp-nearest", "interp-bilinear", "inter-bicubic" (Default), "exact".
+        engine (str): How to compute the xcor map, "fft" (Default) or "loop".
+            See xcor_2d().
+        subpixel (bool): Refine the shifts of the 2nd iteration with a paraboloid
+            fit to the xcor peak. With this set, "upscale" can be reduced to 1.
         plot (int): Make plots?
             0 - No plot.
             1 - Only the xcor map.
@@ -520,6 +710,188 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
     hdu_img, _ = synthesis.whitelight(hdu, wmask=wmask, mask_sky=True)
     hdu_img_ref, _ = synthesis.whitelight(hdu_ref, wmask=wmask, mask_sky=True)
 
+    hdu_img_ref0, box = _xcor_reference(
+        hdu_img,
+        hdu_img_ref,
+        ra=ra,
+        dec=dec,
+        box_size=box_size,
+        pixscale=pixscale,
+        orientation=orientation,
+        dimension=dimension
+        )
+
+    # CRs
+    if crpix is not None:
+        if ra is None or dec is None:
+            raise ValueError("'ra' and 'dec' must be provided if 'crpix' is set")
+        crval = [ra, dec]
+    else:
+        crval = None
+
+    return _xcor_crpix12_iter(
+        hdu_img,
+        hdu_img_ref0,
+        crval=crval,
+        crpix=crpix,
+        maxstep=maxstep,
+        box=box,
+        upscale=upscale,
+        conv_filter=conv_filter,
+        bg_subtraction=bg_subtraction,
+        bg_level=bg_level,
+        reset_center=reset_center,
+        method=method,
+        engine=engine,
+        subpixel=subpixel,
+        plot=plot
+        )
+
+def xcor_crpix12_batch(fits_list, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
+                       box_size=None, crpix=None, pixscale=None, orientation=None,
+                       dimension=None, upscale=10., conv_filter=2., bg_subtraction=False,
+                       bg_level=None, reset_center=False, method='interp-bicubic',
+                       engine='fft', subpixel=False, n_workers=1, plot=0):
+    """Use cross-correlation to measure CRPIX1/2 and CRVAL1/2 for a list of cubes.
+
+    Batch version of xcor_crpix12(). The reference white-light image, its
+    projection onto the uniform grid and its FFTs are computed only once. The
+    white-light images of the inputs are made by a pool of worker threads while
+    earlier frames are being cross-correlated.
+
+    Args:
+        fits_list (list): Input HDU/HDUList with 3D data, or paths to FITS files,
+            to be shifted. Files are only opened when their white-light image
+            is made.
+        fits_ref (astropy HDU / HDUList / str): Input with 3D data as reference.
+        crpix (list): List of (X, Y) reference pixels, one per input, to reset the
+            initial pointing. Use None for inputs which should not be reset.
+        pixscale (float tuple): Size of pixels in X and Y in arcsec of the reference grid.
+            Default is the smallest size between X and Y of "fits_ref".
+        n_workers (int): Number of threads used to make the white-light images.
+        See xcor_crpix12() for the other arguments.
+
+    Returns:
+        astropy.io.fits.TableHDU: Table with one row per input and columns
+            'crpix1', 'crpix2', 'crval1', 'crval2', 'flag' (1 if successful,
+            0 if the cross-correlation failed and the header values were kept),
+            't_wl' and 't_xcor' (time in seconds spent on the white-light image
+            and on the cross-correlation).
+
+    """
+
+    if crpix is None:
+        crpix = [None] * len(fits_list)
+    elif len(crpix) != len(fits_list):
+        raise ValueError("'crpix' must have one entry per input")
+
+    if any(c is not None for c in crpix) and (ra is None or dec is None):
+        raise ValueError("'ra' and 'dec' must be provided if 'crpix' is set")
+
+    hdu_img_ref, _ = _get_xcor_image((fits_ref, wmask))
+    hdu_img_ref0, box = _xcor_reference(
+        hdu_img_ref,
+        hdu_img_ref,
+        ra=ra,
+        dec=dec,
+        box_size=box_size,
+        pixscale=pixscale,
+        orientation=orientation,
+        dimension=dimension
+        )
+
+    ref_cache = {}
+    results = np.zeros((len(fits_list), 7))
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+
+        images = executor.map(_get_xcor_image, [(f, wmask) for f in fits_list])
+
+        for i, (hdu_img, t_wl) in enumerate(images):
+
+            tstart = time.time()
+            try:
+                results[i, :4] = _xcor_crpix12_iter(
+                    hdu_img,
+                    hdu_img_ref0,
+                    crval=None if crpix[i] is None else [ra, dec],
+                    crpix=crpix[i],
+                    maxstep=maxstep,
+                    box=box,
+                    upscale=upscale,
+                    conv_filter=conv_filter,
+                    bg_subtraction=bg_subtraction,
+                    bg_level=bg_level,
+                    reset_center=reset_center,
+                    method=method,
+                    engine=engine,
+                    subpixel=subpixel,
+                    ref_cache=ref_cache,
+                    plot=plot
+                    )
+                results[i, 4] = 1
+            except ValueError:
+                utils.output("\tWARNING: Cross-correlation failed for input %i. "\
+                             "Header values kept.\n" % i)
+                results[i, :4] = [hdu_img.header[key] for key in
+                                  ['CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2']]
+
+            results[i, 5] = t_wl
+            results[i, 6] = time.time() - tstart
+            utils.output("\t\tInput %i: white-light %.2fs, xcor %.2fs\n" %
+                         (i, results[i, 5], results[i, 6]))
+
+    columns = [
+        fits.Column(name=name, format='D', array=results[:, i], unit=unit)
+        for i, (name, unit) in enumerate([
+            ('crpix1', 'pix'), ('crpix2', 'pix'), ('crval1', 'deg'), ('crval2', 'deg')
+            ])
+        ]
+    columns.append(fits.Column(name='flag', format='I', array=results[:, 4].astype(int)))
+    columns.append(fits.Column(name='t_wl', format='D', array=results[:, 5], unit='s'))
+    columns.append(fits.Column(name='t_xcor', format='D', array=results[:, 6], unit='s'))
+    table_hdu = fits.TableHDU.from_columns(columns)
+    return table_hdu
+
+def _get_xcor_image(args):
+    """Make the white-light image of a cube for xcor_crpix12_batch().
+
+    Args:
+        args (tuple): The input cube (HDU/HDUList or path) and the wmask.
+
+    Returns:
+        astropy HDU: The white-light image.
+        float: The time taken, in seconds.
+
+    """
+    fits_in, wmask = args
+    tstart = time.time()
+
+    if isinstance(fits_in, str):
+        with fits.open(fits_in) as hdul:
+            hdu_img, _ = synthesis.whitelight(hdul[0], wmask=wmask, mask_sky=True)
+    else:
+        hdu_img, _ = synthesis.whitelight(utils.extract_hdu(fits_in), wmask=wmask,
+                                          mask_sky=True)
+
+    return hdu_img, time.time() - tstart
+
+def _xcor_reference(hdu_img, hdu_img_ref, ra=None, dec=None, box_size=None, pixscale=None,
+                    orientation=None, dimension=None):
+    """Project a reference white-light image onto the uniform grid used by xcor_crpix12().
+
+    Args:
+        hdu_img (astropy HDU): White-light image to be aligned, used for the
+            default pixel scale.
+        hdu_img_ref (astropy HDU): Reference white-light image.
+        The other arguments are as in xcor_crpix12().
+
+    Returns:
+        astropy HDU: The projected reference image.
+        list: The [X0, Y0, X1, Y1] box to cross-correlate, or None.
+
+    """
+
     ### CHANGED - Use Astropy to get pixel sizes
     wcs = WCS(hdu_img.header)
     pixel_scales = proj_plane_pixel_scales(wcs)
@@ -534,8 +906,8 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
 
     # Post projection image size
     if dimension is None:
-        d_x = int(np.round(ps_x * hdu_ref.shape[2] / pixscale_x))
-        d_y = int(np.round(ps_y * hdu_ref.shape[1] / pixscale_y))
+        d_x = int(np.round(ps_x * hdu_img_ref.shape[1] / pixscale_x))
+        d_y = int(np.round(ps_y * hdu_img_ref.shape[0] / pixscale_y))
         dimension = [d_x, d_y]
 
     # Construct WCS for the reference HDU in uniform grid
@@ -592,13 +964,29 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
     else:
         box = None
 
-    # CRs
-    if crpix is not None:
-        if ra is None or dec is None:
-            raise ValueError("'ra' and 'dec' must be provided if 'crpix' is set")
-        crval = [ra, dec]
-    else:
-        crval = None
+    return hdu_img_ref0, box
+
+def _xcor_crpix12_iter(hdu_img, hdu_img_ref0, crval=None, crpix=None, maxstep=None, box=None,
+                       upscale=10., conv_filter=2., bg_subtraction=False, bg_level=None,
+                       reset_center=False, method='interp-bicubic', engine='fft',
+                       subpixel=False, ref_cache=None, plot=1):
+    """Run the two xcor_2d() iterations of xcor_crpix12() on white-light images.
+
+    Args:
+        hdu_img (astropy HDU): White-light image to be aligned.
+        hdu_img_ref0 (astropy HDU): Reference image from _xcor_reference().
+        ref_cache (dict): See xcor_2d().
+        The other arguments are as in xcor_crpix12().
+
+    Returns:
+        crpix1 (float): True value of CRPIX1.
+        crpix2 (float): True value of CRPIX2.
+        crval1 (float): True value of CRVAL1
+        crval2 (float): True value of CRVAL2
+
+    """
+    if ref_cache is None:
+        ref_cache = {}
 
     # First iteration
     crpix1_tmp, crpix2_tmp, crval1_tmp, crval2_tmp, flag = xcor_2d(
@@ -614,13 +1002,15 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
         bg_level=bg_level,
         reset_center=reset_center,
         method=method,
+        engine=engine,
+        ref_cache=ref_cache,
         output_flag=True,
         plot=plot
         )
     if not flag:
         if not reset_center:
             utils.output('\tFirst attempt failed. Trying to recenter\n')
-            crpix1_tmp, crpix2_tmp, crval1_tmp, crval2_tmp = xcor_2d(
+            crpix1_tmp, crpix2_tmp, crval1_tmp, crval2_tmp, flag = xcor_2d(
                 hdu_img_ref0,
                 hdu_img,
                 crval=crval,
@@ -633,10 +1023,12 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
                 bg_level=bg_level,
                 reset_center=True,
                 method=method,
+                engine=engine,
+                ref_cache=ref_cache,
                 output_flag=True,
                 plot=plot
                 )
-        else:
+        if not flag:
             raise ValueError('Unable to find local maximum in the XCOR map.')
 
     utils.output('\tFirst iteration:\n')
@@ -655,6 +1047,9 @@ def xcor_crpix12(fits_in, fits_ref, wmask=None, maxstep=None, ra=None, dec=None,
         bg_subtraction=bg_subtraction,
         bg_level=bg_level,
         method=method,
+        engine=engine,
+        subpixel=subpixel,
+        ref_cache=ref_cache,
         plot=plot
         )
 
@@ -748,9 +1143,11 @@ def fit_crpix12(fits_in, crval1, crval2, box_size=10, plot=False, std_max=4, crp
         (0, std_max / y_scale)
         ]
 
-    #Run differential evolution fit on each profile
-    x_fit = modeling.fit_model1d(modeling.gauss1d, x_bounds, x_domain, x_prof)
-    y_fit = modeling.fit_model1d(modeling.gauss1d, y_bounds, y_domain, y_prof)
+    #Fit each profile, retrying with differential evolution if the fit fails
+    x_fit = modeling.fit_model1d(modeling.gauss1d, x_bounds, x_domain, x_prof,
+                                   fallback=True)
+    y_fit = modeling.fit_model1d(modeling.gauss1d, y_bounds, y_domain, y_prof,
+                                   fallback=True)
 
     x_center, y_center = x_fit.x[1], y_fit.x[1]
 
@@ -862,7 +1259,8 @@ def fit_crpix3(fits_in, crval3, crpix3_init=None, window=20, plot=False):
         modeling.gauss1d,
         gauss_bounds,
         pix_axis[fit_mask],
-        sky_spec[fit_mask]
+        sky_spec[fit_mask],
+        fallback=True
         )
 
     if plot:
@@ -85,6 +85,13 @@ def parser_init():
         help='Minimum wavelength scale step-size (Default:0.5px)',
         default=0.2
         )
+    parser.add_argument(
+        '-nproc',
+        type=int,
+        metavar='<int>',
+        help='Number of threads to use for smoothing (Default:1)',
+        default=1
+        )
     parser.add_argument(
         '-log',
         metavar="<log_file>",
@@ -100,8 +107,8 @@ def parser_init():
     return parser
 
 def asmooth(int_path, var_path, snr_min=3, snr_max=None, xy_mode='gaussian', z_mode='box',
-            xy_range=(1.5, 8.0), z_range=(1.5, 6.0), xy_step_min=0.5, z_step_min=0.5, log=None,
-            silent=False):
+            xy_range=(1.5, 8.0), z_range=(1.5, 6.0), xy_step_min=0.5, z_step_min=0.5, nproc=1,
+            log=None, silent=False):
     """Perform adaptive kernel smoothing on data.
 
     3D Algorithm based on 2D algorithm by Ebeling, White & Ranjaran 2006. This 3D algorithm has not
@@ -123,6 +130,8 @@ def asmooth(int_path, var_path, snr_min=3, snr_max=None, xy_mode='gaussian', z_m
         z_range (float tuple): Range of smoothing scales to use for z-axis
         xy_step_min (float): Minimum step size to use for increasing spatial kernel size
         z_step_min (float): Minimum step size to use for increasing wavelength kernel size
+        nproc (int): Number of threads over which to distribute the smoothing of
+            wavelength slabs.
 
     Returns:
          numpy.ndarray: adaptively smoothed intensity cube
@@ -149,6 +158,7 @@ def asmooth(int_path, var_path, snr_min=3, snr_max=None, xy_mode='gaussian', z_m
         z_range=z_range,
         xy_step_min=xy_step_min,
         z_step_min=z_step_min,
+        n_workers=nproc
     )
 
     icube_det_out = int_path.replace(".fits", ".AKS.fits")
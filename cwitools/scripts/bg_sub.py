@@ -55,6 +55,13 @@ def parser_init():
         help='Size of median window (if using median filtering method).',
         default=31
         )
+    parser.add_argument(
+        '-nproc',
+        metavar="<int>",
+        type=int,
+        help='Number of threads to use (if using median filtering method).',
+        default=1
+        )
     parser.add_argument(
         '-wmask',
         metavar='<w0:w1>',
@@ -131,7 +138,7 @@ def parser_init():
     return parser
 
 def bg_sub(cube, clist=None, var=None, method='polyfit', poly_k=3, med_window=31,
-           wmask=None, mask_neb_z=None, mask_neb_dv=None, mask_sky=False, mask_sky_dw=None,
+           nproc=1, wmask=None, mask_neb_z=None, mask_neb_dv=None, mask_sky=False, mask_sky_dw=None,
            mask_reg=None, save_model=False, ext=".bs.fits", outdir=None, log=None, silent=None):
     """Subtract background signal from a data cube
 
@@ -148,6 +155,8 @@ def bg_sub(cube, clist=None, var=None, method='polyfit', poly_k=3, med_window=31
             'noiseFit': Model noise in each z-layer and subtract mean.
         poly_k (int): The degree of polynomial to use for background modeling.
         med_window (int): The filter window size to use if median filtering.
+            Must be odd.
+        nproc (int): Number of threads to use if median filtering.
         wmask (list): List of wavelength ranges to exclude from model-fitting,
             provided as a list of float-like tuples e.g. [(4100,4200), (5100,5200)]
         mask_neb_z (float): Redshift of nebular emission to auto-mask.
@@ -239,7 +248,8 @@ def bg_sub(cube, clist=None, var=None, method='polyfit', poly_k=3, med_window=31
             median_window=med_window,
             wmasks=wmask,
             mask_reg=mask_reg,
-            var=var_cube
+            var=var_cube,
+            n_workers=nproc
         )
 
         if var is None:
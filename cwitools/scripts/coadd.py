@@ -67,6 +67,40 @@ def parser_init():
         help='Position Angle of output frame.',
         default=0
         )
+    parser.add_argument(
+        '-cache_dir',
+        metavar="<dir>",
+        type=str,
+        help='Directory in which to cache pixel overlap weights between runs.',
+        default=None
+        )
+    parser.add_argument(
+        '-cache_size',
+        metavar="<MB>",
+        type=float,
+        help='Maximum size of the weights cache in MB.',
+        default=500
+        )
+    parser.add_argument(
+        '-mem_limit',
+        metavar="<MB>",
+        type=float,
+        help='Memory budget in MB. If set, inputs are streamed from disk in\
+        wavelength blocks and the coadd is built in temporary files.',
+        default=None
+        )
+    parser.add_argument(
+        '-nproc',
+        metavar="<int>",
+        type=int,
+        help='Number of processes to use for projecting exposures.',
+        default=1
+        )
+    parser.add_argument(
+        '-float32',
+        help='Align and project input cubes in single precision to save memory.',
+        action='store_true'
+        )
     parser.add_argument(
         '-out',
         metavar="<file_out>",
@@ -94,7 +128,8 @@ def parser_init():
     return parser
 
 def coadd(clist, ctype=None, masks=None, var=None, px_thresh=0.5, exp_thresh=0.75,
-          drizzle=1.0, pa=0, out=None, verbose=False, log=None, silent=None):
+          drizzle=1.0, pa=0, cache_dir=None, cache_size=500, mem_limit=None, nproc=1,
+          float32=False, out=None, verbose=False, log=None, silent=None):
     """Coadd a list of 3D FITS cubes together.
 
     Args:
@@ -124,6 +159,15 @@ def coadd(clist, ctype=None, masks=None, var=None, px_thresh=0.5, exp_thresh=0.7
         drizzle (float): The drizzle factor to use, as a fraction of pixels size.
             E.g. 0.2 will shrink input pixels by 20%.
         pa (float): The desired position-angle of the output data.
+        cache_dir (str): Directory in which to cache pixel overlap weights, so
+            that re-running with the same WCS but different masks, variance or
+            thresholds skips the re-projection.
+        cache_size (float): Maximum size of the weights cache in MB.
+        mem_limit (float): Memory budget in MB. If set, the coadd is streamed
+            from disk one input and one wavelength block at a time.
+        nproc (int): Number of processes to use. Each exposure is projected
+            onto the coadd grid in a separate process.
+        float32 (bool): Store aligned input cubes in single precision.
         out (str): The output filename for the coadd.
         verbose (bool): Set to TRUE to display progress bar and extra info.
         log (str): The path to a log file to save output to (default: None)
@@ -174,7 +218,12 @@ def coadd(clist, ctype=None, masks=None, var=None, px_thresh=0.5, exp_thresh=0.7
         exp_thresh=exp_thresh,
         pos_ang=pa,
         verbose=verbose,
-        drizzle=drizzle
+        drizzle=drizzle,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        mem_limit=mem_limit,
+        n_workers=nproc,
+        float32=float32
     )
 
     if var is not None:
@@ -71,6 +71,13 @@ def parser_init():
         help='Object mask - use to remove 3D objects.',
         default=None
         )
+    parser.add_argument(
+        '-nproc',
+        metavar="<int>",
+        type=int,
+        help='Number of threads to use when measuring the bin sizes.',
+        default=1
+        )
     parser.add_argument(
         '-plot',
         help="Set flag to display plot of fit.",
@@ -91,7 +98,7 @@ def parser_init():
     return parser
 
 def fit_covar(cube, var, xybins=None, wrange=None, alpha_bounds=None, norm_bounds=None,
-              thresh_bounds=None, mask_sky=False, obj=None, plot=False,
+              thresh_bounds=None, mask_sky=False, obj=None, nproc=1, plot=False,
               log=None, silent=None):
     """Fit covariance calibration curve given 3D data and variance.
 
@@ -108,6 +115,7 @@ def fit_covar(cube, var, xybins=None, wrange=None, alpha_bounds=None, norm_bound
             that separates the logarithmic/flat model regimes.
         mask_sky (bool): Set to TRUE to auto-mask sky lines
         obj (str): Path to FITS containing 3D object mask of regions to exclude.
+        nproc (int): Number of threads to use when measuring the bin sizes.
         plot (bool): Set to True to show diagnostic plots.
         log (str): Path to log file to save output to.
         silent (bool): Set to TRUE to suppress standard output.
@@ -146,7 +154,8 @@ def fit_covar(cube, var, xybins=None, wrange=None, alpha_bounds=None, norm_bound
         wrange=wrange,
         plot=plot,
         return_all=True,
-        xybins=xybins
+        xybins=xybins,
+        n_workers=nproc
     )
 
     utils.output("\t%10s%10s\n" % ("BinArea", "Ratio"))
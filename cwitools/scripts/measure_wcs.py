@@ -95,6 +95,18 @@ def parser_init():
         help="The type of cube to load for the sky spectrum, if using 'xcor' or 'fit' for zmode.\
         Default is to replace 'icube' with 'scube' for the main input type"
         )
+    parser.add_argument(
+        '-subpixel',
+        help="Refine xcor shifts with a sub-pixel peak fit instead of upsampling the images.",
+        action='store_true'
+        )
+    parser.add_argument(
+        '-nproc',
+        metavar="<int>",
+        type=int,
+        help="Number of threads to use to make white-light images, if using '-xymode xcor'.",
+        default=1
+        )
     parser.add_argument(
         '-plot',
         help="Display fits with Matplotlib.",
@@ -121,7 +133,8 @@ def parser_init():
 
 def measure_wcs(clist, ctype="icubes.fits", xymode='none', radec=None, box=10.0,
                 crpix1s=None, crpix2s=None, background_sub=False, zmode='none', crval3=None,
-                zwindow=20, sky_type=None, plot=False, out=None, log=None, silent=None):
+                zwindow=20, sky_type=None, subpixel=False, nproc=1, plot=False, out=None,
+                log=None, silent=None):
     """Automatically create a WCS correction table for a list of input cubes.
 
     Args:
@@ -150,6 +163,10 @@ def measure_wcs(clist, ctype="icubes.fits", xymode='none', radec=None, box=10.0,
         zwindow (float): If using zmode='fit', the window-size [Angstrom] to use when fitting
             the sky emission line. Default is 20A (i.e. +/- 10A)
         sky_type (str): The type of cube to load for the sky spectrum (e.g. scubes.fits)
+        subpixel (bool): Set to TRUE to measure sub-pixel shifts from a fit to the
+            cross-correlation peak instead of upsampling the images 10x, if using xymode=xcor.
+        nproc (int): Number of threads to use to make the white-light images, if
+            using xymode=xcor.
         plot (bool): Set to TRUE to show diagnostic plots.
         out (str): File extension to use for masked FITS (".M.fits")
         log (str): Path to log file to save output to.
@@ -266,10 +283,35 @@ def measure_wcs(clist, ctype="icubes.fits", xymode='none', radec=None, box=10.0,
             raise ValueError("'crpix1s' and 'crpix2s' must be set together")
         utils.output("\tCross-correlating in 2D...\n")
 
+        #If CRPIX1s given, and current value is not 'Header' indicator
+        crpix_list = []
+        for i in range(len(in_files)):
+            if crpix1s is not None and crpix1s[i] != 'H' and crpix2s[i] != 'H':
+                crpix_list.append([float(crpix1s[i]), float(crpix2s[i])])
+            else:
+                crpix_list.append(None)
+
+        # Use the first input as the reference image
+        xcor_table = reduction.wcs.xcor_crpix12_batch(
+            in_files[1:],
+            in_files[0],
+            ra=None if radec is None else radec[0],
+            dec=None if radec is None else radec[1],
+            crpix=crpix_list[1:],
+            bg_subtraction=background_sub,
+            box_size=None if radec is None else box,
+            upscale=1 if subpixel else 10,
+            subpixel=subpixel,
+            n_workers=nproc,
+            plot=int(plot)*2
+            )
+
     #SPATIAL ALIGNMENT
+    xcor_failed = []
     for i, i_f in enumerate(int_fits):
 
         hdr = i_f[0].header
+        row_note = ""
 
         if xymode == "src_fit":
             crval1, crval2 = radec[0], radec[1]
@@ -290,12 +332,6 @@ def measure_wcs(clist, ctype="icubes.fits", xymode='none', radec=None, box=10.0,
         #SPATIAL ALIGNMENT  - XCOR
         elif xymode == "xcor":
 
-            #If CRPIX1s given, and current value is not 'Header' indicator
-            if crpix1s is not None and crpix1s[i] != 'H' and crpix2s[i] != 'H':
-                crpix = [float(crpix1s[i]), float(crpix2s[i])]
-            else:
-                crpix = None
-
             # Use i=0  as the reference image
             if i == 0:
 
@@ -309,22 +345,20 @@ def measure_wcs(clist, ctype="icubes.fits", xymode='none', radec=None, box=10.0,
                     crpix1, crpix2 = hdr['CRPIX1'], hdr['CRPIX2']
                     crval1, crval2 = hdr['CRVAL1'], hdr['CRVAL2']
 
-                ref_fits = i_f
+                t_frame = ""
 
             else:
-                crpix1, crpix2, crval1, crval2 = reduction.wcs.xcor_crpix12(
-                    i_f,
-                    ref_fits,
-                    ra=radec[0],
-                    dec=radec[1],
-                    crpix=crpix,
-                    bg_subtraction=background_sub,
-                    plot=int(plot)*2,
-                    box_size=box
-                )
-
-            istring = "\t\t{0}: {1:.2f}, {2:.1f}, {3:.4f}, {4:.4f}\n".format(
-                cdict["ID_LIST"][i], crpix1, crpix2, crval1, crval2)
+                row = xcor_table.data[i - 1]
+                crpix1, crpix2 = row['crpix1'], row['crpix2']
+                crval1, crval2 = row['crval1'], row['crval2']
+                t_frame = " ({0:.2f}s)".format(row['t_wl'] + row['t_xcor'])
+                if not row['flag']:
+                    xcor_failed.append(str(cdict["ID_LIST"][i]))
+                    t_frame += " FAILED - header values kept"
+                    row_note = " # xcor failed, header values kept"
+
+            istring = "\t\t{0}: {1:.2f}, {2:.1f}, {3:.4f}, {4:.4f}{5}\n".format(
+                cdict["ID_LIST"][i], crpix1, crpix2, crval1, crval2, t_frame)
             utils.output(istring)
 
 
@@ -338,8 +372,14 @@ def measure_wcs(clist, ctype="icubes.fits", xymode='none', radec=None, box=10.0,
         else:
             raise ValueError("xymode can only be 'none', 'src_fit', or 'xcor'")
 
-        outstr += ">%19s %15.7f %15.7f %10.3f %10.1f %10.1f %10.1f\n" % (
-            cdict["ID_LIST"][i], crval1, crval2, crval3s[i], crpix1, crpix2, crpix3s[i])
+        outstr += ">%19s %15.7f %15.7f %10.3f %10.1f %10.1f %10.1f%s\n" % (
+            cdict["ID_LIST"][i], crval1, crval2, crval3s[i], crpix1, crpix2, crpix3s[i],
+            row_note)
+
+    if xcor_failed:
+        utils.output("\n\tWARNING: Cross-correlation failed for %i input(s), which keep "\
+                     "their header values:\n\t\t%s\n" % (len(xcor_failed),
+                                                        ", ".join(xcor_failed)))
 
     if out is None:
         outfilename = clist.replace(".list", ".wcs")
@@ -85,6 +85,13 @@ def parser_init():
         help='Min/max blue-peak to red-peak ratio for doublet fitting.',
         default=(0.5, 2.0)
     )
+    parser.add_argument(
+        '-nproc',
+        metavar="<int>",
+        type=int,
+        help='Number of processes used to re-fit spaxels which do not converge.',
+        default=1
+    )
     parser.add_argument(
         '-label',
         metavar="<e.g. LyA>",
@@ -107,7 +114,8 @@ def parser_init():
     return parser
 
 def obj_zfit(cube, obj, peak_wav, obj_id=1, var=None, unit='wav', redshift=0, vel_max=2000,
-             disp_bounds=(50, 500), ratio_bounds=(0.5, 2.0), label=None, log=None, silent=None):
+             disp_bounds=(50, 500), ratio_bounds=(0.5, 2.0), nproc=1, label=None, log=None,
+             silent=None):
     """Create 2D maps of velocity and dispersion.
 
     Args:
@@ -131,6 +139,8 @@ def obj_zfit(cube, obj, peak_wav, obj_id=1, var=None, unit='wav', redshift=0, ve
             the two components in a doublet fit are tied together.
         ratio_bounds (float tuple): For doublet fits only - the min/max ratio between the blue peak
             and the red peak.
+        nproc (int): Number of processes used to re-fit spaxels for which the
+            batched line fit does not converge.
         label (str): Custom label for output file name, which will add .<label>_m1.fits to the
             input file name for the first moment map. e.g. provide "LyA" to get ".LyA_m1.fits",
             ".LyA_m2.fits" and so on. By default, the label will "objXX" where XX is the objID for
@@ -176,7 +186,8 @@ def obj_zfit(cube, obj, peak_wav, obj_id=1, var=None, unit='wav', redshift=0, ve
         disp_bounds=disp_bounds,
         ratio_bounds=ratio_bounds,
         unit=unit,
-        var=var_cube
+        var=var_cube,
+        n_workers=nproc
     )
 
     if label is None:
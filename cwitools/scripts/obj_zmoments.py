@@ -59,6 +59,13 @@ def parser_init():
         choices=['kms', 'wav'],
         default='wav'
     )
+    parser.add_argument(
+        '-method',
+        type=str,
+        help="Method used to calculate the first moment (basic or closing-window).",
+        choices=['basic', 'clw'],
+        default='basic'
+    )
     parser.add_argument(
         '-label',
         type=str,
@@ -79,7 +86,7 @@ def parser_init():
     return parser
 
 def obj_zmoments(cube, obj, obj_id=1, var=None, r_smooth=None, w_smooth=None, unit='wav',
-                 label=None, log=None, silent=None):
+                 method='basic', label=None, log=None, silent=None):
     """Create 2D maps of velocity and dispersion.
 
     Args:
@@ -94,6 +101,8 @@ def obj_zmoments(cube, obj, obj_id=1, var=None, r_smooth=None, w_smooth=None, un
             given as FWHM of a Gaussian kernel.
         unit (str): Output units for moments maps, either 'wav' for Angstroms or
             'kms' for kilometers per second.
+        method (str): Method used to calculate the first moment, 'basic' or 'clw'
+            for the closing-window method.
         label (str): Custom label for output file name, which will add .<label>_m1.fits to the
             input file name for the first moment map. e.g. provide "LyA" to get ".LyA_m1.fits",
             ".LyA_m2.fits" and so on. By default, the label will "objXX" where XX is the objID for
@@ -163,7 +172,8 @@ def obj_zmoments(cube, obj, obj_id=1, var=None, r_smooth=None, w_smooth=None, un
         obj_cube,
         obj_id,
         var_cube=var_cube,
-        unit=unit
+        unit=unit,
+        method=method
     )
 
     if label is None:
@@ -238,7 +238,7 @@ def psf_sub(cube, clist=None, var=None, xy=None, radec=None, reg=None, auto=7,
         if use_var:
             var_cube, var_header = fits.getdata(var_file_list[i], header=True)
         else:
-            var_cube = []
+            var_cube = None
 
         header2d = get_header2d(fits_in[0].header)
         wcs2d = WCS(header2d)
@@ -43,6 +43,20 @@ def parser_init():
         '-vardata',
         action='store_true'
     )
+    parser.add_argument(
+        '-var',
+        metavar='<var_cube>',
+        type=str,
+        help='Variance cube to rebin alongside the input.',
+        default=None
+    )
+    parser.add_argument(
+        '-mask',
+        metavar='<mask_cube>',
+        type=str,
+        help='Mask cube to rebin alongside the input (binned values are OR-ed).',
+        default=None
+    )
     parser.add_argument(
         '-log',
         metavar="<log_file>",
@@ -57,8 +71,8 @@ def parser_init():
     )
     return parser
 
-def rebin(cube, xybin=1, zbin=1, vardata=False, ext=".binned.fits", log=None,
-          silent=None):
+def rebin(cube, xybin=1, zbin=1, vardata=False, var=None, mask=None, ext=".binned.fits",
+          log=None, silent=None):
     """Rebin a data cube along the XY or Z axes.
 
     Args:
@@ -66,6 +80,8 @@ def rebin(cube, xybin=1, zbin=1, vardata=False, ext=".binned.fits", log=None,
         xybin (int): Bin-size for spatial axes
         zbin (int) Bin-size for wavelength axis
         vardata (bool): Set to TRUE if rebinning variance data
+        var (str): Path to a variance cube to rebin alongside the input
+        mask (str): Path to a mask cube to rebin alongside the input
         ext (str): File extension for output file
         log (str): Path to log file to save output to.
         silent (bool): Set to TRUE to suppress standard output.
@@ -87,17 +103,35 @@ def rebin(cube, xybin=1, zbin=1, vardata=False, ext=".binned.fits", log=None,
         utils.output("Binning 1x1x1 won't change anything!\nExiting.")
         sys.exit()
 
-    binned_fits = reduction.cubes.rebin(
-        data_fits,
-        bin_xy=xybin,
-        bin_z=zbin,
-        vardata=vardata
-    )
+    for extra_file in [var, mask]:
+        if extra_file is not None and not os.path.isfile(extra_file):
+            raise FileNotFoundError("Input file not found.\nFile:%s" % extra_file)
 
-    outfilename = cube.replace(".fits", ext)
+    if var is None and mask is None:
+        binned_fits = reduction.cubes.rebin(
+            data_fits,
+            bin_xy=xybin,
+            bin_z=zbin,
+            vardata=vardata
+        )
+        binned_list = [(cube, binned_fits)]
+    else:
+        binned_all = reduction.cubes.rebin_all(
+            data_fits,
+            bin_xy=xybin,
+            bin_z=zbin,
+            vardata=vardata,
+            var=None if var is None else fits.open(var),
+            mask=None if mask is None else fits.open(mask)
+        )
+        binned_list = list(zip([cube, var, mask], binned_all))
 
-    binned_fits.writeto(outfilename, overwrite=True)
-    utils.output("\tSaved %s\n" % outfilename)
+    for filename, binned in binned_list:
+        if filename is None:
+            continue
+        outfilename = filename.replace(".fits", ext)
+        binned.writeto(outfilename, overwrite=True)
+        utils.output("\tSaved %s\n" % outfilename)
     config.set_temp_output_mode(log, silent)
 
 
@@ -86,6 +86,13 @@ def parser_init():
         scipy.ndimage.morphology.binary_fill_holes',
         action='store_true'
     )
+    parser.add_argument(
+        '-slab_size',
+        metavar='<int>',
+        type=int,
+        help='Number of wavelength layers to segment at a time, to limit memory\
+        use for large cubes. Default is to segment the whole cube at once.'
+    )
     parser.add_argument(
         '-ext',
         type=str,
@@ -107,7 +114,7 @@ def parser_init():
 
 def segment(cube, var, snr_int=None, snr_min=3.0, n_min=10, include=None, exclude=None,
             include_neb_z=None, include_neb_dv=None, exclude_sky=False, exclude_sky_dw=None,
-            fill_holes=False, ext=".obj.fits", log=None, silent=None):
+            fill_holes=False, slab_size=None, ext=".obj.fits", log=None, silent=None):
     """Segment cube into 3D regions above a threshold.
 
     Args:
@@ -127,6 +134,8 @@ def segment(cube, var, snr_int=None, snr_min=3.0, n_min=10, include=None, exclud
         exclude_sky_dw (float): Width of sky-line masks to use, in Angstroms.
         fill_holes (bool): Set to TRUE to auto-fill holes in 3D objects using
             scipy.ndimage.morphology.binary_fill_holes.
+        slab_size (int): Number of wavelength layers to segment at a time, reading
+            the memory-mapped input cubes one slab at a time.
         ext (str): File extension for output file
         log (str): Path to log file to save output to.
         silent (bool): Set to TRUE to suppress standard output.
@@ -141,7 +150,7 @@ def segment(cube, var, snr_int=None, snr_min=3.0, n_min=10, include=None, exclud
     utils.output_func_summary("SEGMENT", locals())
 
     fits_in = fits.open(cube)
-    var_cube = fits.getdata(var)
+    var_cube = fits.getdata(var, memmap=True)
 
     #Try to parse the wavelength mask tuple
     includes_all = []
@@ -181,7 +190,8 @@ def segment(cube, var, snr_int=None, snr_min=3.0, n_min=10, include=None, exclud
         includes=includes_all,
         excludes=excludes_all,
         fill_holes=fill_holes,
-        snr_int=snr_int
+        snr_int=snr_int,
+        slab_size=slab_size
     )
 
     out_file = cube.replace(".fits", ext)
@@ -491,7 +491,84 @@ def obj_spec(fits_in, obj_cube, obj_id, var_cube=None, extend_z=False, rescale_c
 
     return table_hdu
 
-def obj_moments(fits_in, obj_cube, obj_id, var_cube=None, unit='kms'):
+def _get_moments(wav, spectra, mask, var=None, method='basic', window_size=25, window_min=10,
+                 window_step=1):
+    """Calculate the first and second moments of many spectra at once.
+
+    This gives the same results as measurement.first_moment and
+    measurement.second_moment applied to the masked part of each spectrum, but
+    uses reductions along the wavelength axis of all spectra at once. With the
+    'clw' method, the closing windows of all spectra are iterated in lockstep.
+
+    Args:
+        wav (numpy.ndarray): The wavelength axis, shape (N_z,)
+        spectra (numpy.ndarray): The spectra, shape (N_z, N_spec)
+        mask (numpy.ndarray): Boolean mask of values to use, shape (N_z, N_spec)
+        var (numpy.ndarray): Variance on the spectra. Taken as the variance of
+            the masked values of each spectrum if not provided.
+        method (str): The method to use for the first moment, 'basic' or 'clw'.
+            See measurement.first_moment.
+        window_size (float): Initial window size, if using the 'clw' method.
+        window_min (float): Minimum window size, if using the 'clw' method.
+        window_step (float): Decrement in window size, if using the 'clw' method.
+
+    Returns:
+        numpy.ndarray: First moment of each spectrum.
+        numpy.ndarray: Error on the first moment of each spectrum.
+        numpy.ndarray: Second moment of each spectrum.
+        numpy.ndarray: Error on the second moment of each spectrum.
+
+    """
+    wav = wav[:, None]
+    flux = np.where(mask, spectra, 0)
+    n_use = np.count_nonzero(mask, axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        #Estimate variance of each spectrum if none given
+        if var is None:
+            mean = np.sum(flux, axis=0) / n_use
+            var = np.sum(np.where(mask, spectra - mean, 0)**2, axis=0) / n_use
+        var = np.where(mask, var, 0)
+
+        num = np.sum(wav * flux, axis=0)
+        den = np.sum(flux, axis=0)
+
+        if method == 'basic':
+            mu1 = num / den
+
+        elif method == 'clw':
+
+            #Start at the central wavelength of each masked spectrum
+            center = np.argmax(np.cumsum(mask, axis=0) > n_use // 2, axis=0)
+            mu1 = wav[center, 0]
+
+            #Loop with decreasing window size until minimum is reached
+            window = window_size
+            while window > window_min:
+                use = mask & (np.abs(wav - mu1) < window / 2) & (spectra > 0)
+                flux_w = np.where(use, spectra, 0)
+                num = np.sum(wav * flux_w, axis=0)
+                den = np.sum(flux_w, axis=0)
+                mu1 = num / den
+                window -= window_step
+
+        else:
+            raise ValueError("method must be 'basic' or 'clw'")
+
+        mu1_err = np.sqrt(np.sum(var * (den * wav - num)**2, axis=0)) / den**2
+
+        #Second moment and its error, over all masked values
+        rsquared = (wav - mu1)**2
+        num2 = np.sum(rsquared * flux, axis=0)
+        den2 = np.sum(flux, axis=0)
+        mu2 = np.sqrt(num2 / den2)
+        mu2_err = np.sqrt(np.sum(var * (rsquared * den2 - num2)**2, axis=0) / den2**4) / (2 * mu2)
+
+    return mu1, mu1_err, mu2, mu2_err
+
+def obj_moments(fits_in, obj_cube, obj_id, var_cube=None, unit='kms', method='basic',
+                window_size=25, window_min=10, window_step=1):
     """Creates 2D maps of 1st and 2nd z-moments for 3D objects.
 
     Input can be ~astropy.io.fits.HDUList, ~astropy.io.fits.PrimaryHDU or
@@ -507,6 +584,12 @@ def obj_moments(fits_in, obj_cube, obj_id, var_cube=None, unit='kms'):
         unit (str): Desired output unit.
             'kms' - kilometers per second
             'wav' - wavelength units (same as input z-axis)
+        method (str): The method used to calculate the first moment.
+            'basic': Use all object voxels in each spaxel.
+            'clw': Use the closing-window method (see measurement.first_moment)
+        window_size (float): Initial window size, if using the 'clw' method.
+        window_min (float): Minimum window size, if using the 'clw' method.
+        window_step (float): Decrement in window size, if using the 'clw' method.
 
     Returns:
         HDU / HDUList*: First moment (velocity) map, with header
@@ -539,51 +622,27 @@ def obj_moments(fits_in, obj_cube, obj_id, var_cube=None, unit='kms'):
     mu2_map = np.zeros_like(msk2d, dtype=float)
 
     #Initialize as NaNs
-    mu1_map[:] = np.NaN
-    mu2_map[:] = np.NaN
+    mu1_map[:] = np.nan
+    mu2_map[:] = np.nan
 
     #Also create arrays for moment map error
     mu1_err_map = np.copy(mu1_map)
     mu2_err_map = np.copy(mu2_map)
 
-    #Loop over spaxels and calculate moments
-    for y_i in range(int_cube.shape[1]):
-        for x_j in range(int_cube.shape[2]):
-
-            msk_ij = bin_msk[:, y_i, x_j]
-
-            #Skip empty spaxels
-            if np.count_nonzero(msk_ij) == 0:
-                continue
-
-            #Extract wavelength domain and spectrum for this spaxel
-            wav_ij = wav_axis[msk_ij]
-            spc_ij = int_cube[msk_ij, y_i, x_j]
-            var_ij = None if var_cube is None else var_cube[msk_ij, y_i, x_j].copy()
-
-            #Calculate first moment
-            mu1, mu1_err = measurement.first_moment(
-                wav_ij,
-                spc_ij,
-                method='basic',
-                y_var=var_ij,
-                get_err=True
-            )
-
-            mu1_map[y_i, x_j] = mu1
-            mu1_err_map[y_i, x_j] = mu1_err
-
-            #Calculate second moment
-            mu2, mu2_err = measurement.second_moment(
-                wav_ij,
-                spc_ij,
-                mu1=mu1,
-                y_var=var_ij,
-                get_err=True
-            )
-
-            mu2_map[y_i, x_j] = mu2
-            mu2_err_map[y_i, x_j] = mu2_err
+    #Calculate moments of all object spaxels at once
+    y_obj, x_obj = np.nonzero(msk2d)
+    moments = _get_moments(
+        wav_axis,
+        int_cube[:, y_obj, x_obj],
+        bin_msk[:, y_obj, x_obj],
+        var=None if var_cube is None else var_cube[:, y_obj, x_obj],
+        method=method,
+        window_size=window_size,
+        window_min=window_min,
+        window_step=window_step
+    )
+    for moment_map, moment in zip([mu1_map, mu1_err_map, mu2_map, mu2_err_map], moments):
+        moment_map[y_obj, x_obj] = moment
 
     #If velocity units requested
     if unit.lower() == 'kms':
@@ -618,7 +677,8 @@ def obj_moments(fits_in, obj_cube, obj_id, var_cube=None, unit='kms'):
     return mu1_out, mu1_err_out, mu2_out, mu2_err_out
 
 def obj_moments_zfit(int_fits, obj_cube, obj_id, peak_wav, redshift=0, vel_max=2000,
-                     disp_bounds=(50, 500), ratio_bounds=(0.5, 2.0), unit="kms", var=None):
+                     disp_bounds=(50, 500), ratio_bounds=(0.5, 2.0), unit="kms", var=None,
+                     n_workers=1):
     """Calculate a 2D map of first/second moments using singlet or doublet line fitting.
 
     Args:
@@ -641,6 +701,8 @@ def obj_moments_zfit(int_fits, obj_cube, obj_id, peak_wav, redshift=0, vel_max=2
         unit (str): Output unit for moment maps, can be 'kms' for kilometers/second or 'wav' for
             input wavelength axis units
         var (numpy.ndarray): The variance cube associated with the input data
+        n_workers (int): Number of processes used to re-fit any spaxels for which
+            the batched line fit does not converge.
 
     Returns:
         HDUList/HDU: HDUlist or HDU containing the first moment map.
@@ -729,59 +791,47 @@ def obj_moments_zfit(int_fits, obj_cube, obj_id, peak_wav, redshift=0, vel_max=2
     #Set non-object voxels to zero
     int_cube[~usewav] = 0
 
-    #Get indices under mask and loop over them
-    xindices, yindices = np.where(bin_mask2d)
-    for y_i, x_i in zip(xindices, yindices):
-
-        spec_ij = int_cube[usewav, y_i, x_i]
-        spec_var = None if var is None else var[usewav, y_i, x_i]
-
-        #Fit model params using D.E.
-        if mode == 1:
-            fit_result = modeling.fit_model1d(
-                modeling.gauss1d,
-                model_bounds,
-                wavgood,
-                spec_ij,
-                y_var=spec_var
-            )
-            line_model = modeling.gauss1d(fit_result.x, wavgood)
-            line_model_full =  modeling.gauss1d(fit_result.x, wav_axis)
-        else:
-            fit_result = modeling.fit_model1d(
-                modeling.doublet,
-                model_bounds,
-                wavgood,
-                spec_ij,
-                peak_wav,
-                y_var=spec_var
-            )
-            #Get model
-            line_model = modeling.doublet(fit_result.x, wavgood, peak_wav)
-            line_model_full = modeling.doublet(fit_result.x, wav_axis, peak_wav)
-
-        #Skip spaxel if model did not fit successfully
-        if not fit_result.success:
-            continue
-
-        #Test if fit out-performs basic polynomial using AIC
-        poly_coeff = np.polyfit(wavgood, spec_ij, 2)
-        poly_model = np.poly1d(poly_coeff)(wavgood)
-        poly_aic = modeling.aic(poly_model, spec_ij, 3)
-        line_aic = modeling.aic(line_model, spec_ij, 4)
-        _, line_p = modeling.bic_weights([poly_aic, line_aic])
-
-        #Reject if model is not confident
-        if line_p < 0.95:
-            continue
+    #Get spectra of all spaxels under mask
+    yindices, xindices = np.where(bin_mask2d)
+    spectra = int_cube[usewav][:, yindices, xindices].T.astype(float)
+    spec_var = None if var is None else var[usewav][:, yindices, xindices].T
 
-        b_amp[y_i, x_i] = fit_result.x[0]
-        b_cen[y_i, x_i] = fit_result.x[1]
-        b_std[y_i, x_i] = fit_result.x[2]
-        if mode == 2:
-            ratio[y_i, x_i] = fit_result.x[3]
+    if mode == 1:
+        model_func, model_args = modeling.gauss1d, ()
+    else:
+        model_func, model_args = modeling.doublet, (peak_wav,)
+
+    #Fit line models to all spectra at once
+    fit_result = modeling.fit_model1d_batch(
+        model_func,
+        model_bounds,
+        wavgood,
+        spectra,
+        *model_args,
+        y_var=spec_var,
+        n_workers=n_workers
+    )
+    line_models = model_func(fit_result.x.T[..., None], wavgood, *model_args)
+
+    #Test if fits out-perform basic polynomials using AIC
+    poly_coeff = np.polyfit(wavgood, spectra.T, 2)
+    poly_models = np.vander(wavgood, 3).dot(poly_coeff).T
+    poly_aic = modeling.aic(poly_models, spectra, 3, axis=1)
+    line_aic = modeling.aic(line_models, spectra, 4, axis=1)
+    _, line_p = modeling.bic_weights([poly_aic, line_aic])
+
+    #Keep spaxels with successful and confident fits
+    keep = fit_result.success & (line_p >= 0.95)
+    y_k, x_k = yindices[keep], xindices[keep]
+    params = fit_result.x[keep]
+
+    b_amp[y_k, x_k] = params[:, 0]
+    b_cen[y_k, x_k] = params[:, 1]
+    b_std[y_k, x_k] = params[:, 2]
+    if mode == 2:
+        ratio[y_k, x_k] = params[:, 3]
 
-        model_3d[:, y_i, x_i] = line_model_full
+    model_3d[:, y_k, x_k] = model_func(params.T[..., None], wav_axis, *model_args).T
 
     #Store as HDULists/HDUs and return
     hdr2d = coordinates.get_header2d(hdu.header)
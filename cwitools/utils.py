@@ -350,6 +350,81 @@ def match_hdu_type(fits_in, data, header):
         return fits.PrimaryHDU(data, header)
     raise ValueError("Astropy ImageHDU, PrimaryHDU or HDUList expected.")
 
+def sigmaclip_median(data, valid, low=2, high=2, maxiters=None):
+    """Get sigma-clipped medians along the last axis of a batch of samples.
+
+    Each 1D sample along the last axis is clipped in the same way as by
+    scipy.stats.sigmaclip, but all samples are clipped at once. Each sample is
+    sorted once, so that the values surviving clipping always form a contiguous
+    range, whose mean and standard deviation are taken from cumulative sums.
+
+    Args:
+        data (numpy.ndarray): The input data, with samples along the last axis.
+        valid (numpy.ndarray): Boolean mask of values to use, broadcastable to
+            the shape of data.
+        low (float): Lower clipping bound, in standard deviations.
+        high (float): Upper clipping bound, in standard deviations.
+        maxiters (int): Maximum number of clipping iterations. Default is to
+            iterate until all samples have converged.
+
+    Returns:
+        numpy.ndarray: The clipped median of each sample, with shape
+            data.shape[:-1].
+
+    """
+    out_shape = data.shape[:-1]
+    samples = np.where(valid, data, np.nan).reshape(-1, data.shape[-1])
+    samples = np.sort(samples, axis=-1)
+    rows = np.arange(samples.shape[0])
+
+    #Range [lo, hi) of surviving values in each sorted sample (NaNs sort last)
+    lo = np.zeros(rows.size, dtype=int)
+    hi = np.count_nonzero(~np.isnan(samples), axis=-1)
+
+    #Shift each sample by a central value to limit round-off in the sums
+    shifted = samples - np.nan_to_num(samples[rows, hi // 2])[:, None]
+    csum = np.zeros((rows.size, samples.shape[1] + 1))
+    csum2 = np.zeros_like(csum)
+    np.cumsum(np.nan_to_num(shifted), axis=-1, out=csum[:, 1:])
+    np.cumsum(np.nan_to_num(shifted)**2, axis=-1, out=csum2[:, 1:])
+
+    #Clip the samples which have not converged yet
+    active = rows[hi > 0]
+    n_iter = 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        while active.size > 0 and (maxiters is None or n_iter < maxiters):
+            n_iter += 1
+            lo_a, hi_a = lo[active], hi[active]
+            count = hi_a - lo_a
+
+            mean = (csum[active, hi_a] - csum[active, lo_a]) / count
+            var = (csum2[active, hi_a] - csum2[active, lo_a]) / count - mean**2
+            std = np.sqrt(np.maximum(var, 0))
+
+            lower = (mean - std * low)[:, None]
+            upper = (mean + std * high)[:, None]
+            lo_new = np.maximum(lo_a, np.count_nonzero(shifted[active] < lower, axis=-1))
+            hi_new = np.minimum(hi_a, np.count_nonzero(shifted[active] <= upper, axis=-1))
+            hi_new = np.maximum(hi_new, lo_new)
+
+            changed = (lo_new != lo_a) | (hi_new != hi_a)
+            lo[active] = lo_new
+            hi[active] = hi_new
+            active = active[changed]
+
+    #Take the median of the surviving range of each sample
+    count = hi - lo
+    mid = np.minimum(lo + count // 2, samples.shape[1] - 1)
+    mid_low = np.maximum(mid - 1, 0)
+    medians = np.where(
+        count % 2 == 1,
+        samples[rows, mid],
+        (samples[rows, mid_low] + samples[rows, mid]) / 2
+        )
+    medians[count == 0] = np.nan
+
+    return medians.reshape(out_shape)
+
 def find_files(id_list, datadir, cubetype, depth=3):
     """Finds the input files given a CWITools parameter file and cube type.
 